@@ -3,17 +3,28 @@
 import time
 import os
 import sys
+import glob
 import datetime
 from optparse import OptionParser
 
+from obs_seq_diag import obs_seq_diagnostics, obs_seq_diag_products
+from obs_seq_collate import obs_seq_collate_files, obs_seq_netcdf_name
+from obs_seq_load import obs_seq_load_attrs
+
 _www_dir = "/www/www.nssl.noaa.gov/projects/wof/news-e/diagnostics"
+_rt_dir  = "/scratch/wof/realtime"
 
 _obs_exe = "/work/wicker/REALTIME/pyObsDiag/obs_seq_collate.py"
 _sfc_exe = "/work/wicker/REALTIME/pyObsDiag/plot_sfc_innov.py"
 _rad_inn = "/work/wicker/REALTIME/pyObsDiag/plot_radar_innov.py"
 _rad_rms = "/work/wicker/REALTIME/pyObsDiag/plot_radar_rms.py"
 
-def run_diag(year, month, day, run_collate=True):
+#-------------------------------------------------------------------------------
+# Collate the day and draw its images.  The realtime run (sort=False) only appends the
+# new cycles to the day's file; sorting rebuilds the whole file, so it is left to the run
+# of a finished day.
+
+def run_diag(year, month, day, run_collate=True, subprocess=False, copies=False, sort=True):
 
     today = "%4.4d%2.2d%2.2d" % (year, month, day)
     print(" Today is:  %s" % today)
@@ -21,7 +32,11 @@ def run_diag(year, month, day, run_collate=True):
     image_dir = "%s/." % (_www_dir)
 
     if run_collate:
-        cmd = 'python %s -d "/scratch/wof/realtime/%s/%s*" -f "obs_seq.final*" -p obs_seq.final' % (_obs_exe, today, year)
+        cmd = 'python %s -d "%s/%s/%s*" -f "obs_seq.final*" -p obs_seq.final -i --stats' % (_obs_exe, _rt_dir, today, year)
+        if sort:
+            cmd = cmd + ' --sort'
+        if copies:
+            cmd = cmd + ' --copies'
 
         print(" Cmd: %s" % (cmd))
         ret = os.system("%s" % cmd)
@@ -31,6 +46,12 @@ def run_diag(year, month, day, run_collate=True):
             print("\n ============================================================================")
             sys.exit(-1)
 
+# All the plots in this process, reading the collated file once
+
+    if not subprocess:
+        obs_seq_diagnostics("obs_seq.final.%s.nc" % today, image_dir=image_dir)
+        return
+
 # Surface diagnostics
     cmd = 'python %s -f obs_seq.final.%s.nc --dir %s' % (_sfc_exe, today, image_dir)
     print(" Cmd: %s" % (cmd))
@@ -52,6 +73,107 @@ def run_diag(year, month, day, run_collate=True):
     print(" Cmd: %s" % (cmd))
     ret = os.system("%s" % cmd)
 
+#-------------------------------------------------------------------------------
+# Watch mode:  poll the day's realtime directory every poll seconds and, as each
+# obs_seq.final file is complete, append it to the collated file (and its statistics cube)
+# and redraw only the images of the kinds it holds.  A file is complete once its size and
+# mtime are the same on two polls in a row, so files DART is still writing are left alone.
+# A file that fails to collate is tried again once it changes.  Stops after idle minutes
+# without a new file collated (0:  never), sorting the day's file like the cron run does.
+# With copies=True the member copies are collated too, and the rank histograms (which
+# read all of them) are redrawn at most every rank_every minutes and once more after the
+# final sort.
+
+def watch_diag(year, month, day, poll=10., idle=180., processes=None, copies=False, rank_every=30.):
+
+    today = "%4.4d%2.2d%2.2d" % (year, month, day)
+    print(" Watching:  %s/%s/%s*/obs_seq.final*" % (_rt_dir, today, year))
+
+    image_dir = "%s/." % (_www_dir)
+
+    last        = {}       # (size, mtime) of every file at the last poll
+    done        = {}       # (size, mtime) of every file when it was collated
+    failed      = {}       # (size, mtime) of every file when it failed to collate
+    netcdf_file = None
+    last_new    = time.time()
+    rank_last   = None     # time the rank histograms were last drawn
+    rank_stale  = False    # new files since then
+
+    while idle <= 0 or time.time() - last_new <= 60.*idle:
+
+        new = []
+        for file in glob.glob("%s/%s/%s*/obs_seq.final*" % (_rt_dir, today, year)):
+            if file.find(".nc") != -1:  continue
+            try:
+                stat = os.stat(file)
+            except OSError:
+                continue
+            now = (stat.st_size, stat.st_mtime)
+            if stat.st_size > 0 and last.get(file) == now and done.get(file) != now and failed.get(file) != now:
+                new.append(file)
+            last[file] = now
+
+        if len(new) > 0:
+
+            start = time.time()
+            kinds = set()
+            added = 0
+
+            # The new files are appended one at a time, so a file that cannot be collated
+            # (e.g. one whose writer paused for more than two polls) only holds up itself:
+            # it is left out of done and skipped until its size or mtime changes
+
+            for file in sorted(new, key = lambda file: last[file][1]):
+                ready       = dict(done)
+                ready[file] = last[file]
+                files       = sorted(ready.keys(), key = lambda file: ready[file][1])
+                try:
+                    kinds.update(obs_seq_collate_files(files, obs_seq_netcdf_name(files, "obs_seq.final"),
+                                                       incremental=True, stats=True, copies=copies))
+                except Exception as error:
+                    print(" Watch:  cannot collate %s, retrying when it changes:  %s" % (file, error))
+                    failed[file] = last[file]
+                    continue
+                done        = ready
+                netcdf_file = obs_seq_netcdf_name(files, "obs_seq.final")
+                added       = added + 1
+
+            if added == 0:
+                time.sleep(poll)
+                continue
+
+            products = obs_seq_diag_products(obs_seq_load_attrs(netcdf_file), kinds)
+
+            if 'RANK' in products:
+                if rank_last != None and time.time() - rank_last < 60.*rank_every:
+                    products.remove('RANK')
+                    rank_stale = True
+                else:
+                    rank_last  = time.time()
+                    rank_stale = False
+
+            if len(products) > 0:
+                try:
+                    obs_seq_diagnostics(netcdf_file, image_dir=image_dir, processes=processes, products=products)
+                except Exception as error:
+                    print(" Watch:  drawing %s failed:  %s" % (", ".join(products), error))
+
+            print(" Watch:  %d new files, updated %s in %5.2f sec" % (added, ", ".join(products), time.time() - start))
+
+            last_new = time.time()
+
+        time.sleep(poll)
+
+    files = sorted(done.keys(), key = lambda file: done[file][1])
+
+    if netcdf_file != None:
+        try:
+            obs_seq_collate_files(files, netcdf_file, incremental=True, sort=True, stats=True, copies=copies)
+            if rank_stale:
+                obs_seq_diagnostics(netcdf_file, image_dir=image_dir, processes=processes, products=['RANK'])
+        except Exception as error:
+            print(" Watch:  sorting %s failed:  %s" % (netcdf_file, error))
+
 #-------------------------------------------------------------------------------
 # Main function defined to return correct sys.exit() calls
 
@@ -71,16 +193,46 @@ def main(argv=None):
    parser.add_option(      "--nofile",  dest="nofile",    default=True, action="store_false", \
                help = "Boolean flag to not create file, just plots")
 
+   parser.add_option(      "--subprocess",  dest="subprocess",    default=False, action="store_true", \
+               help = "Boolean flag to run each plot script in its own python")
+
+   parser.add_option(      "--watch",  dest="watch",    default=False, action="store_true", \
+               help = "Boolean flag to keep running, processing each obs_seq.final file of the day as it lands")
+
+   parser.add_option(      "--poll",  dest="poll",    default=10., type="float", \
+               help = "Seconds between polls of the realtime directory in watch mode, default is 10")
+
+   parser.add_option(      "--idle",  dest="idle",    default=180., type="float", \
+               help = "Minutes without new files after which watch mode stops (0: never), default is 180")
+
+   parser.add_option(      "--copies",  dest="copies",    default=False, action="store_true", \
+               help = "Boolean flag to collate the member copies of every ob too, for the rank histograms")
+
+   parser.add_option(      "--rank_every",  dest="rank_every",    default=30., type="float", \
+               help = "Minutes between redraws of the rank histograms in watch mode, default is 30")
+
    (options, args) = parser.parse_args()
 
+   if options.watch:
+       if options.date != None:
+           year, month, day = int(options.date[0:4]), int(options.date[4:6]), int(options.date[6:8])
+       else:
+           local_today = time.localtime()
+           year, month, day = local_today.tm_year, local_today.tm_mon, local_today.tm_mday
+       watch_diag(year, month, day, poll=options.poll, idle=options.idle, copies=options.copies,
+                  rank_every=options.rank_every)
+       sys.exit(0)
+
    if options.realtime:
        local_today = time.localtime()
-       run_diag(local_today.tm_year, local_today.tm_mon, local_today.tm_mday)
+       run_diag(local_today.tm_year, local_today.tm_mon, local_today.tm_mday, subprocess=options.subprocess,
+                copies=options.copies, sort=False)
        sys.exit(0)
 
    if options.date != None:
        year, month, day = options.date[0:4], options.date[4:6], options.date[6:8]
-       run_diag(int(year), int(month), int(day), run_collate=options.nofile)
+       run_diag(int(year), int(month), int(day), run_collate=options.nofile, subprocess=options.subprocess,
+                copies=options.copies)
        sys.exit(0)
 
    print(" \n Error, incorrect input arguments...exiting\n")
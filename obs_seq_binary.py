@@ -0,0 +1,275 @@
+# coding: utf-8
+#
+# Reader for binary (Fortran unformatted, sequential access) DART obs_seq files.
+#
+# Every Fortran record is written between two 4 byte markers holding its length.  The
+# header (kinds, copy and qc names, counts) is a few hundred records and is walked one
+# record at a time.  The observations are not:  each one starts with the same chain of
+# records -
+#
+#   values(num_copies)  qc(num_qc)  prev next cov_group  lon lat vloc which_vert  kind
+#
+# - then the records specific to its kind (radar platform, ...) and ends with
+#
+#   seconds days  error_variance
+#
+# so the record starts are found for the whole file at once by matching that chain of
+# markers on an int32 view of the memory map, and the fixed parts of all the records are
+# then read through NumPy structured dtypes laid over the map (a strided view when the
+# records are equally spaced, otherwise one gather of the record starts).  The columns
+# are the same as those of the ASCII engine (obs_seq_parse).
+#
+
+import struct
+import numpy as np
+
+import obs_seq_parse
+
+#=========================================================================================
+# Byte order of a binary obs_seq file ('<' or '>'), None for an ASCII file:  the first
+# record is the 12 characters "obs_sequence"
+#
+def obs_seq_binary_order(filename):
+
+    f = open(filename, 'rb')
+    try:
+        head = f.read(16)
+    finally:
+        f.close()
+
+    if len(head) < 16 or head[4:16] != b'obs_sequence':
+        return None
+
+    for order in ['<', '>']:
+        if struct.unpack(order + 'i', head[:4])[0] == 12:
+            return order
+
+    return None
+
+#-------------------------------------------------------------------------------
+# Walk the records of the header.  Returns a dictionary with the same header information
+# as obs_seq_collate.obs_seq_header for ASCII files, plus the byte order, the size of the
+# reals and the offset of the first observation.
+#
+def obs_seq_binary_header(filename):
+
+    order = obs_seq_binary_order(filename)
+    buf   = obs_seq_parse.obs_seq_mmap(filename)
+    pos   = [0]
+
+    def record():
+        length = struct.unpack_from(order + 'i', buf, pos[0])[0]
+        data   = buf[pos[0]+4:pos[0]+4+length].tobytes()
+        if struct.unpack_from(order + 'i', buf, pos[0]+4+length)[0] != length:
+            raise ValueError("obs_seq_binary:  bad record marker at byte %d of %s" % (pos[0], filename))
+        pos[0] = pos[0] + length + 8
+        return data
+
+    def text(data):
+        return data.decode('ascii', 'replace').strip()
+
+    record()                                            # "obs_sequence"
+    record()                                            # "obs_type_definitions"
+    num_ob_kinds = struct.unpack(order + 'i', record())[0]
+
+    obtype_dict = {}
+    for n in range(num_ob_kinds):
+        data = record()
+        obtype_dict[struct.unpack(order + 'i', data[:4])[0]] = text(data[4:])
+
+    num_copies, num_qc, num_obs, max_num_obs = struct.unpack(order + '4i', record())
+
+    copy_names = [text(record()) for n in range(num_copies)]
+    qc_names   = [text(record()) for n in range(num_qc)]
+
+    first, last = struct.unpack(order + '2i', record())
+
+    # Size of the reals (r8 or r4 builds of DART) from the first observation's copies
+
+    real_size = 8
+    if num_obs > 0 and num_copies + num_qc > 0:
+        real_size = struct.unpack_from(order + 'i', buf, pos[0])[0] // (num_copies if num_copies > 0 else num_qc)
+
+    return {'filename':      filename,
+            'num_obs_kinds': num_ob_kinds,
+            'obs_type':      obtype_dict,
+            'copy_names':    copy_names,
+            'qc_names':      qc_names,
+            'num_copies':    num_copies,
+            'num_qc':        num_qc,
+            'num_obs':       num_obs,
+            'max_num_obs':   max_num_obs,
+            'first':         first,
+            'last':          last,
+            'ob_offset':     None,
+            'binary':        True,
+            'byte_order':    order,
+            'real_size':     real_size,
+            'body':          pos[0]}
+
+#=========================================================================================
+# Structured dtypes of the fixed records at the start and at the end of an observation
+#
+def obs_seq_binary_dtypes(fhead):
+
+    i = fhead.byte_order + 'i4'
+    r = fhead.byte_order + ('f8' if fhead.real_size == 8 else 'f4')
+
+    head = []
+    if fhead.num_copies > 0:
+        head += [('m_values', i), ('values', r, (fhead.num_copies,)), ('e_values', i)]
+    if fhead.num_qc > 0:
+        head += [('m_qc', i), ('qc', r, (fhead.num_qc,)), ('e_qc', i)]
+    head += [('m_link', i), ('prev', i), ('next', i), ('cov_group', i), ('e_link', i),
+             ('m_loc', i), ('lon', r), ('lat', r), ('vloc', r), ('which_vert', i), ('e_loc', i),
+             ('m_kind', i), ('kind', i), ('e_kind', i)]
+
+    tail = [('m_time', i), ('seconds', i), ('days', i), ('e_time', i),
+            ('m_var', i), ('error_variance', r), ('e_var', i)]
+
+    return np.dtype(head), np.dtype(tail)
+
+#-------------------------------------------------------------------------------
+# Byte offsets of the observation records:  every position where the chain of record
+# markers of an observation start matches, with a valid kind number
+#
+def obs_seq_binary_starts(buf, fhead):
+
+    rs      = fhead.real_size
+    lengths = []
+    if fhead.num_copies > 0:  lengths.append(rs * fhead.num_copies)
+    if fhead.num_qc > 0:      lengths.append(rs * fhead.num_qc)
+    lengths += [12, 3 * rs + 4, 4]
+
+    kinds  = np.array(sorted(fhead.obs_type.keys()), dtype=np.int64)
+    starts = []
+
+    # Records are a whole number of words long, but kind specific records may not be, so
+    # every byte phase of the body is searched
+
+    for phase in range(4):
+
+        offset = fhead.body + phase
+        nwords = (buf.size - offset) // 4
+        if nwords <= 0:
+            continue
+
+        words = np.frombuffer(buf, dtype=fhead.byte_order + 'i4', count=nwords, offset=offset)
+        first = np.flatnonzero(words == lengths[0])
+        k     = first
+
+        for length in lengths:
+            end  = k + 1 + length // 4
+            ok   = end < nwords
+            first, k, end = first[ok], k[ok], end[ok]
+            ok   = (words[k] == length) & (words[end] == length)
+            first, k = first[ok], k[ok]
+            k = k + 2 + length // 4
+
+        # ... the last record being the kind
+
+        ok     = np.isin(words[k - 2], kinds)
+        first  = first[ok]
+
+        starts.append(offset + 4 * first.astype(np.int64))
+
+    return np.sort(np.concatenate(starts + [np.zeros(0, dtype=np.int64)]))
+
+#-------------------------------------------------------------------------------
+# Records of a dtype at the given byte offsets of the map:  a strided view when they are
+# equally spaced, otherwise a gather from the view with a record at every byte
+#
+def obs_seq_binary_records(buf, offsets, dtype):
+
+    if offsets.size == 0:
+        return np.zeros(0, dtype=dtype)
+
+    if offsets.size == 1 or np.all(np.diff(offsets) == offsets[1] - offsets[0]):
+        stride = int(offsets[1] - offsets[0]) if offsets.size > 1 else dtype.itemsize
+        return np.ndarray((offsets.size,), dtype=dtype, buffer=buf, offset=int(offsets[0]), strides=(stride,))
+
+    every = np.ndarray((buf.size - dtype.itemsize + 1,), dtype=dtype, buffer=buf, offset=0, strides=(1,))
+
+    return every[offsets]
+
+#=========================================================================================
+# Columns (as obs_seq_parse.obs_seq_parse_buffer) of the observations starting at the byte
+# offsets starts, each ending at the matching offset of ends; number is the index of the
+# first of them in the file.  copies=True adds the float32 matrix of all the copies.
+#
+def obs_seq_binary_columns(buf, fhead, starts, ends, number=0, copies=False):
+
+    head_type, tail_type = obs_seq_binary_dtypes(fhead)
+
+    head = obs_seq_binary_records(buf, starts, head_type)
+    tail = obs_seq_binary_records(buf, ends - tail_type.itemsize, tail_type)
+
+    if not (np.all(tail['m_time'] == 8) and np.all(tail['m_var'] == fhead.real_size)):
+        raise ValueError("obs_seq_binary:  unexpected time/error variance records in %s" % fhead.filename)
+
+    copy_map, qc_map = obs_seq_parse.obs_seq_copy_map(fhead)
+
+    cols = {'number': number + np.arange(starts.size, dtype=np.int64)}
+
+    for field, numcp in copy_map.items():
+        cols[field] = head['values'][:, numcp].astype(np.float64)
+    for field, numqc in qc_map.items():
+        cols[field] = head['qc'][:, numqc].astype(np.float64)
+    if copies:
+        if fhead.num_copies > 0:
+            cols['copies'] = head['values'].astype(np.float32)
+        else:
+            cols['copies'] = np.zeros((starts.size, 0), dtype=np.float32)
+
+    lon = np.rad2deg(head['lon'].astype(np.float64))
+    lon[lon > 180.0] -= 360.
+
+    cols['lon']            = lon
+    cols['lat']            = np.rad2deg(head['lat'].astype(np.float64))
+    cols['height']         = head['vloc'].astype(np.float64)
+    cols['vert_coord']     = head['which_vert'].astype(np.int32)
+    cols['kind']           = head['kind'].astype(np.int32)
+    cols['seconds']        = tail['seconds'].astype(np.int64)
+    cols['days']           = tail['days'].astype(np.int64)
+    cols['error_variance'] = tail['error_variance'].astype(np.float64)
+
+    return cols
+
+#-------------------------------------------------------------------------------
+# Start and end byte offsets of all the observations of a file
+#
+def obs_seq_binary_bounds(buf, fhead):
+
+    starts = obs_seq_binary_starts(buf, fhead)
+
+    if starts.size != fhead.num_obs:
+        raise ValueError("obs_seq_binary:  found %d of the %d observations of %s" %
+                         (starts.size, fhead.num_obs, fhead.filename))
+
+    ends = np.concatenate((starts[1:], [buf.size] if starts.size > 0 else [])).astype(np.int64)
+
+    return starts, ends
+
+#=========================================================================================
+# Read all the observations of a binary file (header from obs_seq_binary_header)
+#
+def read_binary_columns(fhead, copies=False):
+
+    buf          = obs_seq_parse.obs_seq_mmap(fhead.filename)
+    starts, ends = obs_seq_binary_bounds(buf, fhead)
+
+    return obs_seq_binary_columns(buf, fhead, starts, ends, copies=copies)
+
+#-------------------------------------------------------------------------------
+# Generator version:  column dictionaries of batch_size observations
+#
+def iter_binary_columns(fhead, batch_size=100000, copies=False):
+
+    buf          = obs_seq_parse.obs_seq_mmap(fhead.filename)
+    starts, ends = obs_seq_binary_bounds(buf, fhead)
+
+    for first in range(0, starts.size, batch_size):
+        yield obs_seq_binary_columns(buf, fhead, starts[first:first+batch_size], ends[first:first+batch_size],
+                                     number=first, copies=copies)
+
+# End of file
@@ -0,0 +1,293 @@
+# coding: utf-8
+#
+# Vectorized binning of obs-space statistics for the plotting scripts.
+#
+# Every observation is matched to its time and height bins once (np.searchsorted on the bin
+# edges, expanded for overlapping bins like the 45 min windows every 15 min), and the sums
+# for all the cells are then formed with np.bincount.  This replaces the nested loops of
+# DataFrame.query calls that rescanned the field for every (time, height) cell.
+#
+# Regular sliding windows (window minutes every stride minutes) are summed from per-interval
+# prefix sums instead, so every obs is added once however much the windows overlap.
+#
+
+import numpy as np
+
+#=========================================================================================
+# Match values to a list of (lo, hi) bins.  Returns two arrays (rows, bins):  value
+# rows[i] falls in bin bins[i].  A value can be in several bins when the bins overlap, or
+# in none (gaps, out of range, NaN).  lo_closed/hi_closed select <= or < at each end.
+#
+def obs_seq_bin_pairs(values, bins, lo_closed=True, hi_closed=True):
+
+    values = np.asarray(values, dtype=np.float64)
+    lo     = np.array([b[0] for b in bins], dtype=np.float64)
+    hi     = np.array([b[1] for b in bins], dtype=np.float64)
+
+    if len(lo) > 1 and (np.any(np.diff(lo) < 0) or np.any(np.diff(hi) < 0)):
+
+        # Bins not in order:  test them one at a time
+
+        rows, index = [], []
+        for n in range(len(bins)):
+            keep = (lo[n] <= values if lo_closed else lo[n] < values) & \
+                   (values <= hi[n] if hi_closed else values < hi[n])
+            rows.append(np.nonzero(keep)[0])
+            index.append(np.full(len(rows[-1]), n, dtype=np.int64))
+        rows  = np.concatenate(rows)
+        index = np.concatenate(index)
+        order = np.argsort(rows, kind='mergesort')
+        return rows[order], index[order]
+
+    # Bins in order:  the bins holding a value are the contiguous run from the first bin
+    # whose upper edge is above it to the last bin whose lower edge is below it
+
+    first = np.searchsorted(hi, values, side='left'  if hi_closed else 'right')
+    last  = np.searchsorted(lo, values, side='right' if lo_closed else 'left')
+    count = np.maximum(last - first, 0)
+
+    rows   = np.repeat(np.arange(len(values)), count)
+    offset = np.arange(len(rows)) - np.repeat(np.cumsum(count) - count, count)
+    index  = np.repeat(first, count) + offset
+
+    return rows, index
+
+#-------------------------------------------------------------------------------
+# Same bins as the old query strings produce:  time bins as '%d <= anal_min <= %d' and
+# height bins as '%f < height <= %f'
+#
+def obs_seq_query_bins(time=None, height=None):
+
+    if time != None:
+        time = [(int(t[0]), int(t[1])) for t in time]
+
+    if height != None:
+        height = [(float('%f' % z[0]), float('%f' % z[1])) for z in height]
+
+    return time, height
+
+#=========================================================================================
+# Sums for every (height, time) cell:  returns a dictionary of (nheight, ntime) arrays
+#
+#   count       number of non-missing values of variable
+#   sum, sumsq  sum and sum of squares of variable
+#   num_obs     number of values != 0 (missing values count, as with np.sum(x != 0.0))
+#   sp_count    number of non-missing values of the spread field
+#   sp_sum      sum of the spread field
+#
+# plus 'mins' (bin start times) and 'hgts' (bin mid heights).  With height=None all heights
+# fall in a single bin.  Only obs with dart_qc < 0.1 are used when dart_qc is True, and
+# only those matching the threshold query string when one is given.
+#
+def obs_seq_bin_sums(df, variable, time, height=None, spread='sdHxf', threshold=None, dart_qc=True):
+
+    time_q, height_q = obs_seq_query_bins(time, height)
+
+    if dart_qc:
+        df = df[df['dart_qc'].values < 0.1]
+
+    if threshold != None:
+        df = df.query(threshold)
+
+    data = np.asarray(df[variable].values, dtype=np.float64)
+    sprd = np.asarray(df[spread].values, dtype=np.float64)
+
+    # Height bin(s) of every obs
+
+    if height != None:
+        rows, zbin = obs_seq_bin_pairs(df['height'].values, height_q, lo_closed=False)
+        nz         = len(height)
+    else:
+        rows = np.arange(len(df))
+        zbin = np.zeros(len(df), dtype=np.int64)
+        nz   = 1
+
+    x   = data[rows]
+    s   = sprd[rows]
+    xok = ~np.isnan(x)
+    sok = ~np.isnan(s)
+
+    weights = {'count':    xok.astype(np.float64),
+               'sum':      np.where(xok, x, 0.0),
+               'sumsq':    np.where(xok, x*x, 0.0),
+               'num_obs':  (x != 0.0).astype(np.float64),
+               'sp_count': sok.astype(np.float64),
+               'sp_sum':   np.where(sok, s, 0.0)}
+
+    anal_min = df['anal_min'].values[rows]
+    windows  = obs_seq_sliding_windows(time_q)
+
+    if windows != None:
+        sums = obs_seq_window_sums(weights, anal_min, zbin, nz, *windows)
+    else:
+        sums = obs_seq_pair_sums(weights, anal_min, zbin, nz, time_q)
+
+    sums['mins'] = np.array([t[0] for t in time])
+
+    if height != None:
+        sums['hgts'] = np.array([0.5*(z[0]+z[1]) for z in height])
+
+    return sums
+
+#-------------------------------------------------------------------------------
+# Sums of two sets of obs (either can be None):  the cell sums add, the bin times and
+# heights are the same
+#
+def obs_seq_add_sums(a, b):
+
+    if a is None:  return b
+    if b is None:  return a
+
+    sums = dict(a)
+    for key in ['count', 'sum', 'sumsq', 'num_obs', 'sp_count', 'sp_sum']:
+        sums[key] = a[key] + b[key]
+
+    return sums
+
+#-------------------------------------------------------------------------------
+# Cell sums for any list of time bins:  every (time bin, height bin) combination of an
+# obs is a cell it goes into
+#
+def obs_seq_pair_sums(weights, anal_min, zbin, nz, time):
+
+    pair, tbin = obs_seq_bin_pairs(anal_min, time)
+    cell       = zbin[pair] * len(time) + tbin
+
+    sums = {}
+    for key in weights.keys():
+        sums[key] = np.bincount(cell, weights=weights[key][pair],
+                                minlength=nz*len(time)).reshape(nz, len(time))
+    return sums
+
+#=========================================================================================
+# Sliding windows:  time bins (start + n*stride, start + n*stride + window) with integer
+# window and stride, as in the default 45 min windows every 15 min.  Returns the tuple
+# (start, window, stride, nwin), or None when the bins are not like that.
+#
+def obs_seq_sliding_windows(time):
+
+    if time == None or len(time) == 0:
+        return None
+
+    start  = time[0][0]
+    window = time[0][1] - time[0][0]
+    stride = time[1][0] - time[0][0] if len(time) > 1 else window
+
+    if window <= 0 or stride <= 0:
+        return None
+
+    for n, t in enumerate(time):
+        if t[0] != start + n*stride or t[1] - t[0] != window:
+            return None
+
+    return start, window, stride, len(time)
+
+#-------------------------------------------------------------------------------
+# Sliding window sums from prefix sums.  The time axis is cut into base intervals of
+# gcd(window, stride) minutes; every obs is added once to its half-open base interval
+# [b, b+1), or to the "exact" array when it is right on an interval edge.  A closed window
+# [lo, hi] is then cumsum[hi] - cumsum[lo] + exact[hi], so the cost does not grow with the
+# window length or the overlap.
+#
+def obs_seq_window_sums(weights, anal_min, zbin, nz, start, window, stride, nwin):
+
+    base  = obs_seq_gcd(window, stride)
+    nbase = ((nwin - 1) * stride + window) // base
+
+    # Base interval of every obs, checked against the edges themselves so rounding in the
+    # division cannot move an obs across an edge
+
+    with np.errstate(invalid='ignore'):
+        b      = np.floor((anal_min - start) / float(base))
+        b     -= (start + b*base) > anal_min
+        b     += (start + (b+1)*base) <= anal_min
+        exact  = anal_min == start + b*base
+        keep   = (b >= 0) & (b <= nbase)
+
+    b    = b[keep].astype(np.int64)
+    z    = zbin[keep]
+    edge = exact[keep]
+
+    lo = (np.arange(nwin) * stride) // base
+    hi = lo + window // base
+
+    sums = {}
+    for key in weights.keys():
+
+        w = weights[key][keep]
+
+        inside = np.bincount(z * (nbase+1) + b, weights=w, minlength=nz*(nbase+1)).reshape(nz, nbase+1)
+        onedge = np.bincount(z[edge] * (nbase+1) + b[edge], weights=w[edge],
+                             minlength=nz*(nbase+1)).reshape(nz, nbase+1)
+
+        prefix = np.zeros((nz, nbase+2))
+        np.cumsum(inside, axis=1, out=prefix[:, 1:])
+
+        sums[key] = prefix[:, hi] - prefix[:, lo] + onedge[:, hi]
+
+    return sums
+
+def obs_seq_gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+#-------------------------------------------------------------------------------
+# Time bins for windows of the given length (minutes) every stride minutes over period
+# minutes.  obs_seq_time_windows(45, 15) are the usual 45 minute windows every 15 minutes.
+#
+def obs_seq_time_windows(window=45, stride=15, period=540):
+
+    return [(stride*t, stride*t + window) for t in range(int(period) // int(stride))]
+
+#-------------------------------------------------------------------------------
+# Ratio a / n, NaN where n == 0 (the mean of an empty selection)
+#
+def obs_seq_bin_mean(a, n):
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(n > 0, a / np.where(n > 0, n, 1.0), np.nan)
+
+#-------------------------------------------------------------------------------
+# The time-height dictionary the plotting functions use:  bin2d is the mean of variable
+# (statistic="mean") or its root mean square (statistic="rms"), spread the mean spread
+#
+def obs_seq_2D_stats(df, variable, time=None, height=None, threshold=None, dart_qc=True,
+                     statistic="mean", spread='sdHxf'):
+
+    sums = obs_seq_bin_sums(df, variable, time, height, spread=spread, threshold=threshold, dart_qc=dart_qc)
+
+    return obs_seq_2D_from_sums(sums, statistic)
+
+def obs_seq_2D_from_sums(sums, statistic="mean"):
+
+    if statistic == "rms":
+        bins = np.sqrt(obs_seq_bin_mean(sums['sumsq'], sums['count']))
+    else:
+        bins = obs_seq_bin_mean(sums['sum'], sums['count'])
+
+    return {'spread':  obs_seq_bin_mean(sums['sp_sum'], sums['sp_count']),
+            'bin2d':   bins,
+            'num_obs': sums['num_obs'],
+            'mins':    sums['mins'],
+            'hgts':    sums['hgts']}
+
+#-------------------------------------------------------------------------------
+# The time series dictionary of plot_sfc_innov:  mean and RMS of variable and the mean
+# spread in each time bin, masked where a bin is empty
+#
+def obs_seq_1D_stats(df, variable, time=None, threshold=None, dart_qc=True, spread='sdHxa'):
+
+    sums = obs_seq_bin_sums(df, variable, time, spread=spread, threshold=threshold, dart_qc=dart_qc)
+
+    return obs_seq_1D_from_sums(sums)
+
+def obs_seq_1D_from_sums(sums):
+
+    return {'spread':  np.ma.masked_invalid(obs_seq_bin_mean(sums['sp_sum'], sums['sp_count'])[0]),
+            'bin1d':   np.ma.masked_invalid(obs_seq_bin_mean(sums['sum'], sums['count'])[0]),
+            'rms1d':   np.ma.masked_invalid(np.sqrt(obs_seq_bin_mean(sums['sumsq'], sums['count']))[0]),
+            'num_obs': sums['num_obs'][0],
+            'mins':    sums['mins']}
+
+# End of file
@@ -0,0 +1,145 @@
+# coding: utf-8
+#
+# Content-addressed cache of parsed obs_seq columns.
+#
+# Each obs_seq file is keyed by the SHA-1 of its bytes together with the parser version,
+# and its column dictionary (from obs_seq_parse) is stored as an uncompressed .npz sidecar
+# in the cache directory.  Re-running a day (rerun.csh, new plot layouts, ...) then loads
+# the binary columns instead of parsing the text again.  The cache is kept under a size
+# limit by removing the least recently used entries.
+#
+
+import os
+import hashlib
+import numpy as np
+
+import obs_seq_parse
+
+_default_dir   = os.path.join(os.path.expanduser("~"), ".obs_seq_cache")
+_default_bytes = 20 * 1024**3
+
+#=========================================================================================
+# Cache handle - only holds the directory and size limit, so it can be passed to the
+# worker processes of obs_seq_collate.obs_seq_read_files
+#
+class ParseCache(object):
+
+    def __init__(self, directory=None, max_bytes=None):
+
+        self.directory = directory or os.environ.get("OBS_SEQ_CACHE", _default_dir)
+        self.max_bytes = max_bytes or _default_bytes
+
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):  raise
+
+        self.evict()
+
+    #-------------------------------------------------------------------------------
+    # Cache key:  hash of the parser version and the file contents
+    #
+    def key(self, filename, block_size=16*1024*1024):
+
+        sha = hashlib.sha1()
+        sha.update(("obs_seq_parse-%s\n" % obs_seq_parse.parser_version).encode('ascii'))
+
+        f = open(filename, 'rb')
+        try:
+            block = f.read(block_size)
+            while len(block) > 0:
+                sha.update(block)
+                block = f.read(block_size)
+        finally:
+            f.close()
+
+        return sha.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, "%s.npz" % key)
+
+    #-------------------------------------------------------------------------------
+    # Returns the column dictionary stored under key, or None.  A hit refreshes the
+    # entry's mtime, which is what eviction goes by.
+    #
+    def load(self, key):
+
+        path = self.path(key)
+
+        try:
+            npz  = np.load(path)
+            cols = dict((name, npz[name]) for name in npz.files)
+            npz.close()
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return cols
+
+    #-------------------------------------------------------------------------------
+    # Store a column dictionary.  Written to a temporary name and renamed into place,
+    # so concurrent readers/writers never see a partial file.
+    #
+    def store(self, key, cols):
+
+        path = self.path(key)
+        tmp  = "%s.%d.tmp" % (path, os.getpid())
+
+        f = open(tmp, 'wb')
+        try:
+            np.savez(f, **cols)
+        finally:
+            f.close()
+
+        os.rename(tmp, path)
+
+        self.evict()
+
+    #-------------------------------------------------------------------------------
+    # Remove the least recently used entries until the cache is under max_bytes
+    #
+    def evict(self):
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".npz"):  continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum([size for mtime, size, name in entries])
+
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:  break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+    #-------------------------------------------------------------------------------
+    # Parse a file through the cache:  load the columns when the key matches, otherwise
+    # run obs_seq_parse.read_obs_columns and store the result.  An entry stored without
+    # the copies matrix is parsed again (and replaced) when copies=True.
+    #
+    def read_obs_columns(self, fhead, workers=1, copies=False):
+
+        key  = self.key(fhead.filename)
+        cols = self.load(key)
+
+        if cols is None or (copies and 'copies' not in cols):
+            cols = obs_seq_parse.read_obs_columns(fhead, workers=workers, copies=copies)
+            self.store(key, cols)
+        else:
+            print(" Loaded parsed columns for %s from cache %s" % (fhead.filename, self.path(key)))
+
+        return cols
+
+# End of file
@@ -0,0 +1,162 @@
+# coding: utf-8
+#
+# Out-of-core statistics of a collated file.
+#
+# The rows of the file are cut into chunks of chunk_rows rows (only the row ranges of the
+# selected kinds for files collated with --sort, the row groups that can hold them for
+# Parquet files) and every chunk goes through the same
+# steps as a whole DataFrame - selection of the kinds, dart_qc, threshold and binning - on
+# its own, in a pool of worker processes that each read their chunk from the file.  Only
+# the cell sums (obs_seq_bins) or statistics cubes (obs_seq_cube) of the chunks come back,
+# and they add up to those of the whole file, so memory depends on the chunk size and not
+# on the size of the file.  The results are those of the in-memory path up to the order of
+# the floating point additions.
+#
+
+import re
+from multiprocessing import Pool
+from functools import partial
+
+from obs_seq_load import obs_seq_load, obs_seq_load_open, obs_seq_load_kinds
+from obs_seq_netcdf import obs_seq_nc_offsets, obs_seq_nc_rows
+from obs_seq_parquet import obs_seq_pq_file, obs_seq_pq_attrs, obs_seq_pq_ranges
+from obs_seq_bins import obs_seq_bin_sums, obs_seq_add_sums, obs_seq_2D_from_sums, obs_seq_1D_from_sums
+from obs_seq_cube import obs_seq_cube, obs_seq_cube_merge
+
+# Default number of rows per chunk
+
+chunk_rows = 1000000
+
+# Columns used to build a statistics cube
+
+cube_columns = ['kind', 'anal_min', 'height', 'dart_qc', 'innov', 'value', 'meanHxa', 'sdHxf', 'sdHxa']
+
+#=========================================================================================
+# Row ranges [(start, stop), ...] of at most rows rows covering the obs of the given kinds
+# (None for all kinds)
+#
+def obs_seq_chunk_ranges(filename, kinds=None, rows=chunk_rows):
+
+    if obs_seq_pq_file(filename):
+        numbers = None if kinds is None else obs_seq_load_kinds(obs_seq_pq_attrs(filename), kinds)
+        ranges  = obs_seq_pq_ranges(filename, numbers)
+    else:
+        fnc = obs_seq_load_open(filename)
+
+        try:
+            attrs   = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+            nrows   = len(fnc.dimensions['index'])
+            offsets = obs_seq_nc_offsets(fnc)
+        finally:
+            fnc.close()
+
+        if offsets != None and kinds is not None:
+            ranges = obs_seq_nc_rows(offsets, obs_seq_load_kinds(attrs, kinds))
+        else:
+            ranges = [(0, nrows)]
+
+    chunks = []
+    for start, stop in ranges:
+        for lo in range(start, stop, rows):
+            chunks.append((lo, min(lo + rows, stop)))
+
+    return chunks
+
+#-------------------------------------------------------------------------------
+# Results of function(chunk) for every chunk, in order, from up to workers processes
+#
+def obs_seq_chunk_map(function, chunks, workers=1):
+
+    if workers > 1 and len(chunks) > 1:
+        pool = Pool(min(workers, len(chunks)))
+        try:
+            for result in pool.imap(function, chunks, chunksize=1):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for chunk in chunks:
+            yield function(chunk)
+
+#=========================================================================================
+# Cell sums (obs_seq_bins.obs_seq_bin_sums) of one chunk
+#
+def obs_seq_chunk_bin(chunk, filename, variable, time, height=None, kinds=None, spread='sdHxf', threshold=None,
+                      dart_qc=True):
+
+    columns = ['kind', 'anal_min', 'dart_qc', variable, spread]
+    if height != None:
+        columns.append('height')
+    if threshold != None:
+        columns = columns + re.findall(r"[A-Za-z_]\w*", threshold)
+
+    df = obs_seq_load(filename, columns=columns, kinds=kinds, start=chunk[0], stop=chunk[1])[0]
+
+    return obs_seq_bin_sums(df, variable, time, height, spread=spread, threshold=threshold, dart_qc=dart_qc)
+
+#-------------------------------------------------------------------------------
+# Cell sums of the obs of the given kinds in a collated file, chunk by chunk
+#
+def obs_seq_chunk_sums(filename, variable, time, height=None, kinds=None, spread='sdHxf', threshold=None,
+                       dart_qc=True, rows=chunk_rows, workers=1):
+
+    chunks = obs_seq_chunk_ranges(filename, kinds, rows)
+
+    if len(chunks) == 0:
+        chunks = [(0, 0)]
+
+    task = partial(obs_seq_chunk_bin, filename=filename, variable=variable, time=time, height=height, kinds=kinds,
+                   spread=spread, threshold=threshold, dart_qc=dart_qc)
+
+    sums = None
+    for part in obs_seq_chunk_map(task, chunks, workers):
+        sums = obs_seq_add_sums(sums, part)
+
+    return sums
+
+#-------------------------------------------------------------------------------
+# The plotting dictionaries of obs_seq_bins.obs_seq_2D_stats / obs_seq_1D_stats, chunk by
+# chunk from a collated file
+#
+def obs_seq_chunk_2D_stats(filename, variable, time=None, height=None, kinds=None, threshold=None, dart_qc=True,
+                           statistic="mean", spread='sdHxf', rows=chunk_rows, workers=1):
+
+    sums = obs_seq_chunk_sums(filename, variable, time, height, kinds=kinds, spread=spread, threshold=threshold,
+                              dart_qc=dart_qc, rows=rows, workers=workers)
+
+    return obs_seq_2D_from_sums(sums, statistic)
+
+def obs_seq_chunk_1D_stats(filename, variable, time=None, kinds=None, threshold=None, dart_qc=True, spread='sdHxa',
+                           rows=chunk_rows, workers=1):
+
+    sums = obs_seq_chunk_sums(filename, variable, time, kinds=kinds, spread=spread, threshold=threshold,
+                              dart_qc=dart_qc, rows=rows, workers=workers)
+
+    return obs_seq_1D_from_sums(sums)
+
+#=========================================================================================
+# Statistics cube of all the obs of a collated file, chunk by chunk
+#
+def obs_seq_chunk_cube_of(chunk, filename, dart_qc=True):
+
+    df = obs_seq_load(filename, columns=cube_columns, start=chunk[0], stop=chunk[1])[0]
+
+    return obs_seq_cube(df, dart_qc=dart_qc)
+
+def obs_seq_chunk_cube(filename, dart_qc=True, rows=chunk_rows, workers=1):
+
+    chunks = obs_seq_chunk_ranges(filename, None, rows)
+
+    if len(chunks) == 0:
+        chunks = [(0, 0)]
+
+    task = partial(obs_seq_chunk_cube_of, filename=filename, dart_qc=dart_qc)
+
+    cube = None
+    for part in obs_seq_chunk_map(task, chunks, workers):
+        cube = obs_seq_cube_merge(cube, part)
+
+    return cube
+
+# End of file
@@ -6,16 +6,35 @@ import numpy as np
 from netcdftime import utime
 import matplotlib.pyplot as plt
 import sys, os, glob
+import json
 import time
 import datetime as dtime
+from functools import partial
+from multiprocessing import Pool
 from optparse import OptionParser
 import xarray as xr
 import netCDF4 as ncdf
 
+import obs_seq_parse
+import obs_seq_binary
+from obs_seq_cache import ParseCache
+from obs_seq_netcdf import obs_seq_nc_create, obs_seq_nc_open_append, obs_seq_nc_append, obs_seq_nc_sort
+from obs_seq_netcdf import obs_seq_nc_write_stats, obs_seq_nc_stats, obs_seq_copy_columns
+from obs_seq_cube import obs_seq_cube_add, obs_seq_cube_check
+from obs_seq_load import obs_seq_load, obs_seq_load_attrs
+from obs_seq_parquet import obs_seq_pq_write, group_rows
+from obs_seq_store import obs_seq_store_add
+
 time_format = "%Y-%m-%d_%H:%M:%S"
 day_utime   = utime("days since 1601-01-01 00:00:00")
 sec_utime   = utime("seconds since 1970-01-01 00:00:00")
 
+# Version of the collated obs layout (recorded in the manifest, so incremental runs do not
+# mix rows written by an older layout).  2:  utime is integer seconds since 1970, date and
+# anal_time are datetime64[s] rather than strings.
+
+schema_version = 2
+
 #-------------------------------------------------------------------------------
 # We have a double precision scientific string which I can only read this way
 #
@@ -87,12 +106,15 @@ def obs_seq_file_dtime(filename):
 #                              ('satellite',           '(3,)f8')] )
 
 #=========================================================================================
-# Defines the data frame for each observation type
+# Defines the data frame for each observation type.  copies=True adds the (num_copies,)
+# float32 "copies" field holding all the copies of each ob (obs_seq_collate --copies).
+# The arrays start zeroed, so fields a reader does not fill are never left uninitialized.
 #
-def obs_seq_dict_default(len, num_copies, num_qc):
+def obs_seq_dict_default(len, num_copies, num_qc, copies=False):
         
-    return np.recarray(len, 
-                    dtype = [('name',                'S128'),
+    return np.zeros(len, 
+                    dtype = obs_seq_dict_copies(num_copies, copies) +
+                            [('name',                'S128'),
                              ('kind',                'i4'),
                              ('number',              'i8'),
                              ('value',               'f8'),
@@ -109,18 +131,61 @@ def obs_seq_dict_default(len, num_copies, num_qc):
                              ('error_variance',      'f4'),
                              ('days',                'i8'),
                              ('seconds',             'i8'),
-                             ('utime',               'f8'),          
-                             ('date',                'S128'),
-                             ('anal_time',           'S128'),
+                             ('utime',               'i8'),          
+                             ('date',                'M8[s]'),
+                             ('anal_time',           'M8[s]'),
                              ('anal_min',            'f8'),
                              ('rmsi',                'f8'),
-                             ('innov',               'f8') ] )
+                             ('innov',               'f8') ] ).view(np.recarray)
+
+#=========================================================================================
+# Compact version of the layout above (about 60 bytes per ob instead of ~450):
+#
+#   - kind is a small integer; the kind names live once in the file attributes/header
+#   - copies, spreads, qc and locations are float32 (well within their precision)
+#   - per-file scalars (anal_time, rmsi) are not broadcast into every row; the analysis
+#     time is time_from_1800 (a file attribute) + anal_min, and date is just utime
+#
+def obs_seq_dict_compact(len, num_copies, num_qc, copies=False):
+        
+    return np.zeros(len, 
+                    dtype = obs_seq_dict_copies(num_copies, copies) +
+                            [('kind',                'i2'),
+                             ('number',              'i4'),
+                             ('value',               'f4'),
+                             ('meanHxf',             'f4'),
+                             ('meanHxa',             'f4'),
+                             ('sdHxf',               'f4'),
+                             ('sdHxa',               'f4'),
+                             ('ncep_qc',             'f4'),
+                             ('dart_qc',             'f4'),
+                             ('lat',                 'f4'),
+                             ('lon',                 'f4'),
+                             ('height',              'f4'),
+                             ('vert_coord',          'i2'),
+                             ('error_variance',      'f4'),
+                             ('days',                'i4'),
+                             ('seconds',             'i4'),
+                             ('utime',               'i8'),          
+                             ('anal_min',            'f4'),
+                             ('innov',               'f4') ] ).view(np.recarray)
+
+def obs_seq_dict_copies(num_copies, copies):
+
+    if copies:
+        return [('copies', ("(%d,)" % num_copies)+'f4')]
+    return []
 
 #=========================================================================================
 # Reads the obs_seq file header and sets up the needed information.  Returns a simple object
+# (binary=True for Fortran unformatted files, whose header is read by obs_seq_binary)
 #
 
 def obs_seq_header(file, debug_header=False):
+
+    if obs_seq_binary.obs_seq_binary_order(file) != None:
+        return myobject("obs_head", **obs_seq_binary.obs_seq_binary_header(file))
+
     fi = open(file, 'r')
     fi.readline()                       # Read(str) "obs_sequence"
     fi.readline()                       # Read(str) "obs_kind_definitions"
@@ -187,16 +252,74 @@ def obs_seq_header(file, debug_header=False):
                                 max_num_obs   = max_num_obs,
                                 first         = first,
                                 last          = last,
-                                ob_offset     = num_ob_kinds + num_qc + num_copies + 6)
+                                ob_offset     = num_ob_kinds + num_qc + num_copies + 6,
+                                binary        = False)
 
 #=========================================================================================
-# Reads the obs_seq file and returns a Pandas dataframe
+# Fill the default (or compact) recarray from the column dictionary returned by the
+# obs_seq_parse engine (with copies=True, from its "copies" matrix as well)
 #
-def read_obs_seq(fhead, return_DF = False, return_XR = False, time_from_1800=None):
- 
-    begin_time = time.time()
-    
-    print(" \n Reading in obs_sequence file:  %s" % fhead.filename)
+def obs_seq_from_columns(cols, fhead, compact=False, copies=False):
+
+    nobs    = cols['number'].size
+
+    if compact:
+        obs_seq = obs_seq_dict_compact(nobs, fhead.num_copies, fhead.num_qc, copies)
+    else:
+        obs_seq = obs_seq_dict_default(nobs, fhead.num_copies, fhead.num_qc, copies)
+
+    for field in cols.keys():
+        if field in obs_seq.dtype.names:
+            obs_seq[field] = cols[field]
+
+    obs_seq.utime  = obs_seq_parse.obs_seq_utime(cols['days'], cols['seconds'])
+
+    if compact:
+        return obs_seq
+
+    # Kind names through a small lookup table, instead of one dictionary access per ob
+
+    kinds, inverse = np.unique(obs_seq.kind, return_inverse=True)
+    names          = np.array([fhead.obs_type[int(k)] for k in kinds], dtype='S128')
+    obs_seq.name   = names[inverse]
+
+    obs_seq.date   = obs_seq.utime.astype('datetime64[s]')
+
+    return obs_seq
+
+#-------------------------------------------------------------------------------
+# Copy a default recarray into the compact layout
+#
+def obs_seq_compact(obs_seq, fhead):
+
+    compact = obs_seq_dict_compact(obs_seq.size, fhead.num_copies, fhead.num_qc)
+
+    for field in compact.dtype.names:
+        compact[field] = obs_seq[field]
+
+    return compact
+
+#-------------------------------------------------------------------------------
+# DataFrame of a recarray.  The copies matrix, which a DataFrame column cannot hold,
+# becomes the columns copy_0 ... copy_N-1 (obs_seq_netcdf.obs_seq_copy_columns).
+#
+def obs_seq_frame(obs_seq):
+
+    if 'copies' not in obs_seq.dtype.names:
+        return pd.DataFrame.from_records(obs_seq)
+
+    names  = [name for name in obs_seq.dtype.names if name != 'copies']
+    copies = np.asarray(obs_seq['copies'])
+
+    df     = pd.DataFrame(dict((name, obs_seq[name]) for name in names), columns=names)
+    copies = pd.DataFrame(copies, columns=obs_seq_copy_columns(copies.shape[1]))
+
+    return pd.concat([df, copies], axis=1)
+
+#=========================================================================================
+# Original line-by-line reader, kept as the "python" engine for reference and checking
+#
+def read_obs_seq_python(fhead):
     
     f = open(fhead.filename)
     fi = f.readlines()
@@ -212,13 +335,6 @@ def read_obs_seq(fhead, return_DF = False, return_XR = False, time_from_1800=Non
     
     obs_seq = obs_seq_dict_default(fhead.num_obs, fhead.num_copies, fhead.num_qc)
 
-    # If time_after_1800 is a datetime object, compute some useful time measures after 18Z
-    if time_from_1800:
-        anal_dtime           = obs_seq_file_dtime(fhead.filename)
-        diff                 = anal_dtime - time_from_1800
-        obs_seq.anal_time[:] = anal_dtime.strftime(time_format)
-        obs_seq.anal_min[:]  = diff.seconds / 60.
-      
     i = 0
     
     for m, n in enumerate(idx_obs):
@@ -309,11 +425,67 @@ def read_obs_seq(fhead, return_DF = False, return_XR = False, time_from_1800=Non
             
         day              = (float(obs_seq.days[i]) + float(obs_seq.seconds[i])/86400.)
         date             = day_utime.num2date(day)
-        obs_seq.date[i]  = date.strftime(time_format)
         obs_seq.utime[i] = round(sec_utime.date2num(date))
         
         i += 1
 
+    obs_seq.date = obs_seq.utime.astype('datetime64[s]')
+
+    return obs_seq
+
+#=========================================================================================
+# If time_after_1800 is a datetime object, compute some useful time measures after 18Z,
+# otherwise the analysis time is unknown (NaT / NaN)
+#
+def obs_seq_anal_time(obs_seq, fhead, time_from_1800):
+
+    if time_from_1800:
+        anal_dtime           = obs_seq_file_dtime(fhead.filename)
+        diff                 = anal_dtime - time_from_1800
+        if 'anal_time' in obs_seq.dtype.names:
+            obs_seq.anal_time[:] = np.datetime64(anal_dtime, 's')
+        obs_seq.anal_min[:]  = diff.seconds / 60.
+    else:
+        if 'anal_time' in obs_seq.dtype.names:
+            obs_seq.anal_time[:] = np.datetime64('NaT')
+        obs_seq.anal_min[:]  = np.nan
+
+#=========================================================================================
+# Reads the obs_seq file and returns a Pandas dataframe
+#
+#   engine="mmap"   :  vectorized, memory-mapped parser in obs_seq_parse (default)
+#   engine="python" :  the original line-by-line reader
+#
+#   workers > 1 (mmap engine) parses the file in that many OBS-aligned pieces in parallel
+#   cache (mmap engine) is an obs_seq_cache.ParseCache used to skip the text parse
+#   compact=True returns the obs_seq_dict_compact layout (no per-row rmsi)
+#   copies=True (mmap engine) adds the matrix of all the copies (obs_seq_dict_copies)
+#
+def read_obs_seq(fhead, return_DF = False, return_XR = False, time_from_1800=None, engine="mmap", workers=1,
+                 cache=None, compact=False, copies=False):
+ 
+    begin_time = time.time()
+    
+    print(" \n Reading in obs_sequence file:  %s" % fhead.filename)
+
+    # The line-by-line reader only knows the ASCII format and the mapped copies
+
+    if fhead.binary or copies:
+        engine = "mmap"
+    
+    if engine == "mmap" and cache != None:
+        obs_seq = obs_seq_from_columns(cache.read_obs_columns(fhead, workers=workers, copies=copies), fhead,
+                                       compact, copies)
+    elif engine == "mmap":
+        obs_seq = obs_seq_from_columns(obs_seq_parse.read_obs_columns(fhead, workers=workers, copies=copies), fhead,
+                                       compact, copies)
+    elif compact:
+        obs_seq = obs_seq_compact(read_obs_seq_python(fhead), fhead)
+    else:
+        obs_seq = read_obs_seq_python(fhead)
+
+    obs_seq_anal_time(obs_seq, fhead, time_from_1800)
+
     print(" %d observations are now read in from:  %s" % (fhead.num_obs,fhead.filename))
 
     end_time = time.time()
@@ -322,18 +494,537 @@ def read_obs_seq(fhead, return_DF = False, return_XR = False, time_from_1800=Non
 
 # Calculate some handy stuff - like mean innovation (Yb)
     obs_seq.innov = obs_seq.value - obs_seq.meanHxf
-    obs_seq.rmsi  = np.sqrt((obs_seq.innov[:]**2).mean())
+    if not compact:
+        obs_seq.rmsi  = np.sqrt((obs_seq.innov[:]**2).mean())
     
     if return_DF == True:
-        return pd.DataFrame.from_records(obs_seq)
+        return obs_seq_frame(obs_seq)
     
     if return_XR == True:
-        tmp = pd.DataFrame.from_records(obs_seq)
+        tmp = obs_seq_frame(obs_seq)
         return xr.Dataset(tmp, coords = {'index':tmp.number})
 
     else:
         return obs_seq
 
+#=========================================================================================
+# Streaming version of read_obs_seq:  a generator that reads the file incrementally and
+# yields batches of at most batch_size observations, each in the same form read_obs_seq
+# returns (recarray, or DataFrame/xarray with return_DF/return_XR).  Peak memory depends
+# on batch_size, not on the size of the file.
+#
+# rmsi is a per-file quantity, so it is left as NaN on each batch - use the innov column
+# (or obs_seq_fill_rmsi once all the batches of a file are in hand).
+#
+def iter_obs_seq(fhead, batch_size=100000, return_DF = False, return_XR = False, time_from_1800=None,
+                 compact=False, copies=False):
+
+    print(" \n Streaming obs_sequence file:  %s in batches of %d" % (fhead.filename, batch_size))
+
+    for cols in obs_seq_parse.iter_obs_columns(fhead, batch_size=batch_size, copies=copies):
+
+        obs_seq = obs_seq_from_columns(cols, fhead, compact, copies)
+
+        obs_seq_anal_time(obs_seq, fhead, time_from_1800)
+
+        obs_seq.innov = obs_seq.value - obs_seq.meanHxf
+        if not compact:
+            obs_seq.rmsi  = np.nan
+
+        if return_DF == True:
+            yield obs_seq_frame(obs_seq)
+
+        elif return_XR == True:
+            tmp = obs_seq_frame(obs_seq)
+            yield xr.Dataset(tmp, coords = {'index':tmp.number})
+
+        else:
+            yield obs_seq
+
+#-------------------------------------------------------------------------------
+# Set the per-file rmsi on a list of DataFrame batches from one file
+#
+def obs_seq_fill_rmsi(batches):
+
+    if len(batches) == 0 or 'rmsi' not in batches[0]:
+        return batches
+
+    sum_sq = np.sum([(df['innov']**2).sum() for df in batches])
+    count  = np.sum([len(df) for df in batches])
+
+    for df in batches:
+        df['rmsi'] = np.sqrt(sum_sq / count) if count > 0 else np.nan
+
+    return batches
+
+#-------------------------------------------------------------------------------
+# Stream one obs_seq file straight into the open output fnc, batch_size obs at a time, so
+# only one batch is ever held.  The per-file rmsi is written over the file's rows once
+# all its batches are in.  With stats, each batch is added to the statistics cube.
+# Returns (number of obs, kind numbers, cube).
+#
+def obs_seq_stream_file(fnc, file, batch_size, time_from_1800=None, compact=False, stats=False, cube=None,
+                        copies=False):
+
+    first  = len(fnc.dimensions['index'])
+    count  = 0
+    sum_sq = 0.0
+    kinds  = set()
+
+    for df in iter_obs_seq(obs_seq_header(file), batch_size=batch_size, return_DF=True,
+                           time_from_1800=time_from_1800, compact=compact, copies=copies):
+        obs_seq_nc_append(fnc, df)
+        kinds.update(np.unique(df['kind']).tolist())
+        count  = count + len(df)
+        sum_sq = sum_sq + (df['innov']**2).sum()
+        if stats:
+            cube = obs_seq_cube_add(cube, df)
+        del df
+
+    if count > 0 and 'rmsi' in fnc.variables:
+        fnc.variables['rmsi'][first:first+count] = np.sqrt(sum_sq / count)
+
+    return count, kinds, cube
+
+#=========================================================================================
+# Read one obs_seq file into a DataFrame (whole, split over "split" processes, or streamed
+# in batches).  Returns the header with it - this is the unit of work handed to each
+# process by main --workers.  With a parse cache the file is read whole through the cache.
+#
+def obs_seq_read_file(file, time_from_1800=None, batch_size=None, split=1, cache=None, compact=False,
+                      copies=False):
+
+    file_header = obs_seq_header(file)
+
+    if batch_size and cache == None:
+        batches = iter_obs_seq(file_header, batch_size=batch_size, return_DF=True, time_from_1800=time_from_1800,
+                               compact=compact, copies=copies)
+        df      = pd.concat(obs_seq_fill_rmsi(list(batches)), ignore_index=True)
+    else:
+        df      = read_obs_seq(file_header, return_DF=True, time_from_1800=time_from_1800, workers=split,
+                               cache=cache, compact=compact, copies=copies)
+
+    return file_header, df
+
+#-------------------------------------------------------------------------------
+# Read a list of files, in parallel over a process pool when workers > 1.  Results are
+# yielded as they become available, in the same order as the files list.  Pool processes
+# cannot start pools of their own, so splitting single files (split > 1) is only used
+# when files are read serially.
+#
+def iter_obs_seq_files(files, time_from_1800=None, batch_size=None, workers=1, split=1, cache=None,
+                       compact=False, copies=False):
+
+    if workers > 1 and len(files) > 1:
+        split = 1
+
+    reader = partial(obs_seq_read_file, time_from_1800=time_from_1800, batch_size=batch_size, split=split,
+                     cache=cache, compact=compact, copies=copies)
+
+    if workers > 1 and len(files) > 1:
+        pool = Pool(min(workers, len(files)))
+        try:
+            for result in pool.imap(reader, files, chunksize=1):
+                yield result
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for file in files:
+            yield reader(file)
+
+def obs_seq_read_files(files, **kwargs):
+    return list(iter_obs_seq_files(files, **kwargs))
+
+#=========================================================================================
+# Processed-file manifest kept beside the collated netCDF file.  It records, for each
+# obs_seq file in the output (in row order), its path, size, mtime and number of obs, plus
+# the time used for anal_min, so an incremental run can tell which files are new/changed.
+#
+def obs_seq_manifest_name(netcdf_file):
+    return netcdf_file + ".manifest"
+
+def obs_seq_file_stat(file):
+    stat = os.stat(file)
+    return {'path': file, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+def read_obs_seq_manifest(netcdf_file):
+
+    try:
+        f = open(obs_seq_manifest_name(netcdf_file), 'r')
+        manifest = json.load(f)
+        f.close()
+        return manifest
+    except (IOError, ValueError):
+        return None
+
+def write_obs_seq_manifest(netcdf_file, time_from_1800, files, nobs, compact=False, sort=False, copies=False):
+
+    entries = []
+    for file, n in zip(files, nobs):
+        entry = obs_seq_file_stat(file)
+        entry['nobs'] = int(n)
+        entries.append(entry)
+
+    f = open(obs_seq_manifest_name(netcdf_file), 'w')
+    json.dump({'schema':         schema_version,
+               'compact':        compact,
+               'copies':         copies,
+               'sorted':         sort,
+               'time_from_1800': time_from_1800.strftime(time_format), 
+               'files':          entries}, f, indent=1)
+    f.close()
+
+#-------------------------------------------------------------------------------
+# Rows of an existing collated file that can be reused for an incremental run.  Returns
+# a dictionary {file: (start, stop)} of row ranges for every file whose size and mtime are
+# unchanged since it was collated; new or changed files are absent and have to be parsed.
+# The ranges are in collation order (the "collate_row" variable of a sorted file).
+#
+def obs_seq_reuse_rows(netcdf_file, files, time_from_1800, compact=False, copies=False):
+
+    manifest = read_obs_seq_manifest(netcdf_file)
+
+    if manifest == None or not os.path.exists(netcdf_file):
+        return {}
+
+    if manifest.get('schema', 1) != schema_version or manifest.get('compact', False) != compact:
+        return {}
+
+    if manifest.get('copies', False) != copies:
+        return {}
+
+    # anal_min is measured from the first file, so if that moved nothing can be reused
+
+    if manifest['time_from_1800'] != time_from_1800.strftime(time_format):
+        return {}
+
+    reuse  = {}
+    start  = 0
+
+    for entry in manifest['files']:
+        stop = start + entry['nobs']
+        if entry['path'] in files and os.path.exists(entry['path']):
+            stat = obs_seq_file_stat(entry['path'])
+            if stat['size'] == entry['size'] and stat['mtime'] == entry['mtime']:
+                reuse[entry['path']] = (start, stop)
+        start = stop
+
+    return reuse
+
+#-------------------------------------------------------------------------------
+# Number of leading files that are already in the output, unchanged and in order - when
+# every previously collated file is reused like this, the new files can simply be appended
+# (never to a sorted file, which has to be sorted again)
+#
+def obs_seq_append_point(reuse, files, netcdf_file):
+
+    manifest = read_obs_seq_manifest(netcdf_file)
+    nkeep    = 0
+    rows     = 0
+
+    for file in files:
+        if file not in reuse or reuse[file][0] != rows:  break
+        rows   = reuse[file][1]
+        nkeep += 1
+
+    if manifest == None or manifest.get('sorted', False) or nkeep != len(manifest['files']):
+        return 0
+
+    return nkeep
+
+#-------------------------------------------------------------------------------
+# Rows start:stop (in collation order) of an existing collated file as a DataFrame.
+# old_row is the collate_row column of a sorted file, or None for a file in file order.
+# The copies matrix is returned as its copy_* columns.
+#
+def obs_seq_old_rows(old_file, start, stop, old_row=None):
+
+    if old_row is None:
+        rows = slice(start, stop)
+    else:
+        rows = np.nonzero((old_row >= start) & (old_row < stop))[0]
+        rows = rows[np.argsort(old_row[rows], kind='mergesort')]
+
+    old = old_file.isel(index=rows)
+
+    if 'copies' not in old.variables:
+        return old.to_dataframe()
+
+    df     = old[[name for name in old.data_vars if name != 'copies']].to_dataframe()
+    copies = old['copies'].values
+
+    return pd.concat([df, pd.DataFrame(copies, index=df.index, columns=obs_seq_copy_columns(copies.shape[1]))],
+                     axis=1)
+
+#=========================================================================================
+# Global attributes of the collated file:  one attribute per kind (name -> kind number),
+# plus the creation time, the anal_min origin and the layout (and, with copies, the
+# names of the copies, one per line, in the order of the copy dimension)
+#
+def obs_seq_nc_attrs(file_header0, time_stamp, compact=False, copies=False):
+
+    attrs = {'history':        "Created " + dtime.datetime.today().strftime(time_format),
+             'time_from_1800': time_stamp.strftime(time_format)}
+
+    if compact:
+        attrs['layout'] = "compact"
+
+    if copies:
+        attrs['copy_names'] = "\n".join([name.strip() for name in file_header0.copy_names])
+
+    for key in file_header0.obs_type.keys():
+        print(" Writing attribute %s with key %d" % (file_header0.obs_type[key], key))
+        attrs[file_header0.obs_type[key]] = int(key)
+
+    return attrs
+
+#=========================================================================================
+# Obs_seq files matching a wildcard, oldest first (by modification time), leaving out the
+# netCDF output and its manifest/temporary files
+#
+def obs_seq_collate_list(pattern):
+
+    print(pattern)
+    rawlist = glob.glob(pattern)
+    print(rawlist)
+        
+    files = sorted( rawlist, key = lambda file: os.path.getmtime(file))
+        
+    print("\n Obs_seq.final files sorted by modification time\n")
+    for file in files:
+        print(" {} - {}".format(file, time.ctime(os.path.getmtime(file))) )
+        
+    # Fix in case we picked up some none obs_seq files (netCDF output, manifests)
+    for file in files:
+         if file.find(".nc") != -1:  
+             print("\n Removing file:  %s from list" % file)
+
+    return [file for file in files if file.find(".nc") == -1]
+
+#-------------------------------------------------------------------------------
+# Name of the collated file of a list of obs_seq files:  the first file's name without
+# its extension, or prefix.YYYYMMDD.nc
+#
+def obs_seq_netcdf_name(files, fprefix=None):
+
+    if fprefix == None:
+        return os.path.split(files[0])[1][:-4]+".nc"
+    else:
+        return ("%s.%s" % (fprefix, os.path.split(files[0])[1][-12:-4]+".nc"))
+
+#=========================================================================================
+# Collate a list of obs_seq files (oldest first) into netcdf_file.  With incremental=True
+# only new or changed files are parsed, and when the files already in the output are
+# unchanged the new ones are appended to it.  Returns the kind numbers found in the files
+# that were parsed, so callers know which products changed.  With parquet=True a columnar
+# copy is written next to it (obs_seq_collate_parquet), and with store the day's
+# partitions of that partitioned store are (re)written (obs_seq_store).  With copies=True
+# all the copies of every ob are kept, as the copies(index, copy) matrix.
+#
+def obs_seq_collate_files(files, netcdf_file, incremental=False, compact=False, pack=False, sort=False,
+                          stats=False, batch=None, workers=1, split=1, cache=None, parquet=False, store=None,
+                          copies=False):
+
+    begin_time = time.time()
+    
+    time_stamp = obs_seq_file_dtime(files[0])
+    
+    # Headers are cheap to read:  the file with the most kinds provides the kind attributes
+
+    num_obs_kinds = -1
+    
+    for file in files:
+        file_header = obs_seq_header(file)
+        if file_header.num_obs_kinds > num_obs_kinds:
+            num_obs_kinds = file_header.num_obs_kinds
+            file_header0 = file_header
+            
+    print("\n Found %d kinds of observations" % num_obs_kinds)
+
+    # The copies matrix has one column per copy, so every file must have the same copies
+    # (ASCII headers keep the newline of each name, binary ones do not).  When they do not,
+    # the day is collated without the copies.
+
+    if copies:
+        copy_names0 = [name.strip() for name in file_header0.copy_names]
+        for file in files:
+            if [name.strip() for name in obs_seq_header(file).copy_names] != copy_names0:
+                print("\n Dart_cc:  %s does not have the copies of %s, collating without the copies....\n" %
+                      (file, file_header0.filename))
+                copies = False
+                break
+
+    attrs = obs_seq_nc_attrs(file_header0, time_stamp, compact=compact, copies=copies)
+
+    if compact:
+        layout = obs_seq_dict_compact(0, file_header0.num_copies, 0, copies).dtype
+    else:
+        layout = obs_seq_dict_default(0, file_header0.num_copies, 0, copies).dtype
+
+    # Incremental mode:  reuse the rows of unchanged files from the existing output.  When
+    # all of the previous output is reused as is, open it and just append the new files.
+
+    reuse = {}
+    nkeep = 0
+    fnc   = None
+
+    if incremental:
+        reuse = obs_seq_reuse_rows(netcdf_file, files, time_stamp, compact=compact, copies=copies)
+        if not sort:
+            nkeep = obs_seq_append_point(reuse, files, netcdf_file)
+        if nkeep > 0:
+            fnc = obs_seq_nc_open_append(netcdf_file)
+
+        # Rows appended by a run that failed part way are not in the manifest:  rewrite
+
+        if fnc != None and len(fnc.dimensions['index']) != reuse[files[nkeep-1]][1]:
+            fnc.close()
+            fnc = None
+
+    # The statistics cube of the rows kept in place comes from the existing file, so it
+    # can only be appended to when it has one (of the current layout) exactly when one is
+    # asked for
+
+    cube = None
+
+    if fnc != None and stats:
+        cube = obs_seq_cube_check(obs_seq_nc_stats(fnc))
+
+    if fnc != None and (('stats' in fnc.groups) != stats or (stats and cube is None)):
+        fnc.close()
+        fnc  = None
+        cube = None
+
+    if fnc != None:
+        print("\n Dart_cc:  Appending %d new files to %s" % (len(files) - nkeep, netcdf_file))
+        attrs['history'] = fnc.history + "\n" + attrs['history'].replace("Created", "Appended")
+        for key in attrs.keys():
+            fnc.setncattr(key, attrs[key])
+        old_file, old_row, out_file = None, None, netcdf_file
+    else:
+        nkeep    = 0
+        out_file = netcdf_file + ".tmp"
+        fnc      = obs_seq_nc_create(out_file, layout, attrs, pack=pack)
+        old_file = None
+        old_row  = None
+        if len(reuse) > 0:
+            old_file = xr.open_dataset(netcdf_file)
+            if 'collate_row' in old_file.variables:
+                old_row = old_file['collate_row'].values
+
+    todo = [file for file in files[nkeep:] if file not in reuse]
+
+    print("\n Dart_cc:  Reusing %d files, parsing %d new or changed files" % (len(files) - len(todo), len(todo)))
+
+    # Stream every file into the output in order:  only one file's obs are held at a time,
+    # or only one batch of them when files are read one after the other in batches
+
+    stream = batch and workers <= 1 and cache == None
+
+    if not stream:
+        parsed = iter_obs_seq_files(todo, time_from_1800=time_stamp, 
+                                    batch_size=batch, workers=workers,
+                                    split=split, cache=cache, compact=compact, copies=copies)
+
+    nobs  = [reuse[file][1] - reuse[file][0] for file in files[:nkeep]]
+    kinds = set()
+
+    # A file that cannot be read (e.g. a truncated one) stops the run:  the output is
+    # closed, and a partly written new file removed, before the error is passed on
+
+    try:
+        for file in files[nkeep:]:
+            if file in reuse:
+                start, stop = reuse[file]
+                df = obs_seq_old_rows(old_file, start, stop, old_row)
+            elif stream:
+                count, file_kinds, cube = obs_seq_stream_file(fnc, file, batch, time_from_1800=time_stamp,
+                                                              compact=compact, stats=stats, cube=cube,
+                                                              copies=copies)
+                kinds.update(file_kinds)
+                nobs.append(count)
+                continue
+            else:
+                file_header, df = next(parsed)
+                kinds.update(np.unique(df['kind']).tolist())
+            obs_seq_nc_append(fnc, df)
+            nobs.append(len(df))
+            if stats:
+                cube = obs_seq_cube_add(cube, df)
+            del df
+    except Exception:
+        fnc.close()
+        if old_file != None:
+            old_file.close()
+        if out_file != netcdf_file and os.path.exists(out_file):
+            os.remove(out_file)
+        raise
+
+    fnc.sync()  
+    fnc.close()
+
+    if old_file != None:
+        old_file.close()
+
+    if sort:
+        print("\n Dart_cc:  Sorting %s by kind and analysis time" % netcdf_file)
+        obs_seq_nc_sort(out_file, netcdf_file + ".sort.tmp")
+        os.remove(out_file)
+        out_file = netcdf_file + ".sort.tmp"
+
+    if stats and cube != None:
+        fnc = ncdf.Dataset(out_file, mode='a')
+        obs_seq_nc_write_stats(fnc, cube)
+        fnc.close()
+
+    if out_file != netcdf_file:
+        os.rename(out_file, netcdf_file)
+
+    write_obs_seq_manifest(netcdf_file, time_stamp, files, nobs, compact=compact, sort=sort, copies=copies)
+
+    if parquet:
+        obs_seq_collate_parquet(netcdf_file)
+
+    if store != None:
+        if not os.path.isdir(store):
+            os.makedirs(store)
+        obs_seq_store_add(store, netcdf_file)
+
+    end_time = time.time()
+    
+    print("\n Collating took {0} seconds since the loop started \n".format(end_time - begin_time))
+
+    return sorted(kinds)
+    
+#-------------------------------------------------------------------------------
+# Columnar copy of a collated file (obs_seq_parquet), by default the same name ending in
+# .parquet:  the kinds are read from the netCDF file one at a time (contiguous reads for
+# files collated with --sort), sorted by analysis time and written in row groups of at
+# most rows rows.  Returns the Parquet file name.
+#
+def obs_seq_collate_parquet(netcdf_file, parquet_file=None, rows=group_rows):
+
+    if parquet_file == None:
+        parquet_file = os.path.splitext(netcdf_file)[0] + ".parquet"
+
+    attrs = obs_seq_load_attrs(netcdf_file)
+    kinds = np.unique(obs_seq_load(netcdf_file, columns=['kind'])[0]['kind'].values)
+
+    def frames():
+        if len(kinds) == 0:
+            yield obs_seq_load(netcdf_file)[0]
+        for kind in kinds:
+            df = obs_seq_load(netcdf_file, kinds=[int(kind)])[0]
+            yield df.iloc[np.argsort(df['anal_min'].values, kind='mergesort')]
+
+    nrows = obs_seq_pq_write(parquet_file + ".tmp", frames(), attrs, rows=rows)
+    os.rename(parquet_file + ".tmp", parquet_file)
+
+    print("\n Dart_cc:  %d obs written to %s" % (nrows, parquet_file))
+
+    return parquet_file
+
 #=========================================================================================
 # Write out obs_seq files to netCDF for faster inspection
 #-------------------------------------------------------------------------------
@@ -356,6 +1047,44 @@ def main(argv=None):
     parser.add_option("-p", "--prefix", dest="fprefix",  default=None, type="string",
                        help = "Preappend this string to the netcdf object filename")
 
+    parser.add_option("-b", "--batch", dest="batch",  default=None, type="int",
+                       help = "Stream each obs_seq file in batches of this many obs (bounded memory)")
+
+    parser.add_option("-w", "--workers", dest="workers",  default=1, type="int",
+                       help = "Number of processes used to read the obs_seq files in parallel")
+
+    parser.add_option("-s", "--split", dest="split",  default=1, type="int",
+                       help = "Split each obs_seq file into this many pieces parsed in parallel")
+
+    parser.add_option("-i", "--incremental", dest="incremental",  default=False, action="store_true",
+                       help = "Only parse obs_seq files that are new or changed since the last run")
+
+    parser.add_option("-c", "--cache", dest="cache",  default=None, type="string",
+                       help = "Directory of the parsed-file cache (keyed by file contents), default is no cache")
+
+    parser.add_option(      "--cache_size", dest="cache_size",  default=20., type="float",
+                       help = "Maximum size of the parsed-file cache in GB, default is 20")
+
+    parser.add_option(      "--compact", dest="compact",  default=False, action="store_true",
+                       help = "Write the compact layout (integer kinds, float32 values, no per-row strings)")
+
+    parser.add_option(      "--pack", dest="pack",  default=False, action="store_true",
+                       help = "Pack innov and spread fields into int16 (scale 0.01) in the netCDF file")
+
+    parser.add_option(      "--sort", dest="sort",  default=False, action="store_true",
+                       help = "Sort the rows by kind and anal_min and write a kind/time offset index")
+
+    parser.add_option(      "--stats", dest="stats",  default=False, action="store_true",
+                       help = "Also write the kind x analysis time x height statistics cube used by the plots")
+
+    parser.add_option(      "--parquet", dest="parquet",  default=False, action="store_true",
+                       help = "Also write a columnar Parquet copy (row groups by kind and time, needs pyarrow)")
+
+    parser.add_option(      "--store", dest="store",  default=None, type="string",
+                       help = "Also add the day to this date/kind partitioned store (see obs_seq_store)")
+
+    parser.add_option(      "--copies", dest="copies",  default=False, action="store_true",
+                       help = "Also keep every copy of every ob (ensemble members, ...) as a float32 ob x copy matrix")
                        
     (options, args) = parser.parse_args()
     
@@ -368,83 +1097,30 @@ def main(argv=None):
 
     else:
 
-        suffix = options.file
-        print "%s/%s" % (os.path.abspath(options.dir), suffix)
-        rawlist = glob.glob("%s/%s" % (os.path.abspath(options.dir), suffix))
-        print rawlist
-        
-        files = sorted( rawlist, key = lambda file: os.path.getmtime(file))
-        
-        print("\n Obs_seq.final files sorted by modification time\n")
-        for file in files:
-            print(" {} - {}".format(file, time.ctime(os.path.getmtime(file))) )
-        
-        # Fix in case we picked up some none obs_seq files
-        for n, file in enumerate(files):
-             if file.find(".nc") != -1:  
-                 print("\n Removing file:  %s from list" % file)
-                 del files[n]
-    
+        files = obs_seq_collate_list("%s/%s" % (os.path.abspath(options.dir), options.file))
+
+        if len(files) == 0:
+            print("\n Dart_cc:  no obs_seq files found in %s, EXITING....\n" % options.dir)
+            sys.exit(1)
+
         print("\n Dart_cc:  Processing %d files in the directory:  %s" % (len(files), options.dir))
         print(" Dart_cc:  First file is %s" % (files[0]))
         print(" Dart_cc:  Last  file is %s" % (files[-1]))
         
-        if options.fprefix == None:
-            netcdf_file = os.path.split(files[0])[1][:-4]+".nc"
-        else:
-            netcdf_file = ("%s.%s" % (options.fprefix, os.path.split(files[0])[1][-12:-4]+".nc"))
+        netcdf_file = obs_seq_netcdf_name(files, options.fprefix)
 
         print("\n Dart_cc:  netCDF4 file to be written is %s\n" % (netcdf_file))
-                
-    dataset = []
 
-    begin_time = time.time()
-    
-    time_stamp = obs_seq_file_dtime(files[0])
-    
-    num_obs_kinds = -1
-    
-    for file in files:
-        file_header = obs_seq_header(file)
-        dataset.append(read_obs_seq(file_header, return_DF=True, time_from_1800=time_stamp))
-        if file_header.num_obs_kinds > num_obs_kinds:
-            num_obs_kinds = file_header.num_obs_kinds
-            file_header0 = file_header
-            
-    print("\n Found %d kinds of observations" % num_obs_kinds)
-            
-    end_time = time.time()
-    
-    print("\n Reading took {0} seconds since the loop started \n".format(end_time - begin_time))
+    if options.cache != None:
+        cache = ParseCache(options.cache, max_bytes=int(options.cache_size * 1024**3))
+    else:
+        cache = None
 
-    # Concat the obs_seq files together
-    
-    a = pd.concat(dataset, ignore_index=True)
-    
-    # Create an xarray dataset for file I/O
-    xa = xr.Dataset(a)
-    
-    # reset index to be a master index across all obs
-    xa.rename({'dim_0': 'index'}, inplace=True)
-    
-    # Write the xarray file out (this is all there is, very nice guys!)
-    xa.to_netcdf(netcdf_file, mode='w')
-    xa.close()
-    
-#   Add attributes to the files
+    obs_seq_collate_files(files, netcdf_file, incremental=options.incremental, compact=options.compact,
+                          pack=options.pack, sort=options.sort, stats=options.stats, batch=options.batch,
+                          workers=options.workers, split=options.split, cache=cache, parquet=options.parquet,
+                          store=options.store, copies=options.copies)
     
-    fnc = ncdf.Dataset(netcdf_file, mode = 'a')
-    fnc.history = "Created " + dtime.datetime.today().strftime(time_format)
-    
-    for key in file_header0.obs_type.keys():
-        print(" Writing attribute %s with key %d" % (file_header0.obs_type[key], key))
-        fnc.setncattr(file_header0.obs_type[key],int(key))  
-        
-    fnc.sync()  
-    fnc.close()
-    
-    
-
 #-------------------------------------------------------------------------------
 # Main program for testing...
 #
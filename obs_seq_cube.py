@@ -0,0 +1,314 @@
+# coding: utf-8
+#
+# Statistics cube of a collated day:  kind x analysis time x height level.
+#
+# Each cell holds running statistics of the prior and posterior innovations and spreads of
+# the assimilated obs (dart_qc < 0.1):  for every field its number of values, mean and sum
+# of squared deviations from the mean (M2, as in Welford's algorithm), plus the number of
+# non-zero values.  Cubes of different files, cycles or days merge exactly with the pairwise
+# update of Chan et al., so obs_seq_collate --stats builds one in the same pass that writes
+# the obs (a new cycle only costs its own obs), and the plotting scripts turn it into their
+# time-height and time series statistics without reading any obs.  Any window of analysis
+# times and any union of levels is exact, because anal_min is the same for every obs of a
+# cycle.
+#
+
+import numpy as np
+
+from obs_seq_bins import obs_seq_query_bins, obs_seq_bin_pairs, obs_seq_bin_mean
+from obs_seq_bins import obs_seq_2D_from_sums, obs_seq_1D_from_sums
+
+# Height levels (m) are (edge[l], edge[l+1]], the last level holds every other height
+
+cube_height_edges = np.arange(0., 10001., 1000.)
+
+# Fields accumulated (innov_a is the posterior innovation, value - meanHxa) and the
+# statistics kept for each
+
+cube_fields = ['innov', 'innov_a', 'sdHxf', 'sdHxa']
+
+cube_stats = ['n', 'mean', 'm2', 'nz']
+
+#=========================================================================================
+# Cube of the obs in a DataFrame (or recarray) of the collated layout
+#
+def obs_seq_cube(df, dart_qc=True):
+
+    kind     = np.asarray(df['kind'])
+    anal_min = np.asarray(df['anal_min'], dtype=np.float64)
+    height   = np.asarray(df['height'], dtype=np.float64)
+
+    values = {'innov':   np.asarray(df['innov'], dtype=np.float64),
+              'innov_a': np.asarray(df['value'], dtype=np.float64) - np.asarray(df['meanHxa'], dtype=np.float64),
+              'sdHxf':   np.asarray(df['sdHxf'], dtype=np.float64),
+              'sdHxa':   np.asarray(df['sdHxa'], dtype=np.float64)}
+
+    keep = ~np.isnan(anal_min)
+    if dart_qc:
+        keep &= np.asarray(df['dart_qc']) < 0.1
+
+    kinds, kidx = np.unique(kind[keep], return_inverse=True)
+    times, tidx = np.unique(anal_min[keep], return_inverse=True)
+    nlev        = len(cube_height_edges)
+
+    level = np.searchsorted(cube_height_edges, height[keep], side='left') - 1
+    level[(level < 0) | (level >= nlev - 1)] = nlev - 1
+
+    cell  = (kidx.ravel() * len(times) + tidx.ravel()) * nlev + level
+    shape = (len(kinds), len(times), nlev)
+    cube  = obs_seq_cube_empty(kinds, times)
+
+    for field in cube_fields:
+
+        x  = values[field][keep]
+        ok = ~np.isnan(x)
+
+        # Two passes over the obs:  the cell means, then the squared deviations from them
+
+        n    = np.bincount(cell, weights=ok.astype(np.float64), minlength=np.prod(shape))
+        mean = obs_seq_bin_mean(np.bincount(cell, weights=np.where(ok, x, 0.0), minlength=np.prod(shape)), n)
+        dev  = np.where(ok, x - mean[cell], 0.0)
+
+        cube[field + '_n']    = n.reshape(shape)
+        cube[field + '_mean'] = np.where(n > 0, mean, 0.0).reshape(shape)
+        cube[field + '_m2']   = np.bincount(cell, weights=dev*dev, minlength=np.prod(shape)).reshape(shape)
+        cube[field + '_nz']   = np.bincount(cell, weights=(x != 0.0).astype(np.float64), minlength=np.prod(shape)).reshape(shape)
+
+    return cube
+
+#-------------------------------------------------------------------------------
+# A cube with no obs for the given kinds and analysis times
+#
+def obs_seq_cube_empty(kinds, times):
+
+    nlev = len(cube_height_edges)
+    cube = {'kind':      np.asarray(kinds, dtype=np.int32),
+            'anal_min':  np.asarray(times, dtype=np.float64),
+            'height_lo': np.append(cube_height_edges[:-1], np.nan),
+            'height_hi': np.append(cube_height_edges[1:], np.nan)}
+
+    for field in cube_fields:
+        for stat in cube_stats:
+            cube["%s_%s" % (field, stat)] = np.zeros((len(kinds), len(times), nlev))
+
+    return cube
+
+#-------------------------------------------------------------------------------
+# Merge of two cubes (either can be None):  the statistics of the union of their obs
+#
+def obs_seq_cube_merge(a, b):
+
+    if a is None:  return b
+    if b is None:  return a
+
+    kinds = np.union1d(a['kind'], b['kind'])
+    times = np.union1d(a['anal_min'], b['anal_min'])
+    cube  = obs_seq_cube_empty(kinds, times)
+
+    for part in [a, b]:
+        cell = np.ix_(np.searchsorted(kinds, part['kind']), np.searchsorted(times, part['anal_min']))
+        for field in cube_fields:
+            n, mean, m2 = obs_seq_cube_combine(cube[field + '_n'][cell], cube[field + '_mean'][cell],
+                                               cube[field + '_m2'][cell], part[field + '_n'],
+                                               part[field + '_mean'], part[field + '_m2'])
+            cube[field + '_n'][cell]    = n
+            cube[field + '_mean'][cell] = mean
+            cube[field + '_m2'][cell]   = m2
+            cube[field + '_nz'][cell]  += part[field + '_nz']
+
+    return cube
+
+#-------------------------------------------------------------------------------
+# The cube with the obs of a DataFrame folded in (cube can be None)
+#
+def obs_seq_cube_add(cube, df, dart_qc=True):
+
+    return obs_seq_cube_merge(cube, obs_seq_cube(df, dart_qc=dart_qc))
+
+#-------------------------------------------------------------------------------
+# The cube with its kinds renumbered (numbers[i] is the new number of cube['kind'][i]) and
+# its analysis times moved by shift minutes, so cubes of files with different kind
+# numbers or time origins can be merged
+#
+def obs_seq_cube_align(cube, numbers, shift=0.0):
+
+    order   = np.argsort(numbers, kind='mergesort')
+    aligned = {}
+
+    for name, data in cube.items():
+        if data.ndim == 3:
+            aligned[name] = data[order]
+        else:
+            aligned[name] = data
+
+    aligned['kind']     = np.asarray(numbers, dtype=np.int32)[order]
+    aligned['anal_min'] = cube['anal_min'] + shift
+
+    return aligned
+
+#-------------------------------------------------------------------------------
+# Pairwise update of (count, mean, M2) arrays:  the statistics of two sets of values
+# from those of each set
+#
+def obs_seq_cube_combine(na, meana, m2a, nb, meanb, m2b):
+
+    n     = na + nb
+    delta = meanb - meana
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wb = np.where(n > 0, nb / np.where(n > 0, n, 1.0), 0.0)
+
+    return n, meana + delta*wb, m2a + m2b + delta*delta*na*wb
+
+#-------------------------------------------------------------------------------
+# The cube when it has the statistics of this layout, otherwise None (a cube written
+# before the layout changed cannot be merged with a new one, and is recomputed)
+#
+def obs_seq_cube_check(cube):
+
+    if cube is None:
+        return None
+
+    for field in cube_fields:
+        for stat in cube_stats:
+            if "%s_%s" % (field, stat) not in cube:
+                return None
+
+    return cube
+
+#-------------------------------------------------------------------------------
+# Number of values, sum and sum of squares of a field in every cell of the cube, which
+# (unlike the means) add over cells
+#
+def obs_seq_cube_sums_of(cube, field):
+
+    n    = cube[field + '_n']
+    mean = cube[field + '_mean']
+
+    return n, n*mean, cube[field + '_m2'] + n*mean*mean
+
+#-------------------------------------------------------------------------------
+# (count, mean, M2) of a field for the selected kinds, summed over the cube axes that are
+# not kept (axes:  the axis numbers to sum over)
+#
+def obs_seq_cube_pool(cube, field, k, axes):
+
+    n    = cube[field + '_n'][k]
+    mean = cube[field + '_mean'][k]
+    m2   = cube[field + '_m2'][k]
+
+    total = n.sum(axis=axes, keepdims=True)
+    pool  = obs_seq_bin_mean((n*mean).sum(axis=axes, keepdims=True), total)
+    dev   = np.where(n > 0, mean - np.where(np.isnan(pool), 0.0, pool), 0.0)
+
+    m2 = (m2 + n*dev*dev).sum(axis=axes)
+
+    return total.reshape(m2.shape), pool.reshape(m2.shape), m2
+
+#=========================================================================================
+# Sums of variable and spread over the kinds, for each (height bin, time bin), in the
+# form of obs_seq_bins.obs_seq_bin_sums.  Bins are used with the plotting scripts' query
+# semantics.  Returns None when a height bin cuts through a cube level, in which case the
+# statistics have to come from the obs.
+#
+def obs_seq_cube_sums(cube, variable, time, height=None, kinds=None, spread='sdHxf'):
+
+    time_q, height_q = obs_seq_query_bins(time, height)
+
+    if kinds is None:
+        k = np.ones(len(cube['kind']), dtype=bool)
+    else:
+        k = np.isin(cube['kind'], kinds)
+
+    # Time bins x analysis times
+
+    rows, tbin = obs_seq_bin_pairs(cube['anal_min'], time_q)
+    tmat       = np.zeros((len(time), len(cube['anal_min'])))
+    tmat[tbin, rows] = 1.0
+
+    # Height bins x levels
+
+    lo, hi = cube['height_lo'], cube['height_hi']
+    nlev   = len(lo)
+
+    if height == None:
+        zmat = np.ones((1, nlev))
+    else:
+        zmat = np.zeros((len(height), nlev))
+        for m, z in enumerate(height_q):
+            if z[1] <= z[0]:
+                continue
+            if z[0] < lo[0] or z[1] > hi[nlev-2]:
+                return None
+            inside  = (lo[:-1] >= z[0]) & (hi[:-1] <= z[1])
+            overlap = (np.maximum(lo[:-1], z[0]) < np.minimum(hi[:-1], z[1])) & ~inside
+            if overlap.any():  return None
+            zmat[m, :-1] = inside
+
+    def reduce(cells):
+        total = cells[k].sum(axis=0)                   # (time, level)
+        return np.dot(np.dot(zmat, total.T), tmat.T)   # (height bin, time bin)
+
+    n,  x,  xx = obs_seq_cube_sums_of(cube, variable)
+    sn, sx, sxx = obs_seq_cube_sums_of(cube, spread)
+
+    sums = {'count':    reduce(n),
+            'sum':      reduce(x),
+            'sumsq':    reduce(xx),
+            'num_obs':  reduce(cube[variable + '_nz']),
+            'sp_count': reduce(sn),
+            'sp_sum':   reduce(sx),
+            'mins':     np.array([t[0] for t in time])}
+
+    if height != None:
+        sums['hgts'] = np.array([0.5*(z[0]+z[1]) for z in height])
+
+    return sums
+
+#-------------------------------------------------------------------------------
+# The plotting dictionaries of obs_seq_bins.obs_seq_2D_stats / obs_seq_1D_stats computed
+# from the cube (None when the height bins do not line up with the cube levels)
+#
+def obs_seq_cube_2D_stats(cube, variable, time=None, height=None, kinds=None, statistic="mean", spread='sdHxf'):
+
+    sums = obs_seq_cube_sums(cube, variable, time, height, kinds=kinds, spread=spread)
+
+    if sums is None:
+        return None
+
+    return obs_seq_2D_from_sums(sums, statistic)
+
+def obs_seq_cube_1D_stats(cube, variable, time=None, kinds=None, spread='sdHxa'):
+
+    return obs_seq_1D_from_sums(obs_seq_cube_sums(cube, variable, time, kinds=kinds, spread=spread))
+
+#-------------------------------------------------------------------------------
+# Mean, standard deviation, RMS, spread (root mean variance) and consistency ratio
+# (spread^2 + obs_error^2) / RMS^2 of a field, keeping the cube axes listed in keep
+# ('kind', 'time', 'level') and pooling the others
+#
+def obs_seq_cube_moments(cube, field='innov', spread='sdHxf', obs_error=0.0, keep=('time',), kinds=None):
+
+    axes = tuple([n for n, axis in enumerate(['kind', 'time', 'level']) if axis not in keep])
+
+    if kinds is None:
+        k = np.ones(len(cube['kind']), dtype=bool)
+    else:
+        k = np.isin(cube['kind'], kinds)
+
+    n,  mean,  m2  = obs_seq_cube_pool(cube, field, k, axes)
+    sn, smean, sm2 = obs_seq_cube_pool(cube, spread, k, axes)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        rms     = np.sqrt(obs_seq_bin_mean(m2 + n*mean*mean, n))
+        sprd    = np.sqrt(obs_seq_bin_mean(sm2 + sn*smean*smean, sn))
+        consist = (sprd**2 + obs_error**2) / rms**2
+
+    return {'num_obs': cube[field + '_nz'][k].sum(axis=axes),
+            'mean':    mean,
+            'std':     np.sqrt(obs_seq_bin_mean(m2, n)),
+            'rms':     rms,
+            'spread':  sprd,
+            'consist': consist}
+
+# End of file
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# All the diagnostics plots of a collated day from a single read of the file.
+#
+# cron_diag used to start a new python for each of the five plots, and each of them
+# imported pandas/xarray/matplotlib again and read the same obs_seq.final netCDF file.
+# Here the file is opened once:  the statistics cube (obs_seq_collate --stats) when the file
+# has one, otherwise the union of the columns and kinds all the plots need, and every plot
+# is drawn from that shared data.  The statistics of the plots are computed here and the
+# images drawn side by side by obs_seq_render.  Files collated with --copies also get the
+# rank histograms of their ensemble members (plot_rank_hist).
+#
+
+import sys
+import time
+from optparse import OptionParser
+
+from obs_seq_load import obs_seq_load_diag
+from obs_seq_render import obs_seq_render
+from plot_sfc_innov import obs_seq_sfc_innov_job, plot_params
+from plot_radar_innov import obs_seq_radar_innov_job
+from plot_radar_rms import obs_seq_radar_rms_job
+from plot_rank_hist import obs_seq_rank_hist_jobs, obs_seq_rank_members
+from obs_seq_load import obs_seq_load_copy_names
+from obs_seq_chunks import chunk_rows
+
+# Columns and kinds used by the surface, radar innovation and radar RMS plots
+
+diag_columns = ['kind', 'anal_min', 'height', 'dart_qc', 'innov', 'sdHxf', 'sdHxa']
+
+diag_sfc_kinds = [name for key in plot_params.keys() for name in plot_params[key][:2]]
+
+diag_kinds = ['RADAR_REFLECTIVITY', 'DOPPLER_RADIAL_VELOCITY'] + diag_sfc_kinds
+
+# Products:  the surface plot, the innovation and RMS plots of each radar variable, and
+# the rank histograms of every kind (only drawn for files with member copies)
+
+diag_products = ['SFC', 'REF', 'VR', 'RANK']
+
+#=========================================================================================
+# Draw the surface, REF and VR plots of a collated file into image_dir (or only the
+# listed products), with up to processes worker processes (default one per core).  The
+# images are named by the date in the file name, or by tag when one is given.  With chunk,
+# files without a statistics cube are binned chunk rows at a time by workers processes
+# instead of being read whole.  Returns the list of png files written.
+#
+def obs_seq_diagnostics(filename, image_dir="./", window=45, stride=15, raw=False, processes=None,
+                        products=diag_products, tag=None, chunk=None, workers=1):
+
+    start = time.time()
+
+    data = obs_seq_load_diag(filename, columns=diag_columns, kinds=diag_kinds, raw=raw, obs=chunk == None)
+
+    print(" obs_seq_diagnostics:  read %s in %5.2f sec" % (filename, time.time() - start))
+
+    jobs = []
+
+    def plotfilename(name):
+        if tag == None:
+            return None
+        return "%s/%s_%s" % (image_dir, name, tag)
+
+    if 'SFC' in products:
+        jobs.append(obs_seq_sfc_innov_job(filename, image_dir=image_dir, plotfilename=plotfilename("SFC_ObsDiag"),
+                                          plotlabel=None if tag == None else "SFC %s" % tag,
+                                          window=window, stride=stride, raw=raw, data=data,
+                                          chunk=chunk, workers=workers))
+
+    for var in [var for var in ['REF', 'VR'] if var in products]:
+        jobs.append(obs_seq_radar_innov_job(filename, var=var, image_dir=image_dir, plotfilename=plotfilename(var + "_INNOV"),
+                                            window=window, stride=stride, raw=raw, data=data,
+                                            chunk=chunk, workers=workers))
+        jobs.append(obs_seq_radar_rms_job(filename, var=var, image_dir=image_dir, plotfilename=plotfilename(var + "_RMS"),
+                                          window=window, stride=stride, raw=raw, data=data,
+                                          chunk=chunk, workers=workers))
+
+    if 'RANK' in products:
+        jobs += obs_seq_rank_hist_jobs(filename, image_dir=image_dir, plotfilename=plotfilename("RANK"),
+                                       plotlabel=None if tag == None else "RANK %s" % tag,
+                                       out=None if tag == None else plotfilename("RANK") + ".nc",
+                                       window=window, stride=stride, rows=chunk or chunk_rows, workers=workers)
+
+    del data
+
+    plots = obs_seq_render(jobs, processes=processes)
+
+    print(" obs_seq_diagnostics:  %d plots in %5.2f sec" % (len(plots), time.time() - start))
+
+    return plots
+
+#-------------------------------------------------------------------------------
+# Products showing any of the kind numbers in kinds (attrs:  the collated file attributes,
+# kind name -> kind number)
+#
+def obs_seq_diag_products(attrs, kinds):
+
+    kinds    = set(kinds)
+    products = []
+
+    if kinds & set([attrs[name] for name in diag_sfc_kinds if name in attrs]):
+        products.append('SFC')
+
+    if attrs.get('RADAR_REFLECTIVITY', None) in kinds:
+        products.append('REF')
+
+    if attrs.get('DOPPLER_RADIAL_VELOCITY', None) in kinds:
+        products.append('VR')
+
+    if len(kinds) > 0 and len(obs_seq_rank_members(obs_seq_load_copy_names(attrs))) > 0:
+        products.append('RANK')
+
+    return products
+
+#-------------------------------------------------------------------------------
+# Main function defined to return correct sys.exit() calls
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+# Command line interface definitions
+
+    parser = OptionParser()
+
+    parser.add_option("-f", "--file",  dest="file",  default=None, type="string", help = "obs_seq.final.nc file to process")
+    parser.add_option("--dir",  dest="dir",  default="./", type="string", help = "full pathname where to put the images")
+    parser.add_option("--window", dest="window", default=45, type="int", help = "length of the time windows in minutes, default is 45")
+    parser.add_option("--stride", dest="stride", default=15, type="int", help = "minutes between the starts of the time windows, default is 15")
+    parser.add_option("--raw", dest="raw", default=False, action="store_true", help = "bin the obs even when the file has a statistics cube")
+    parser.add_option("--processes", dest="processes", default=None, type="int", help = "number of processes drawing the images, default is one per core")
+    parser.add_option("--chunk", dest="chunk", default=None, type="int", help = "bin the obs out of core in chunks of this many rows")
+    parser.add_option("--workers", dest="workers", default=1, type="int", help = "number of processes binning the chunks, default is 1")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.file == None:
+        print("\n                NO INPUT obs_seq_final.nc IS SUPPLIED, EXITING.... \n ")
+        parser.print_help()
+        sys.exit(1)
+
+    obs_seq_diagnostics(options.file, image_dir=options.dir, window=options.window, stride=options.stride,
+                        raw=options.raw, processes=options.processes, chunk=options.chunk, workers=options.workers)
+
+#-------------------------------------------------------------------------------
+# Main program for testing...
+#
+if __name__ == "__main__":
+
+    sys.exit(main())
@@ -0,0 +1,382 @@
+# coding: utf-8
+#
+# Shared loader for collated obs_seq netCDF files, used by the plotting scripts.
+#
+# Instead of xr.open_dataset(file).to_dataframe(), which decodes every variable for every
+# kind, only the requested columns are read, and only the rows of the requested kinds (and
+# analysis time window).  For files collated with --sort the rows come straight from the
+# kind/time offset index as contiguous reads; otherwise the kind and anal_min columns are
+# read first and used as a mask for the other columns.
+#
+# Files ending in .parquet are the columnar copies written by obs_seq_collate --parquet,
+# and are read through obs_seq_parquet with the same arguments and results (they have no
+# statistics cube).
+#
+# The copies matrix of files collated with --copies reads back as the columns copy_0 ...
+# copy_N-1, or as a matrix with obs_seq_load_copies.
+#
+
+import os
+import sys
+import datetime as dtime
+import numpy as np
+import pandas as pd
+import netCDF4 as ncdf
+
+from obs_seq_netcdf import obs_seq_nc_offsets, obs_seq_nc_rows, obs_seq_nc_stats, obs_seq_copy_columns, chunk_rows
+from obs_seq_cube import obs_seq_cube_check
+from obs_seq_parquet import obs_seq_pq_file, obs_seq_pq_attrs, obs_seq_pq_names, obs_seq_pq_load
+
+time_format = "%Y-%m-%d_%H:%M:%S"
+
+#=========================================================================================
+# Load a collated file.  Returns (DataFrame, attrs) where attrs are the global attributes
+# (kind name -> kind number, time_from_1800, ...).
+#
+#   columns:     names of the columns to read, None for all of them.  Names that are not
+#                in the file are ignored, so callers can ask for the columns used in a
+#                threshold string without checking the layout.
+#   kinds:       list of kind numbers or kind names (looked up in the file attributes),
+#                None for all kinds.  Names that are not in the file are ignored.
+#   tmin, tmax:  only keep analysis times tmin <= anal_min <= tmax
+#   start, stop: only look at rows start:stop of the file (a chunk, see obs_seq_chunks)
+#
+def obs_seq_load(filename, columns=None, kinds=None, tmin=None, tmax=None, start=None, stop=None):
+
+    if obs_seq_pq_file(filename):
+        attrs   = obs_seq_pq_attrs(filename)
+        numbers = None if kinds is None else obs_seq_load_kinds(attrs, kinds)
+        return obs_seq_pq_load(filename, columns, numbers, tmin, tmax, start, stop), attrs
+
+    fnc = obs_seq_load_open(filename)
+
+    try:
+        attrs = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+        rows  = obs_seq_load_rows(fnc, attrs, kinds, tmin, tmax, start, stop)
+        df    = obs_seq_load_frame(fnc, columns, rows)
+    finally:
+        fnc.close()
+
+    return df, attrs
+
+#-------------------------------------------------------------------------------
+# The given columns (None for all of them) of the selected rows of an open file
+#
+def obs_seq_load_frame(fnc, columns, rows):
+
+    names = obs_seq_load_names(fnc)
+
+    if columns == None:
+        columns = names
+    else:
+        columns = [name for name in columns if name in names]
+
+    data   = {}
+    copies = None
+
+    for name in columns:
+        if name in fnc.variables:
+            data[name] = obs_seq_load_variable(fnc.variables[name], rows)
+        else:
+            # one of the copy_* columns:  the copies matrix is read once for all of them
+            if copies is None:
+                copies = obs_seq_load_variable(fnc.variables['copies'], rows)
+            data[name] = copies[:, int(name[len('copy_'):])]
+
+    return pd.DataFrame(data, columns=columns)
+
+#-------------------------------------------------------------------------------
+# The copies matrix of a file collated with --copies.  Returns (DataFrame, copies, attrs):
+# the other columns (as obs_seq_load, none by default) and the float32 (nobs x num_copies)
+# matrix of the same rows, whose columns are named by obs_seq_load_copy_names(attrs).  A
+# file without copies gives a matrix with no columns.
+#
+def obs_seq_load_copies(filename, columns=[], kinds=None, tmin=None, tmax=None, start=None, stop=None):
+
+    if obs_seq_pq_file(filename):
+        names     = obs_seq_copy_columns(len(obs_seq_load_copy_names(obs_seq_pq_attrs(filename))))
+        df, attrs = obs_seq_load(filename, list(columns) + names, kinds, tmin, tmax, start, stop)
+        copies    = np.asarray(df[names], dtype=np.float32).reshape(len(df), len(names))
+        return df[[name for name in df.columns if name not in names]], copies, attrs
+
+    fnc = obs_seq_load_open(filename)
+
+    try:
+        attrs = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+        rows  = obs_seq_load_rows(fnc, attrs, kinds, tmin, tmax, start, stop)
+        df    = obs_seq_load_frame(fnc, [name for name in columns if not name.startswith('copy_')], rows)
+
+        if 'copies' in fnc.variables:
+            copies = obs_seq_load_variable(fnc.variables['copies'], rows).astype(np.float32)
+        else:
+            copies = np.zeros((len(obs_seq_load_variable(fnc.variables['kind'], rows)), 0), dtype=np.float32)
+    finally:
+        fnc.close()
+
+    return df, copies, attrs
+
+#-------------------------------------------------------------------------------
+# Names of the copies (the copy_names attribute written by obs_seq_collate --copies)
+#
+def obs_seq_load_copy_names(attrs):
+
+    return [name for name in attrs.get('copy_names', "").split("\n") if name != ""]
+
+#-------------------------------------------------------------------------------
+# The statistics cube of a file collated with --stats (None otherwise) and the global
+# attributes, without reading any obs
+#
+def obs_seq_load_cube(filename):
+
+    if obs_seq_pq_file(filename):
+        return None, obs_seq_pq_attrs(filename)
+
+    fnc = obs_seq_load_open(filename)
+
+    try:
+        attrs = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+        cube  = obs_seq_cube_check(obs_seq_nc_stats(fnc))
+    finally:
+        fnc.close()
+
+    return cube, attrs
+
+#-------------------------------------------------------------------------------
+# Only the global attributes of a collated file
+#
+def obs_seq_load_attrs(filename):
+
+    if obs_seq_pq_file(filename):
+        return obs_seq_pq_attrs(filename)
+
+    fnc = obs_seq_load_open(filename)
+
+    try:
+        attrs = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+    finally:
+        fnc.close()
+
+    return attrs
+
+#-------------------------------------------------------------------------------
+# Time origin of anal_min of a collated file, as a datetime:  its time_from_1800
+# attribute or, for files collated before that was written, anal_time - anal_min of the
+# first ob, or else 00Z of the day in the file name (prefix.YYYYMMDD.nc).  Raises a
+# ValueError when the file has none of them.
+#
+def obs_seq_load_origin(filename, attrs=None):
+
+    if attrs == None:
+        attrs = obs_seq_load_attrs(filename)
+
+    if 'time_from_1800' in attrs:
+        return dtime.datetime.strptime(str(attrs['time_from_1800']), time_format)
+
+    df = obs_seq_load(filename, columns=['anal_time', 'anal_min'], start=0, stop=1)[0]
+
+    if 'anal_time' in df.columns and 'anal_min' in df.columns and len(df) > 0 and not pd.isnull(df['anal_time'].values[0]):
+        anal_time = df['anal_time'].values[0]
+        if isinstance(anal_time, bytes):
+            anal_time = anal_time.decode('utf-8')
+        try:
+            if isinstance(anal_time, np.datetime64):
+                anal_time = pd.Timestamp(anal_time).to_pydatetime()
+            else:
+                anal_time = dtime.datetime.strptime(str(anal_time).strip(), time_format)
+            return anal_time - dtime.timedelta(minutes=float(df['anal_min'].values[0]))
+        except ValueError:
+            pass
+
+    try:
+        return dtime.datetime.strptime(os.path.basename(filename).split(".")[-2], "%Y%m%d")
+    except (ValueError, IndexError):
+        raise ValueError("%s has no time origin:  no time_from_1800 attribute, no anal_time column "
+                         "and no YYYYMMDD in its name" % filename)
+
+#-------------------------------------------------------------------------------
+# Data shared by several plots of one file (obs_seq_diag):  a dictionary with the file
+# name, global attributes, obs variable names and statistics cube (None when the file has
+# none, or with raw=True).  Without a cube the obs of the given columns and kinds are read
+# as well, once for all the plots.
+#
+def obs_seq_load_diag(filename, columns=None, kinds=None, raw=False, obs=True):
+
+    data = {'file':  filename,
+            'attrs': None,
+            'names': None,
+            'cube':  None,
+            'obs':   None,
+            'kinds': None}
+
+    if obs_seq_pq_file(filename):
+        data['attrs'] = obs_seq_pq_attrs(filename)
+        data['names'] = obs_seq_pq_names(filename)
+    else:
+        fnc = obs_seq_load_open(filename)
+        try:
+            data['attrs'] = dict((key, fnc.getncattr(key)) for key in fnc.ncattrs())
+            data['names'] = obs_seq_load_names(fnc)
+            if not raw:
+                data['cube'] = obs_seq_cube_check(obs_seq_nc_stats(fnc))
+        finally:
+            fnc.close()
+
+    if data['cube'] is None and obs:
+        data['obs'] = obs_seq_load(filename, columns=columns, kinds=kinds)[0]
+        if kinds is not None:
+            data['kinds'] = obs_seq_load_kinds(data['attrs'], kinds)
+
+    return data
+
+#-------------------------------------------------------------------------------
+# The obs of the given kinds and columns:  selected from the shared data when it holds
+# them, otherwise read from the file
+#
+def obs_seq_load_select(data, columns, kinds):
+
+    obs     = data['obs']
+    numbers = obs_seq_load_kinds(data['attrs'], kinds)
+    needed  = [name for name in columns if name in data['names']]
+
+    if obs is not None and 'kind' in obs.columns and \
+       (data['kinds'] is None or set(numbers) <= set(data['kinds'])) and \
+       all([name in obs.columns for name in needed]):
+        return obs[np.isin(obs['kind'].values, numbers)][needed]
+
+    return obs_seq_load(data['file'], columns=columns, kinds=kinds)[0]
+
+#-------------------------------------------------------------------------------
+# Open a collated file, exiting with a message when it is not there
+#
+def obs_seq_load_open(filename):
+
+    try:
+        return ncdf.Dataset(filename, mode='r')
+    except (IOError, OSError):
+        print(" \n ----> netCDF obs_seq_final file not found! \n")
+        sys.exit(-1)
+
+#-------------------------------------------------------------------------------
+# Names of the obs variables (those along the index dimension), with the copies matrix
+# as its copy_* columns
+#
+def obs_seq_load_names(fnc):
+
+    names = []
+
+    for name, var in fnc.variables.items():
+        if var.dimensions[:1] != ('index',) or name == 'index':
+            continue
+        if var.dimensions[1:] == ('copy',):
+            names += obs_seq_copy_columns(var.shape[1])
+        else:
+            names.append(name)
+
+    return names
+
+#-------------------------------------------------------------------------------
+# Kind numbers for a list of kind numbers/names
+#
+def obs_seq_load_kinds(attrs, kinds):
+
+    numbers = []
+    for kind in kinds:
+        if isinstance(kind, str):
+            if kind in attrs:
+                numbers.append(int(attrs[kind]))
+        else:
+            numbers.append(int(kind))
+
+    return numbers
+
+#-------------------------------------------------------------------------------
+# Rows to read:  None for all rows, a list of (start, stop) ranges, or an array of row
+# numbers.  With start/stop only rows start:stop are looked at.
+#
+def obs_seq_load_rows(fnc, attrs, kinds, tmin, tmax, start=None, stop=None):
+
+    if start != None or stop != None:
+        nrows = len(fnc.dimensions['index'])
+        start = 0 if start == None else max(min(start, nrows), 0)
+        stop  = nrows if stop == None else max(min(stop, nrows), start)
+
+    if kinds is None and tmin == None and tmax == None:
+        if start == None:
+            return None
+        return [(start, stop)]
+
+    offsets = obs_seq_nc_offsets(fnc)
+
+    if kinds is None:
+        numbers = None
+    else:
+        numbers = obs_seq_load_kinds(attrs, kinds)
+
+    if offsets != None:
+        if numbers is None:
+            numbers = offsets['kind']
+        ranges = obs_seq_nc_rows(offsets, numbers, tmin, tmax)
+        if start == None:
+            return ranges
+        ranges = [(max(lo, start), min(hi, stop)) for lo, hi in ranges]
+        return [(lo, hi) for lo, hi in ranges if hi > lo]
+
+    if start == None:
+        window = None
+        start  = 0
+    else:
+        window = [(start, stop)]
+
+    keep = np.ones(len(fnc.dimensions['index']) if window == None else stop - start, dtype=bool)
+
+    if numbers is not None:
+        keep &= np.isin(obs_seq_load_variable(fnc.variables['kind'], window), numbers)
+
+    if tmin != None or tmax != None:
+        anal_min = obs_seq_load_variable(fnc.variables['anal_min'], window)
+        if tmin != None:  keep &= anal_min >= tmin
+        if tmax != None:  keep &= anal_min <= tmax
+
+    return start + np.nonzero(keep)[0]
+
+#-------------------------------------------------------------------------------
+# Read and decode one variable for the selected rows:  char arrays become byte strings,
+# time variables datetime64, packed and missing values are unpacked / set to NaN.  An array
+# of rows is read as the spans of rows closer than one chunk of the variable to each other,
+# so rows spread over the file do not read everything between them.
+#
+def obs_seq_load_variable(var, rows):
+
+    if rows is None:
+        data = var[:]
+    elif isinstance(rows, list):
+        if len(rows) == 0:
+            data = var[0:0]
+        else:
+            data = np.ma.concatenate([var[start:stop] for start, stop in rows])
+    elif len(rows) == 0:
+        data = var[0:0]
+    else:
+        chunks = var.chunking()
+        gap    = chunk_rows if chunks == 'contiguous' or chunks == None else chunks[0]
+        breaks = np.nonzero(np.diff(rows) > gap)[0] + 1
+        firsts = np.concatenate(([0], breaks))
+        lasts  = np.concatenate((breaks, [len(rows)]))
+        data   = np.ma.concatenate([var[rows[i]:rows[j-1]+1][rows[i:j] - rows[i]] for i, j in zip(firsts, lasts)])
+
+    if np.ma.isMaskedArray(data):
+        if data.dtype.kind == 'f':
+            data = data.filled(np.nan)
+        else:
+            data = data.data
+
+    if var.dtype == np.dtype('S1') and data.ndim == 2:
+        data = np.ascontiguousarray(data).view('S%d' % data.shape[1]).reshape(data.shape[0])
+
+    elif ' since ' in getattr(var, 'units', ''):
+        unit, origin = var.units.split(' since ')
+        data = (pd.Timestamp(origin) + pd.to_timedelta(data, unit=unit.strip())).values
+
+    return data
+
+# End of file
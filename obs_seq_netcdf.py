@@ -0,0 +1,378 @@
+# coding: utf-8
+#
+# Streaming netCDF writer for collated obs_seq data.
+#
+# The file is created once with an unlimited "index" dimension, one variable per field
+# of the obs layout (obs_seq_dict_default or obs_seq_dict_compact), per-variable
+# zlib/shuffle compression and chunking, and all the global attributes.  Each obs_seq
+# file is then appended as soon as it is read, so only one file's worth of obs is held
+# in memory.  The result reads back with xr.open_dataset exactly like the old
+# xarray-written files (strings as bytes, date/anal_time as datetime64).
+#
+# Optionally the rows are then sorted by kind and anal_min (obs_seq_nc_sort), and an
+# "offsets" group records where each kind and each (kind, analysis time) starts and stops,
+# so a reader can pull one kind with a contiguous read (obs_seq_nc_offsets/obs_seq_nc_rows).
+# A "stats" group can hold the kind x analysis time x level statistics cube (obs_seq_cube).
+#
+# A layout with a "copies" field (obs_seq_collate --copies) gets a "copy" dimension and a
+# float32 copies(index, copy) variable holding every copy of every ob (ensemble members,
+# ...); in DataFrames the matrix travels as the columns copy_0 ... copy_N-1.
+#
+
+import numpy as np
+import netCDF4 as ncdf
+
+time_units = "seconds since 1970-01-01 00:00:00"
+
+# Rows per chunk along the index dimension
+
+chunk_rows = 32768
+
+# Bytes of one variable obs_seq_nc_sort holds at a time
+
+sort_bytes = 256*1024*1024
+
+# Optional packing of innovation-type fields into int16 with this scale_factor:
+# values are kept to +/- scale/2 over a range of +/- 32767*scale
+
+pack_fields = {'innov': 0.01,
+               'sdHxf': 0.01,
+               'sdHxa': 0.01}
+
+_pack_fill = np.int16(-32768)
+
+#-------------------------------------------------------------------------------
+# DataFrame column names of the copies matrix
+#
+def obs_seq_copy_columns(num_copies):
+
+    return ["copy_%d" % n for n in range(num_copies)]
+
+#=========================================================================================
+# Create the output file.  dtype is the record layout, attrs a dictionary of global
+# attributes (kind name -> kind number, history, ...).  Returns the open netCDF4.Dataset.
+#
+def obs_seq_nc_create(netcdf_file, dtype, attrs={}, pack=False, complevel=4):
+
+    fnc = ncdf.Dataset(netcdf_file, mode='w', format='NETCDF4')
+
+    fnc.createDimension('index', None)
+
+    for name in dtype.names:
+
+        field = dtype[name]
+
+        if field.kind == 'S':
+
+            dim = "string%d" % field.itemsize
+            if dim not in fnc.dimensions:
+                fnc.createDimension(dim, field.itemsize)
+
+            fnc.createVariable(name, 'S1', ('index', dim), zlib=True, shuffle=True, complevel=complevel,
+                               chunksizes=(max(chunk_rows // field.itemsize, 1024), field.itemsize))
+
+        elif field.subdtype is not None:
+
+            base, shape = field.subdtype
+            ncopy       = max(shape[0], 1)
+            if 'copy' not in fnc.dimensions:
+                fnc.createDimension('copy', shape[0])
+
+            fnc.createVariable(name, base.str.lstrip('<>|='), ('index', 'copy'), zlib=True, shuffle=True,
+                               complevel=complevel, chunksizes=(max(chunk_rows // ncopy, 1024), ncopy))
+
+        elif field.kind == 'M':
+
+            var = fnc.createVariable(name, 'i8', ('index',), zlib=True, shuffle=True, complevel=complevel,
+                                     chunksizes=(chunk_rows,))
+            var.units    = time_units
+            var.calendar = "standard"
+
+        elif pack and name in pack_fields:
+
+            var = fnc.createVariable(name, 'i2', ('index',), zlib=True, shuffle=True, complevel=complevel,
+                                     chunksizes=(chunk_rows,), fill_value=_pack_fill)
+            var.scale_factor = pack_fields[name]
+            var.add_offset   = 0.0
+
+        else:
+
+            fnc.createVariable(name, field.str.lstrip('<>|='), ('index',), zlib=True, shuffle=True,
+                               complevel=complevel, chunksizes=(chunk_rows,))
+
+    for key in attrs.keys():
+        fnc.setncattr(key, attrs[key])
+
+    return fnc
+
+#-------------------------------------------------------------------------------
+# Open an existing file for appending.  Returns None when the file cannot be appended to
+# (does not exist, or was written with a fixed-size index dimension by xarray).
+#
+def obs_seq_nc_open_append(netcdf_file):
+
+    try:
+        fnc = ncdf.Dataset(netcdf_file, mode='a')
+    except (IOError, OSError, RuntimeError):
+        return None
+
+    if 'index' not in fnc.dimensions or not fnc.dimensions['index'].isunlimited():
+        fnc.close()
+        return None
+
+    return fnc
+
+#=========================================================================================
+# Append the rows of a DataFrame (or recarray) to the open file.  Fields that are not in
+# the file are skipped.  The copies matrix comes from the copy_* columns of a DataFrame.
+# Returns the new number of rows.
+#
+def obs_seq_nc_append(fnc, df):
+
+    start = len(fnc.dimensions['index'])
+    nrows = len(df)
+
+    if nrows == 0:
+        return start
+
+    if hasattr(df, 'columns'):
+        fields = list(df.columns)
+    else:
+        fields = list(df.dtype.names)
+
+    for name, var in fnc.variables.items():
+
+        if var.dimensions[1:] == ('copy',) and hasattr(df, 'columns'):
+            columns = obs_seq_copy_columns(var.shape[1])
+            if len(columns) > 0 and columns[0] in fields:
+                var[start:start+nrows] = np.asarray(df[columns], dtype=var.dtype)
+            continue
+
+        if name not in fields:
+            continue
+
+        data = np.asarray(df[name])
+
+        if var.dtype == np.dtype('S1'):
+            data = np.ascontiguousarray(data.astype('S%d' % var.shape[1])).view('S1').reshape(nrows, var.shape[1])
+
+        elif getattr(var, 'units', None) == time_units:
+            data = data.astype('datetime64[s]').astype(np.int64)
+
+        elif 'scale_factor' in var.ncattrs():
+            limit = 32767 * var.scale_factor
+            data  = np.ma.masked_where(~np.isfinite(data) | (np.abs(data) > limit), data)
+            if data.mask.any():
+                print(" obs_seq_nc_append:  %d values of %s could not be packed and are missing" %
+                      (data.mask.sum(), name))
+
+        var[start:start+nrows] = data
+
+    return start + nrows
+
+#=========================================================================================
+# Rewrite in_file into out_file with the rows sorted by kind, then anal_min (stable, so
+# rows keep their collation order within a kind and analysis time).  The original row
+# number is kept in "collate_row" so incremental runs can find each file's rows again,
+# and the kind/time offsets are written to the "offsets" group.  Works one variable at a
+# time, and each variable one block of at most sort_bytes of sorted rows at a time:  the
+# block is gathered from the input read chunk_rows rows at a time (one pass over the
+# variable per block), so only the sort keys and one block are held in memory.
+#
+def obs_seq_nc_sort(in_file, out_file):
+
+    fin = ncdf.Dataset(in_file, mode='r')
+    fin.set_auto_maskandscale(False)
+    fin.set_always_mask(False)
+    fin.set_auto_chartostring(False)
+
+    kind     = fin.variables['kind'][:]
+    anal_min = fin.variables['anal_min'][:]
+    order    = np.lexsort((anal_min, kind))
+    nrows    = len(order)
+    position = np.empty(nrows, dtype=np.int64)
+
+    position[order] = np.arange(nrows)
+
+    fout = ncdf.Dataset(out_file, mode='w', format='NETCDF4')
+
+    for name, dim in fin.dimensions.items():
+        fout.createDimension(name, None if dim.isunlimited() else len(dim))
+
+    fout.setncatts(dict((key, fin.getncattr(key)) for key in fin.ncattrs()))
+
+    for name, var in fin.variables.items():
+
+        filters = var.filters()
+        attrs   = dict((key, var.getncattr(key)) for key in var.ncattrs() if key != '_FillValue')
+
+        out = fout.createVariable(name, var.dtype, var.dimensions, zlib=filters['zlib'],
+                                  shuffle=filters['shuffle'], complevel=filters['complevel'],
+                                  chunksizes=var.chunking(), fill_value=getattr(var, '_FillValue', None))
+        out.setncatts(attrs)
+        out.set_auto_maskandscale(False)
+        out.set_auto_chartostring(False)
+
+        row_bytes = var.dtype.itemsize * int(np.prod(var.shape[1:]))
+        block     = max(chunk_rows, sort_bytes // max(row_bytes, 1))
+
+        for start in range(0, nrows, block):
+
+            stop = min(start + block, nrows)
+            data = np.empty((stop - start,) + var.shape[1:], dtype=var.dtype)
+
+            for first in range(0, nrows, chunk_rows):
+                last = min(first + chunk_rows, nrows)
+                pos  = position[first:last]
+                keep = (pos >= start) & (pos < stop)
+                if keep.any():
+                    data[pos[keep] - start] = var[first:last][keep]
+
+            out[start:stop] = data
+            del data
+
+    row = fout.createVariable('collate_row', 'i8', ('index',), zlib=True, shuffle=True,
+                              chunksizes=(chunk_rows,))
+    row.long_name = "row number of the obs in collation (file) order"
+    if nrows > 0:
+        row[0:nrows] = order
+
+    obs_seq_nc_write_offsets(fout, kind[order], anal_min[order])
+
+    fin.close()
+    fout.close()
+
+#-------------------------------------------------------------------------------
+# Offsets group of a sorted file:  for each kind present its row range, and for each
+# (kind, analysis time) pair the row range of those obs (empty ranges have start == stop)
+#
+def obs_seq_nc_write_offsets(fnc, kind, anal_min):
+
+    kinds = np.unique(kind)
+    times = np.unique(anal_min)
+
+    kind_start = np.searchsorted(kind, kinds, side='left')
+    kind_stop  = np.searchsorted(kind, kinds, side='right')
+
+    start = np.zeros((len(kinds), len(times)), dtype=np.int64)
+    stop  = np.zeros((len(kinds), len(times)), dtype=np.int64)
+
+    for k in range(len(kinds)):
+        mins     = anal_min[kind_start[k]:kind_stop[k]]
+        start[k] = kind_start[k] + np.searchsorted(mins, times, side='left')
+        stop[k]  = kind_start[k] + np.searchsorted(mins, times, side='right')
+
+    grp = fnc.createGroup('offsets')
+    grp.sort_order = "kind anal_min"
+
+    grp.createDimension('kind', len(kinds))
+    grp.createDimension('time', len(times))
+
+    grp.createVariable('kind', 'i4', ('kind',))[:]                = kinds
+    grp.createVariable('anal_min', 'f8', ('time',))[:]            = times
+    grp.createVariable('kind_start', 'i8', ('kind',))[:]          = kind_start
+    grp.createVariable('kind_stop', 'i8', ('kind',))[:]           = kind_stop
+    grp.createVariable('start', 'i8', ('kind', 'time'))[:]        = start
+    grp.createVariable('stop', 'i8', ('kind', 'time'))[:]         = stop
+
+#-------------------------------------------------------------------------------
+# Read the offsets group of a collated file (a filename or an open netCDF4.Dataset).
+# Returns None when the file was not written sorted.
+#
+def obs_seq_nc_offsets(netcdf_file):
+
+    if isinstance(netcdf_file, ncdf.Dataset):
+        fnc, close = netcdf_file, False
+    else:
+        fnc, close = ncdf.Dataset(netcdf_file, mode='r'), True
+
+    try:
+        if 'offsets' not in fnc.groups:
+            return None
+        grp = fnc.groups['offsets']
+        grp.set_auto_mask(False)
+        return dict((name, grp.variables[name][:]) for name in grp.variables)
+    finally:
+        if close:  fnc.close()
+
+#-------------------------------------------------------------------------------
+# Row ranges [(start, stop), ...] holding the given kinds, optionally only for analysis
+# times (anal_min) between tmin and tmax inclusive.  Adjacent ranges are merged, so
+# a run of analysis times of one kind comes back as a single contiguous read.
+#
+def obs_seq_nc_rows(offsets, kinds, tmin=None, tmax=None):
+
+    ranges = []
+
+    for kind in kinds:
+
+        k = np.nonzero(offsets['kind'] == kind)[0]
+        if len(k) == 0:  continue
+        k = k[0]
+
+        if tmin == None and tmax == None:
+            ranges.append((int(offsets['kind_start'][k]), int(offsets['kind_stop'][k])))
+            continue
+
+        times = offsets['anal_min']
+        use   = np.ones(len(times), dtype=bool)
+        if tmin != None:  use &= times >= tmin
+        if tmax != None:  use &= times <= tmax
+
+        if use.any():
+            ranges.append((int(offsets['start'][k][use].min()), int(offsets['stop'][k][use].max())))
+
+    merged = []
+    for start, stop in sorted(ranges):
+        if stop <= start:  continue
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+
+    return merged
+
+#=========================================================================================
+# Write a statistics cube (obs_seq_cube) to the "stats" group, replacing what is there.
+# kind and time are unlimited dimensions, so the cube of an appended file can grow.
+#
+def obs_seq_nc_write_stats(fnc, cube):
+
+    if 'stats' in fnc.groups:
+        grp = fnc.groups['stats']
+    else:
+        grp = fnc.createGroup('stats')
+        grp.createDimension('kind', None)
+        grp.createDimension('time', None)
+        grp.createDimension('level', len(cube['height_lo']))
+
+    dims = {'kind': ('kind',), 'anal_min': ('time',), 'height_lo': ('level',), 'height_hi': ('level',)}
+
+    for name, data in cube.items():
+        if name not in grp.variables:
+            dtype = 'i4' if name == 'kind' else 'f8'
+            grp.createVariable(name, dtype, dims.get(name, ('kind', 'time', 'level')), zlib=True)
+        if data.size > 0:
+            grp.variables[name][tuple(slice(0, n) for n in data.shape)] = data
+
+#-------------------------------------------------------------------------------
+# Read the statistics cube of a collated file (a filename or an open netCDF4.Dataset),
+# or None when the file has none
+#
+def obs_seq_nc_stats(netcdf_file):
+
+    if isinstance(netcdf_file, ncdf.Dataset):
+        fnc, close = netcdf_file, False
+    else:
+        fnc, close = ncdf.Dataset(netcdf_file, mode='r'), True
+
+    try:
+        if 'stats' not in fnc.groups:
+            return None
+        grp = fnc.groups['stats']
+        grp.set_auto_mask(False)
+        return dict((name, grp.variables[name][:]) for name in grp.variables)
+    finally:
+        if close:  fnc.close()
+
+# End of file
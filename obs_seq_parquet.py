@@ -0,0 +1,252 @@
+# coding: utf-8
+#
+# Columnar (Parquet) copy of a collated file, written by obs_seq_collate --parquet.
+#
+# The obs are written one kind after the other, sorted by analysis time, in row groups of
+# at most group_rows rows that never hold more than one kind, so the min/max statistics
+# Parquet keeps for every column of every row group bound the kind and anal_min of the
+# group.  The kind names are written as a dictionary encoded "name" column (one string
+# per kind, a small integer per row), and the global attributes of the netCDF file (kind
+# name -> kind number, time_from_1800, ...) are kept in the file metadata.
+#
+# Reading (obs_seq_load, for file names ending in .parquet) only decodes the requested
+# columns of the row groups whose statistics can hold the requested kinds and analysis
+# times, so reading one kind costs about the bytes of that kind.
+#
+# pyarrow is only needed to write or read these files.
+#
+
+import sys
+import json
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Largest number of rows in a row group
+
+group_rows = 65536
+
+# Key of the global attributes in the file metadata
+
+attrs_key = b'obs_seq_attrs'
+
+#=========================================================================================
+# True for file names of the Parquet copy of a collated file
+#
+def obs_seq_pq_file(filename):
+
+    return filename.endswith(".parquet")
+
+#-------------------------------------------------------------------------------
+# Exit with a message when pyarrow is missing
+#
+def obs_seq_pq_check():
+
+    if pq is None:
+        print(" \n ----> pyarrow is needed to read or write Parquet obs files! \n")
+        sys.exit(-1)
+
+#-------------------------------------------------------------------------------
+# Open a Parquet obs file, exiting with a message when it is not there
+#
+def obs_seq_pq_open(filename):
+
+    obs_seq_pq_check()
+
+    try:
+        return pq.ParquetFile(filename)
+    except (IOError, OSError):
+        print(" \n ----> Parquet obs_seq_final file not found! \n")
+        sys.exit(-1)
+
+#-------------------------------------------------------------------------------
+# Arrow schema of an open Parquet obs file (ParquetFile.schema_arrow is pyarrow >= 1.0 only)
+#
+def obs_seq_pq_schema(pfile):
+
+    return pfile.schema.to_arrow_schema()
+
+#=========================================================================================
+# Write parquet_file from an iterable of DataFrames (the obs of one kind each, sorted by
+# anal_min) and the global attributes of the collated file.  Every DataFrame starts new
+# row groups of at most rows rows.  Returns the number of rows written.
+#
+def obs_seq_pq_write(parquet_file, frames, attrs, rows=group_rows, compression='snappy'):
+
+    obs_seq_pq_check()
+
+    names    = dict((int(value), key) for key, value in attrs.items() if isinstance(value, (int, np.integer)))
+    metadata = {attrs_key: json.dumps(dict((key, obs_seq_pq_value(value)) for key, value in attrs.items()))}
+
+    writer = None
+    nrows  = 0
+
+    try:
+        for df in frames:
+
+            kinds, index = np.unique(np.asarray(df['kind']), return_inverse=True)
+            labels       = [names.get(int(kind), "KIND_%d" % kind) for kind in kinds]
+
+            df = df.drop(columns=[name for name in ['name'] if name in df.columns])
+            df['name'] = pd.Categorical.from_codes(index.ravel().astype(np.int32), categories=labels)
+
+            if writer is None:
+                table  = pa.Table.from_pandas(df, preserve_index=False)
+                schema = table.schema.with_metadata(dict(list((table.schema.metadata or {}).items()) +
+                                                         list(metadata.items())))
+                writer = pq.ParquetWriter(parquet_file, schema, compression=compression,
+                                          use_dictionary=['name'], write_statistics=True)
+            else:
+                table  = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+            if len(df) > 0:
+                writer.write_table(table.cast(schema), row_group_size=rows)
+                nrows = nrows + len(df)
+
+            del df, table
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return nrows
+
+#-------------------------------------------------------------------------------
+# Attribute values as plain python values for the json metadata
+#
+def obs_seq_pq_value(value):
+
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+#=========================================================================================
+# Global attributes of a Parquet obs file
+#
+def obs_seq_pq_attrs(filename):
+
+    metadata = obs_seq_pq_schema(obs_seq_pq_open(filename)).metadata or {}
+
+    if attrs_key not in metadata:
+        return {}
+
+    return json.loads(metadata[attrs_key].decode('utf-8'))
+
+#-------------------------------------------------------------------------------
+# Names of the obs columns of a Parquet obs file
+#
+def obs_seq_pq_names(filename):
+
+    return list(obs_seq_pq_schema(obs_seq_pq_open(filename)).names)
+
+#-------------------------------------------------------------------------------
+# Row groups [(group, first row, number of rows), ...] whose statistics do not rule out
+# the kind numbers (None for all kinds) and analysis times tmin <= anal_min <= tmax
+#
+def obs_seq_pq_groups(pfile, numbers=None, tmin=None, tmax=None):
+
+    meta    = pfile.metadata
+    columns = obs_seq_pq_schema(pfile).names
+    groups  = []
+    first   = 0
+
+    for group in range(meta.num_row_groups):
+
+        rg   = meta.row_group(group)
+        keep = True
+
+        if numbers is not None and 'kind' in columns:
+            lo, hi = obs_seq_pq_range(rg, columns.index('kind'))
+            if lo != None:
+                keep = any([lo <= number <= hi for number in numbers])
+
+        if keep and (tmin != None or tmax != None) and 'anal_min' in columns:
+            lo, hi = obs_seq_pq_range(rg, columns.index('anal_min'))
+            if lo != None:
+                keep = (tmin == None or hi >= tmin) and (tmax == None or lo <= tmax)
+
+        if keep:
+            groups.append((group, first, rg.num_rows))
+
+        first = first + rg.num_rows
+
+    return groups
+
+def obs_seq_pq_range(rg, column):
+
+    stats = rg.column(column).statistics
+
+    if stats is None or not getattr(stats, 'has_min_max', True):
+        return None, None
+
+    return stats.min, stats.max
+
+#-------------------------------------------------------------------------------
+# Row ranges [(start, stop), ...] of the row groups that can hold the kind numbers (None
+# for all kinds), for obs_seq_chunks
+#
+def obs_seq_pq_ranges(filename, numbers=None):
+
+    return [(first, first + count) for group, first, count in obs_seq_pq_groups(obs_seq_pq_open(filename), numbers)]
+
+#=========================================================================================
+# The obs of a Parquet obs file as a DataFrame, for obs_seq_load (which resolves the kind
+# names):  columns (None for all of them, unknown names are ignored), kind numbers (None
+# for all kinds), analysis time window and row window start:stop.  Only the row groups that
+# can hold the selected rows are read, and only the requested columns of them.
+#
+def obs_seq_pq_load(filename, columns=None, numbers=None, tmin=None, tmax=None, start=None, stop=None):
+
+    pfile = obs_seq_pq_open(filename)
+    names = obs_seq_pq_schema(pfile).names
+
+    if columns == None:
+        columns = names
+    else:
+        columns = [name for name in columns if name in names]
+
+    groups = obs_seq_pq_groups(pfile, numbers, tmin, tmax)
+
+    if start != None or stop != None:
+        start  = 0 if start == None else start
+        stop   = pfile.metadata.num_rows if stop == None else stop
+        groups = [(group, first, count) for group, first, count in groups
+                  if first < stop and first + count > start]
+
+    needed = list(columns)
+    for name in ['kind', 'anal_min']:
+        if name in names and name not in needed:
+            needed.append(name)
+
+    if len(groups) > 0:
+        df = pfile.read_row_groups([group for group, first, count in groups], columns=needed).to_pandas()
+    elif pfile.metadata.num_row_groups > 0:
+        df = pfile.read_row_group(0, columns=needed).to_pandas().iloc[0:0]
+    else:
+        df = pd.DataFrame(columns=needed)
+
+    keep = np.ones(len(df), dtype=bool)
+
+    if start != None:
+        rows = np.concatenate([first + np.arange(count) for group, first, count in groups] + [np.zeros(0, dtype=int)])
+        keep &= (rows >= start) & (rows < stop)
+    if numbers is not None:
+        keep &= np.isin(df['kind'].values, numbers)
+    if tmin != None:
+        keep &= df['anal_min'].values >= tmin
+    if tmax != None:
+        keep &= df['anal_min'].values <= tmax
+
+    if not keep.all():
+        df = df[keep]
+
+    return df[columns].reset_index(drop=True)
+
+# End of file
@@ -0,0 +1,476 @@
+# coding: utf-8
+#
+# Vectorized parse engine for ASCII DART obs_seq files.
+#
+# The file is memory-mapped and viewed as a flat uint8 array.  Line boundaries and
+# the "OBS" record markers are found with a single byte-level scan, and every column
+# (copies, QC, location, kind, time, error variance) is then pulled out for all records
+# at once by gathering the needed lines and converting them in bulk with NumPy.
+#
+# Headers of binary (Fortran unformatted) files are flagged by obs_seq_collate.obs_seq_header
+# and their records are decoded by obs_seq_binary instead.
+#
+
+import mmap
+from multiprocessing import Pool
+import numpy as np
+
+import obs_seq_binary
+
+# Version of the column layout produced here - bump it whenever the parsed columns change,
+# so entries in the obs_seq_cache made by an older parser are not reused
+
+parser_version = "1"
+
+# Byte values used by the scanner
+
+_NL    = ord('\n')
+_SPACE = ord(' ')
+_O, _B, _S = ord('O'), ord('B'), ord('S')
+_D, _d = ord('D'), ord('d')
+_E     = ord('E')
+
+# Days between the DART calendar origin (1601-01-01) and the unix epoch (1970-01-01)
+
+dart_epoch_days = 134774
+
+# Which copies / qc values are kept by the default reader, and the string used to find them
+
+copy_fields = [('value',   'obser'),
+               ('meanHxf', 'prior ensemble mean'),
+               ('meanHxa', 'posterior ensemble mean'),
+               ('sdHxf',   'prior ensemble spread'),
+               ('sdHxa',   'posterior ensemble spread')]
+
+qc_fields   = [('ncep_qc', 'NCEP'),
+               ('dart_qc', 'DART')]
+
+#=========================================================================================
+# Resolve the copy/qc name -> column mapping once per header (same matching rules as the
+# original loop in read_obs_seq: first copy whose name contains the search string wins)
+#
+def obs_seq_copy_map(fhead):
+
+    copy_map = {}
+    for numcp, name in enumerate(fhead.copy_names):
+        for field, search in copy_fields:
+            if name.find(search) != -1:
+                if field not in copy_map:  copy_map[field] = numcp
+                break
+
+    qc_map = {}
+    for numqc, name in enumerate(fhead.qc_names):
+        for field, search in qc_fields:
+            if name.find(search) != -1:
+                if field not in qc_map:  qc_map[field] = numqc
+                break
+
+    return copy_map, qc_map
+
+#=========================================================================================
+# Memory map a file and return a read-only uint8 view of it (the mmap stays alive as
+# long as the array does)
+#
+def obs_seq_mmap(filename):
+
+    f = open(filename, 'rb')
+    try:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+
+    return np.frombuffer(mm, dtype=np.uint8)
+
+#=========================================================================================
+# Line start / end (exclusive, newline not included) offsets for a byte buffer.
+# Trailing blank lines at the end of the buffer are ignored.
+#
+def obs_seq_lines(buf):
+
+    nbytes = buf.size
+    while nbytes > 0 and buf[nbytes-1] <= _SPACE:
+        nbytes -= 1
+
+    if nbytes == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    nl     = np.flatnonzero(buf[:nbytes] == _NL)
+    starts = np.concatenate(([0], nl + 1)).astype(np.int64)
+    ends   = np.concatenate((nl, [nbytes])).astype(np.int64)
+
+    return starts, ends
+
+#=========================================================================================
+# Indices of the lines whose first token is "OBS" - these start each observation record
+#
+def obs_seq_record_lines(buf, starts):
+
+    if buf.size < 3:
+        return np.zeros(0, dtype=np.int64)
+
+    # every "OBS" in the file, followed by white space (or the end of the buffer)
+
+    pos = np.flatnonzero((buf[:-2] == _O) & (buf[1:-1] == _B) & (buf[2:] == _S))
+    after = pos + 3
+    pos = pos[(after >= buf.size) | (buf[np.minimum(after, buf.size-1)] <= _SPACE)]
+
+    # ... which is the first token on its line:  only blanks between the line start and OBS
+
+    line   = np.searchsorted(starts, pos, side='right') - 1
+    prefix = pos - starts[line]
+    keep   = prefix == 0
+
+    if prefix.size > 0 and prefix.max() > 0:
+        idx  = starts[line][:,np.newaxis] + np.arange(prefix.max())
+        lead = (buf[np.minimum(idx, buf.size-1)] > _SPACE) & (idx < pos[:,np.newaxis])
+        keep = ~lead.any(axis=1)
+
+    return line[keep]
+
+#=========================================================================================
+# Gather a set of lines (all at once) into one contiguous uint8 array, each line
+# terminated by a newline.  Returns the array and the offset of each line in it.  Lines
+# past the end of the buffer mean the last record was cut short.
+#
+def _gather_lines(buf, starts, ends, lines):
+
+    if lines.size == 0:
+        return np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.int64)
+
+    if lines.max() >= starts.size:
+        raise ValueError("truncated obs_seq file:  the last observation record is incomplete")
+
+    s      = starts[lines]
+    length = ends[lines] - s + 1
+    total  = int(length.sum())
+    offset = np.concatenate(([0], np.cumsum(length)[:-1])).astype(np.int64)
+
+    idx = np.arange(total, dtype=np.int64) + np.repeat(s - offset, length)
+    out = buf[np.minimum(idx, buf.size-1)]
+    out[offset + length - 1] = _NL
+
+    return out, offset
+
+#-------------------------------------------------------------------------------
+# Convert a block of gathered text to numbers.  Fortran "D" exponents are converted
+# to "E" in bulk on the bytes before the conversion.
+#
+def _to_numbers(text, dtype=np.float64):
+
+    text = text.copy()
+    text[(text == _D) | (text == _d)] = _E
+
+    return np.array(text.tobytes().split()).astype(dtype)
+
+#-------------------------------------------------------------------------------
+# Number of white-space separated tokens on each gathered line
+#
+def _token_counts(text, offset):
+
+    if offset.size == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    solid = text > _SPACE
+    first = solid.copy()
+    first[1:] &= ~solid[:-1]
+
+    return np.add.reduceat(first.astype(np.int64), offset)
+
+#-------------------------------------------------------------------------------
+# Parse lines that hold exactly one number each
+#
+def _read_lines(buf, starts, ends, lines, dtype=np.float64):
+
+    if lines.size == 0:
+        return np.zeros(0, dtype=dtype)
+
+    text, offset = _gather_lines(buf, starts, ends, lines)
+
+    return _to_numbers(text, dtype)
+
+#=========================================================================================
+# Vectorized DART time decoding with whole-array integer arithmetic:
+#
+#   (days, seconds) since 1601-01-01  ->  integer seconds since 1970-01-01 (utime)
+#                                     ->  numpy datetime64[s]
+#
+def obs_seq_utime(days, seconds):
+
+    return (np.asarray(days, dtype=np.int64) - dart_epoch_days) * 86400 + np.asarray(seconds, dtype=np.int64)
+
+def obs_seq_datetime64(days, seconds):
+
+    return obs_seq_utime(days, seconds).astype('datetime64[s]')
+
+#=========================================================================================
+# Parse every observation record in a byte buffer.  The buffer may be a whole file
+# (header included) or any slice of one that starts and stops on record boundaries.
+# Returns a dictionary of column arrays, in record order.  With copies=True all the copies
+# are also returned, as a float32 (nobs x num_copies) matrix "copies".
+#
+def obs_seq_parse_buffer(buf, fhead, copies=False):
+
+    starts, ends = obs_seq_lines(buf)
+    obs_lines    = obs_seq_record_lines(buf, starts)
+    nobs         = obs_lines.size
+
+    copy_map, qc_map = obs_seq_copy_map(fhead)
+
+    # A file still being written stops inside its last record:  every record has at least
+    # the OBS, copy, QC, link, obdef, loc3d, location, kind, time and error variance lines,
+    # and the last one ends with its two token time line and error variance line (the final
+    # newline may be missing)
+
+    if nobs > 0:
+        size = np.diff(np.concatenate((obs_lines, [starts.size])))
+        if size.min() < fhead.num_copies + fhead.num_qc + 9 or \
+           _token_counts(*_gather_lines(buf, starts, ends, np.array([starts.size-2])))[0] != 2:
+            raise ValueError("truncated obs_seq file %s:  the last observation record is incomplete" % fhead.filename)
+
+    if nobs == 0:
+        cols = dict((field, np.zeros(0)) for field in list(copy_map.keys()) + list(qc_map.keys()))
+        cols.update({'number':         np.zeros(0, dtype=np.int64),
+                     'lon':            np.zeros(0),
+                     'lat':            np.zeros(0),
+                     'height':         np.zeros(0),
+                     'vert_coord':     np.zeros(0, dtype=np.int32),
+                     'kind':           np.zeros(0, dtype=np.int32),
+                     'seconds':        np.zeros(0, dtype=np.int64),
+                     'days':           np.zeros(0, dtype=np.int64),
+                     'error_variance': np.zeros(0)})
+        if copies:
+            cols['copies'] = np.zeros((0, fhead.num_copies), dtype=np.float32)
+        return cols
+
+    cols = {}
+
+    # Record number from the "OBS    n" line
+
+    text, offset   = _gather_lines(buf, starts, ends, obs_lines)
+    cols['number'] = np.array(text.tobytes().split()[1::2]).astype(np.int64) - 1
+
+    # Copies and QC values sit at fixed offsets from the OBS line.  All the copies are read
+    # in one pass when they are all wanted.
+
+    if copies:
+        lines  = (obs_lines[:,np.newaxis] + 1 + np.arange(fhead.num_copies)).ravel()
+        values = _read_lines(buf, starts, ends, lines).reshape(nobs, fhead.num_copies)
+        for field, numcp in copy_map.items():
+            cols[field] = values[:,numcp].copy()
+        cols['copies'] = values.astype(np.float32)
+        del values
+    else:
+        for field, numcp in copy_map.items():
+            cols[field] = _read_lines(buf, starts, ends, obs_lines + 1 + numcp)
+
+    j = obs_lines + 1 + fhead.num_copies
+
+    for field, numqc in qc_map.items():
+        cols[field] = _read_lines(buf, starts, ends, j + numqc)
+
+    # Skip the "prev next cov_group", "obdef" and "loc3d" lines to get to the location
+
+    loc_lines    = j + fhead.num_qc + 3
+    text, offset = _gather_lines(buf, starts, ends, loc_lines)
+    ntok         = _token_counts(text, offset)
+    values       = _to_numbers(text)
+    first        = np.concatenate(([0], np.cumsum(ntok)[:-1])).astype(np.int64)
+
+    lon = np.rad2deg(values[first])
+    lat = np.rad2deg(values[first+1])
+    lon[lon > 180.0] -= 360.
+
+    cols['lon']    = lon
+    cols['lat']    = lat
+    cols['height'] = values[first+2]
+
+    # The vertical coordinate is either the 4th token of the location line, or on the next line
+
+    on_line = ntok == 4
+    vert    = np.zeros(nobs, dtype=np.int32)
+    vert[on_line]  = values[first[on_line]+3]
+    vert[~on_line] = _read_lines(buf, starts, ends, loc_lines[~on_line] + 1, np.int64)
+
+    cols['vert_coord'] = vert
+
+    kind_lines   = np.where(on_line, loc_lines + 2, loc_lines + 3)
+    cols['kind'] = _read_lines(buf, starts, ends, kind_lines, np.int64).astype(np.int32)
+
+    # Time and error variance are the last two lines of each record, i.e. the two lines
+    # before the next OBS line (or the end of the buffer for the last record)
+
+    next_obs     = np.concatenate((obs_lines[1:], [starts.size]))
+    text, offset = _gather_lines(buf, starts, ends, next_obs - 2)
+    time         = _to_numbers(text, np.int64)
+
+    cols['seconds']        = time[0::2]
+    cols['days']           = time[1::2]
+    cols['error_variance'] = _read_lines(buf, starts, ends, next_obs - 1)
+
+    return cols
+
+#=========================================================================================
+# Byte offsets of the record ("OBS" line) starts in a buffer
+#
+def obs_seq_record_offsets(buf):
+
+    starts, ends = obs_seq_lines(buf)
+
+    return starts[obs_seq_record_lines(buf, starts)]
+
+#=========================================================================================
+# Split a file into (at most) nsplit byte ranges that each start on an OBS record line.
+# Split points are placed evenly through the file and then moved forward to the next
+# record start, so every record falls entirely in one range.
+#
+def obs_seq_split_ranges(buf, nsplit, window=65536):
+
+    bounds = [0]
+
+    for n in range(1, nsplit):
+
+        pos = max(int(buf.size * n // nsplit), bounds[-1])
+
+        # move to the start of the next line, then search for the next record start
+
+        nl = np.flatnonzero(buf[pos:pos+window] == _NL)
+        while nl.size == 0 and pos + window < buf.size:
+            window *= 2
+            nl = np.flatnonzero(buf[pos:pos+window] == _NL)
+        if nl.size == 0:
+            break
+
+        pos     = pos + nl[0] + 1
+        offsets = obs_seq_record_offsets(buf[pos:pos+window])
+        while offsets.size == 0 and pos + window < buf.size:
+            window *= 2
+            offsets = obs_seq_record_offsets(buf[pos:pos+window])
+        if offsets.size == 0:
+            break
+
+        if pos + offsets[0] > bounds[-1]:
+            bounds.append(pos + offsets[0])
+
+    bounds.append(buf.size)
+
+    return [(bounds[n], bounds[n+1]) for n in range(len(bounds)-1)]
+
+#-------------------------------------------------------------------------------
+# Worker:  parse one byte range of a file (each worker maps the file itself)
+#
+def _parse_range(args):
+
+    fhead, start, stop, copies = args
+
+    return obs_seq_parse_buffer(obs_seq_mmap(fhead.filename)[start:stop], fhead, copies)
+
+#-------------------------------------------------------------------------------
+# Stitch the column dictionaries from consecutive ranges back together in record order
+#
+def obs_seq_concat_columns(parts):
+
+    parts = [p for p in parts if p['number'].size > 0] or parts[:1]
+
+    return dict((key, np.concatenate([p[key] for p in parts])) for key in parts[0].keys())
+
+#=========================================================================================
+# Parse a whole obs_seq file given its header (from obs_seq_collate.obs_seq_header).
+#
+# With workers > 1 the file is split into byte ranges aligned to OBS records, which are
+# parsed in a process pool sharing the same header, and stitched back in record order -
+# the result is identical to the serial parse.  copies=True adds the matrix of all the
+# copies (see obs_seq_parse_buffer).
+#
+def read_obs_columns(fhead, workers=1, copies=False):
+
+    if getattr(fhead, 'binary', False):
+        return obs_seq_binary.read_binary_columns(fhead, copies)
+
+    buf = obs_seq_mmap(fhead.filename)
+
+    if workers <= 1:
+        return obs_seq_parse_buffer(buf, fhead, copies)
+
+    ranges = obs_seq_split_ranges(buf, workers)
+    del buf
+
+    pool = Pool(len(ranges))
+    try:
+        parts = pool.map(_parse_range, [(fhead, start, stop, copies) for start, stop in ranges], chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    return obs_seq_concat_columns(parts)
+
+#=========================================================================================
+# Generator version of read_obs_columns:  reads the file incrementally in blocks of
+# block_size bytes and yields column dictionaries of batch_size records (the last batch
+# may be shorter).  Only the unparsed tail of the file read so far is held in memory,
+# so peak memory is set by batch_size/block_size and not by the size of the file.
+#
+def iter_obs_columns(fhead, batch_size=100000, block_size=8*1024*1024, copies=False):
+
+    if getattr(fhead, 'binary', False):
+        for cols in obs_seq_binary.iter_binary_columns(fhead, batch_size=batch_size, copies=copies):
+            yield cols
+        return
+
+    f = open(fhead.filename, 'rb')
+
+    parts  = []                           # unparsed blocks (uint8 arrays)
+    size   = 0                            # bytes in parts
+    tail   = b''                          # last, incomplete, line of parts
+    starts = np.zeros(0, dtype=np.int64)  # record starts found in parts
+    eof    = False
+
+    try:
+        while True:
+
+            # Read until there are more than batch_size record starts (the last one may
+            # still be incomplete) or the end of the file is reached.  Only the complete
+            # lines of each new block (and the incomplete line before it) are scanned for
+            # record starts, so a record split across many blocks is scanned once.
+
+            while not eof and starts.size <= batch_size:
+                block = f.read(block_size)
+                if len(block) == 0:
+                    eof  = True
+                    text = tail
+                    cut  = len(text)
+                else:
+                    parts.append(np.frombuffer(block, dtype=np.uint8))
+                    size = size + len(block)
+                    text = tail + block
+                    cut  = text.rfind(b'\n') + 1
+                base   = size - len(text)
+                found  = obs_seq_record_offsets(np.frombuffer(text, dtype=np.uint8, count=cut))
+                starts = np.concatenate((starts, base + found))
+                tail   = text[cut:]
+
+            if starts.size == 0:
+                break
+
+            if len(parts) > 1:
+                parts = [np.concatenate(parts)]
+            buf = parts[0]
+
+            # Records are complete when the next record start is in the buffer, or at EOF
+
+            if starts.size > batch_size:
+                stop = starts[batch_size]
+            else:
+                stop = buf.size
+
+            yield obs_seq_parse_buffer(buf[starts[0]:stop], fhead, copies)
+
+            parts  = [buf[stop:]]
+            size   = size - stop
+            starts = starts[batch_size:] - stop
+
+            if eof and size == 0:
+                break
+    finally:
+        f.close()
+
+# End of file
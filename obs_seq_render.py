@@ -0,0 +1,80 @@
+# coding: utf-8
+#
+# Headless batch renderer for the diagnostics plots.
+#
+# A plot is described by a job dictionary:
+#
+#   product:  'radar_innov', 'radar_rms', 'sfc_innov' or 'rank_hist' (see render_products)
+#   kind:     what the plot is of (REF, VR, SFC, ...), for the log
+#   stats:    the statistics the drawing function plots (data_dict or list of panels)
+#   output:   png file to write
+#   options:  other keyword arguments of the drawing function (labels, time origin, ...)
+#
+# Each job is drawn into its own matplotlib Figure on an Agg canvas, without going through
+# the pyplot state, so jobs can run side by side in worker processes and no display is
+# needed.  The statistics are computed beforehand (they are small), so the workers only draw
+# and write the images.
+#
+
+import time
+import multiprocessing
+
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# product -> (module, drawing function, figure size).  The functions take the stats, the
+# Figure to draw into and the job options.  The plotting modules are imported when a job
+# is drawn, so they can import this one.
+
+render_products = {'radar_innov': ('plot_radar_innov', 'obs_seq_TimeHeightInnov', (12,12)),
+                   'radar_rms':   ('plot_radar_rms',   'obs_seq_TimeHeightRMS',   (12,12)),
+                   'sfc_innov':   ('plot_sfc_innov',   'obs_seq_SfcDiag',         (12,14)),
+                   'rank_hist':   ('plot_rank_hist',   'obs_seq_RankHist',        (12,12))}
+
+#=========================================================================================
+# Draw one job and save its png.  Returns the png file name.
+#
+def obs_seq_render_job(job):
+
+    module, function, figsize = render_products[job['product']]
+
+    draw = getattr(__import__(module), function)
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+
+    draw(job['stats'], fig=fig, **job.get('options', {}))
+
+    fig.savefig(job['output'])
+
+    return job['output']
+
+#-------------------------------------------------------------------------------
+# Draw a list of jobs with up to processes worker processes (default:  one per core,
+# no more than there are jobs).  processes=1 draws them one after the other in this process.
+# Returns the png file names in the order of the jobs.
+#
+def obs_seq_render(jobs, processes=None):
+
+    start = time.time()
+
+    if processes == None:
+        processes = multiprocessing.cpu_count()
+
+    processes = max(min(processes, len(jobs)), 1)
+
+    if processes == 1:
+        outputs = [obs_seq_render_job(job) for job in jobs]
+    else:
+        pool = multiprocessing.Pool(processes)
+        try:
+            outputs = pool.map(obs_seq_render_job, jobs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    print(" obs_seq_render:  %d images with %d processes in %5.2f sec" % (len(outputs), processes, time.time() - start))
+
+    return outputs
+
+# End of file
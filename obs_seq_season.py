@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Season (multi-day) obs-space diagnostics from the daily collated files.
+#
+# Every day is reduced to its statistics cube (obs_seq_cube):  read from the stats group of
+# files collated with --stats, computed from the obs otherwise (chunk by chunk with --chunk,
+# see obs_seq_chunks).  The days are reduced in a
+# pool of worker processes and their cubes merged as they come back, so only the season
+# cube and the cubes in flight are held, however many days there are.  Before merging, each
+# day's cube is put on the kind numbers of the season (by kind name) and its analysis
+# minutes are counted from the same time of day as the first day, so the statistics are
+# by time of day and height.  The season cube is written to a netCDF file of its own and
+# drawn with the daily plots (obs_seq_diag).
+#
+
+import os
+import sys
+import time
+import datetime as dtime
+from optparse import OptionParser
+from multiprocessing import Pool
+from functools import partial
+
+import numpy as np
+import netCDF4 as ncdf
+
+from obs_seq_load import obs_seq_load, obs_seq_load_cube, obs_seq_load_origin
+from obs_seq_cube import obs_seq_cube, obs_seq_cube_align, obs_seq_cube_merge
+from obs_seq_netcdf import obs_seq_nc_write_stats
+from obs_seq_diag import obs_seq_diagnostics
+from obs_seq_chunks import obs_seq_chunk_cube
+
+time_format = "%Y-%m-%d_%H:%M:%S"
+
+# Columns needed to build the cube of a file collated without --stats
+
+season_columns = ['kind', 'anal_min', 'height', 'dart_qc', 'innov', 'value', 'meanHxa', 'sdHxf', 'sdHxa']
+
+#=========================================================================================
+# Collated files prefix.YYYYMMDD.nc in directory for the days start to end (datetimes)
+#
+def obs_seq_season_files(directory, prefix, start, end):
+
+    files = []
+    day   = start
+
+    while day <= end:
+        file = os.path.join(directory, "%s.%s.nc" % (prefix, day.strftime("%Y%m%d")))
+        if os.path.exists(file):
+            files.append(file)
+        else:
+            print(" obs_seq_season:  no collated file for %s" % day.strftime("%Y%m%d"))
+        day = day + dtime.timedelta(days=1)
+
+    return files
+
+#-------------------------------------------------------------------------------
+# Partial aggregate of one day:  (file, cube, {kind name: kind number}, time origin).
+# With chunk, a day without a cube is read chunk rows at a time.
+#
+def obs_seq_season_day(filename, chunk=None):
+
+    cube, attrs = obs_seq_load_cube(filename)
+
+    if cube is None and chunk != None:
+        cube = obs_seq_chunk_cube(filename, rows=chunk)
+    elif cube is None:
+        df, attrs = obs_seq_load(filename, columns=season_columns)
+        cube = obs_seq_cube(df)
+        del df
+
+    kinds = dict((key, int(value)) for key, value in attrs.items() if isinstance(value, (int, np.integer)))
+
+    return filename, cube, kinds, obs_seq_load_origin(filename, attrs)
+
+#-------------------------------------------------------------------------------
+# Season cube of a list of collated files, reduced with workers processes.  Returns
+# (cube, {kind name: kind number}, time origin of anal_min).
+#
+def obs_seq_season(files, workers=1, chunk=None):
+
+    season = None
+    kinds  = {}
+    origin = None
+    reduce = partial(obs_seq_season_day, chunk=chunk)
+
+    if workers > 1 and len(files) > 1:
+        pool  = Pool(min(workers, len(files)))
+        days  = pool.imap(reduce, files, chunksize=1)
+    else:
+        pool  = None
+        days  = (reduce(file) for file in files)
+
+    try:
+        for filename, cube, day_kinds, day_origin in days:
+
+            print(" obs_seq_season:  adding %s" % filename)
+
+            # Time of day:  the minutes from the season origin to this day's origin, taken
+            # within +/- 12 hours
+
+            if origin == None:
+                origin = day_origin
+            shift = ((day_origin - origin).seconds / 60. + 720.) % 1440. - 720.
+
+            # Kind numbers of the season, by name
+
+            names   = dict((number, name) for name, number in day_kinds.items())
+            numbers = []
+            for number in cube['kind']:
+                name = names.get(int(number), "KIND_%d" % number)
+                if name not in kinds:
+                    if int(number) in kinds.values():
+                        kinds[name] = max(kinds.values()) + 1
+                    else:
+                        kinds[name] = int(number)
+                numbers.append(kinds[name])
+
+            season = obs_seq_cube_merge(season, obs_seq_cube_align(cube, numbers, shift))
+
+            del cube
+    finally:
+        if pool != None:
+            pool.close()
+            pool.join()
+
+    return season, kinds, origin
+
+#-------------------------------------------------------------------------------
+# Write the season cube to netcdf_file:  the kind attributes and time origin of a collated
+# file, the list of days, and the stats group
+#
+def obs_seq_season_write(netcdf_file, cube, kinds, origin, files):
+
+    fnc = ncdf.Dataset(netcdf_file, mode='w', format='NETCDF4')
+
+    fnc.history        = "Created " + dtime.datetime.today().strftime(time_format)
+    fnc.time_from_1800 = origin.strftime(time_format)
+    fnc.season_files   = "\n".join(files)
+
+    for name in kinds.keys():
+        fnc.setncattr(name, kinds[name])
+
+    obs_seq_nc_write_stats(fnc, cube)
+
+    fnc.close()
+
+#-------------------------------------------------------------------------------
+# Main function defined to return correct sys.exit() calls
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+# Command line interface definitions
+
+    parser = OptionParser()
+
+    parser.add_option("-d", "--dir",  dest="dir",  default="./", type="string", help = "directory of the daily collated files")
+    parser.add_option("-p", "--prefix", dest="prefix", default="obs_seq.final", type="string", help = "prefix of the daily collated files, default is obs_seq.final")
+    parser.add_option("--start", dest="start", default=None, type="string", help = "first day YYYYMMDD")
+    parser.add_option("--end",   dest="end",   default=None, type="string", help = "last day YYYYMMDD")
+    parser.add_option("-w", "--workers", dest="workers", default=1, type="int", help = "number of processes reducing the days")
+    parser.add_option("--chunk", dest="chunk", default=None, type="int", help = "read the days without a statistics cube in chunks of this many rows")
+    parser.add_option("-o", "--out", dest="out", default=None, type="string", help = "season netCDF file, default is prefix.START_END.nc")
+    parser.add_option("--images", dest="images", default="./", type="string", help = "full pathname where to put the images")
+    parser.add_option("--noplot", dest="plot", default=True, action="store_false", help = "only write the season file")
+    parser.add_option("--window", dest="window", default=45, type="int", help = "length of the time windows in minutes, default is 45")
+    parser.add_option("--stride", dest="stride", default=15, type="int", help = "minutes between the starts of the time windows, default is 15")
+    parser.add_option("--processes", dest="processes", default=None, type="int", help = "number of processes drawing the images, default is one per core")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.start == None or options.end == None:
+        print("\n                NO --start AND --end DAYS ARE SUPPLIED, EXITING.... \n ")
+        parser.print_help()
+        sys.exit(1)
+
+    start = dtime.datetime.strptime(options.start, "%Y%m%d")
+    end   = dtime.datetime.strptime(options.end, "%Y%m%d")
+    tag   = "%s_%s" % (options.start, options.end)
+
+    files = obs_seq_season_files(options.dir, options.prefix, start, end)
+
+    if len(files) == 0:
+        print("\n obs_seq_season:  no collated files between %s and %s, EXITING....\n" % (options.start, options.end))
+        sys.exit(1)
+
+    begin_time = time.time()
+
+    try:
+        cube, kinds, origin = obs_seq_season(files, workers=options.workers, chunk=options.chunk)
+    except ValueError as error:
+        print("\n obs_seq_season:  %s, EXITING....\n" % error)
+        sys.exit(1)
+
+    print("\n obs_seq_season:  %d days reduced in %5.2f sec" % (len(files), time.time() - begin_time))
+
+    if options.out == None:
+        netcdf_file = "%s.%s.nc" % (options.prefix, tag)
+    else:
+        netcdf_file = options.out
+
+    obs_seq_season_write(netcdf_file, cube, kinds, origin, files)
+
+    print(" obs_seq_season:  season statistics written to %s" % netcdf_file)
+
+    if options.plot:
+        obs_seq_diagnostics(netcdf_file, image_dir=options.images, window=options.window, stride=options.stride,
+                            processes=options.processes, tag=tag)
+
+#-------------------------------------------------------------------------------
+# Main program for testing...
+#
+if __name__ == "__main__":
+
+    sys.exit(main())
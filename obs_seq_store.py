@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Date/kind partitioned store of collated obs for multi-day archives.
+#
+#   store/catalog.json                      partitions, with their counts and time ranges
+#   store/YYYYMMDD/KIND_NAME/COLUMN.npy     one column of the obs of one kind on one day
+#
+# A partition holds the obs of one kind of one collated day, sorted by analysis time, one
+# .npy file per column (the dtype of the collated file, so --compact files give compact
+# partitions; the per-row kind name is the directory name and is not stored).  The catalog
+# lists every partition with its kind name and number, number of obs, anal_min range,
+# analysis time origin (time_from_1800) and first/last analysis times, so queries across
+# days choose their partitions from the catalog alone and only open the columns they need
+# of the partitions they keep (memory mapped).
+#
+# obs_seq_collate --store DIR adds (or replaces) the partitions of the day it writes;
+# obs_seq_store.py -s DIR -f FILE ... adds existing collated files.
+#
+
+import os
+import sys
+import json
+import shutil
+import datetime as dtime
+from optparse import OptionParser
+
+import numpy as np
+import pandas as pd
+
+from obs_seq_load import obs_seq_load, obs_seq_load_attrs, obs_seq_load_origin
+
+time_format = "%Y-%m-%d_%H:%M:%S"
+
+catalog_name = "catalog.json"
+
+#=========================================================================================
+# Catalog of a store:  a list of partition entries, [] for a new store
+#
+def obs_seq_store_catalog(store):
+
+    try:
+        f = open(os.path.join(store, catalog_name), 'r')
+        catalog = json.load(f)
+        f.close()
+        return catalog['partitions']
+    except (IOError, ValueError, KeyError):
+        return []
+
+def obs_seq_store_write_catalog(store, partitions):
+
+    partitions = sorted(partitions, key=lambda entry: (entry['date'], entry['kind']))
+
+    f = open(os.path.join(store, catalog_name + ".tmp"), 'w')
+    json.dump({'partitions': partitions}, f, indent=1)
+    f.close()
+
+    os.rename(os.path.join(store, catalog_name + ".tmp"), os.path.join(store, catalog_name))
+
+#-------------------------------------------------------------------------------
+# Add the obs of a collated file to the store, one partition per kind, replacing the
+# partitions the store already has for that day.  Returns the day's catalog entries.
+#
+def obs_seq_store_add(store, netcdf_file):
+
+    attrs  = obs_seq_load_attrs(netcdf_file)
+    origin = obs_seq_load_origin(netcdf_file, attrs)
+    date   = origin.strftime("%Y%m%d")
+    names  = dict((int(value), key) for key, value in attrs.items() if isinstance(value, (int, np.integer)))
+
+    # The day is written beside its old partitions and swapped in when complete
+
+    new_dir = os.path.join(store, date + ".tmp")
+    old_dir = os.path.join(store, date + ".old")
+    day_dir = os.path.join(store, date)
+
+    for path in [new_dir, old_dir]:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    os.makedirs(new_dir)
+
+    entries = []
+
+    for kind in np.unique(obs_seq_load(netcdf_file, columns=['kind'])[0]['kind'].values):
+
+        df   = obs_seq_load(netcdf_file, kinds=[int(kind)])[0]
+        df   = df.iloc[np.argsort(df['anal_min'].values, kind='mergesort')]
+        name = names.get(int(kind), "KIND_%d" % kind)
+        path = os.path.join(new_dir, name)
+
+        os.makedirs(path)
+
+        columns = [column for column in df.columns if column != 'name']
+        for column in columns:
+            np.save(os.path.join(path, column + ".npy"), np.ascontiguousarray(df[column].values))
+
+        amin = float(np.nanmin(df['anal_min'].values))
+        amax = float(np.nanmax(df['anal_min'].values))
+
+        entries.append({'date':           date,
+                        'kind':           name,
+                        'number':         int(kind),
+                        'nobs':           int(len(df)),
+                        'amin':           amin,
+                        'amax':           amax,
+                        'time_from_1800': origin.strftime(time_format),
+                        'first':          (origin + dtime.timedelta(minutes=amin)).strftime(time_format),
+                        'last':           (origin + dtime.timedelta(minutes=amax)).strftime(time_format),
+                        'path':           os.path.join(date, name),
+                        'columns':        columns})
+        del df
+
+    if os.path.exists(day_dir):
+        os.rename(day_dir, old_dir)
+    os.rename(new_dir, day_dir)
+
+    partitions = [entry for entry in obs_seq_store_catalog(store) if entry['date'] != date]
+    obs_seq_store_write_catalog(store, partitions + entries)
+
+    if os.path.exists(old_dir):
+        shutil.rmtree(old_dir)
+
+    print(" obs_seq_store:  %d kinds of %s added to %s" % (len(entries), date, store))
+
+    return entries
+
+#=========================================================================================
+# Catalog entries of the partitions that can hold obs of the given kind names (None for
+# all kinds) analysed between the datetimes start and end and, with hours=(h0, h1), between
+# h0 and h1 UTC (h1 < h0 wraps past midnight).  Nothing but the catalog is read.
+#
+def obs_seq_store_partitions(store, kinds=None, start=None, end=None, hours=None):
+
+    selected = []
+
+    for entry in obs_seq_store_catalog(store):
+
+        if kinds is not None and entry['kind'] not in kinds:
+            continue
+
+        first = dtime.datetime.strptime(entry['first'], time_format)
+        last  = dtime.datetime.strptime(entry['last'], time_format)
+
+        if start != None and last < start:
+            continue
+        if end != None and first > end:
+            continue
+        if hours != None and not obs_seq_store_hours(first, last, hours):
+            continue
+
+        selected.append(entry)
+
+    return selected
+
+#-------------------------------------------------------------------------------
+# True when the analysis times first..last reach the hours window (h0, h1)
+#
+def obs_seq_store_hours(first, last, hours):
+
+    if (last - first).total_seconds() >= 86400.:
+        return True
+
+    span = obs_seq_store_hour_of(first) + np.array([0., (last - first).total_seconds() / 3600.])
+
+    h0, h1 = float(hours[0]), float(hours[1])
+    if h1 < h0:
+        h1 = h1 + 24.
+
+    # Compare on two days, so windows and spans past midnight overlap where they should
+
+    return any([span[0] <= h1 + shift and span[1] >= h0 + shift for shift in [-24., 0., 24.]])
+
+def obs_seq_store_hour_of(time):
+
+    return time.hour + time.minute / 60. + time.second / 3600.
+
+#-------------------------------------------------------------------------------
+# Query the store:  the obs of the selected partitions (see obs_seq_store_partitions) as
+# one DataFrame with the given columns (None for all of them) plus "time", the analysis
+# time of every ob (time_from_1800 of its day + anal_min), the common time axis across
+# days.  The rows outside start/end/hours are dropped.
+#
+def obs_seq_store_query(store, kinds=None, start=None, end=None, hours=None, columns=None):
+
+    frames = []
+
+    for entry in obs_seq_store_partitions(store, kinds, start, end, hours):
+
+        path   = os.path.join(store, entry['path'])
+        origin = np.datetime64(dtime.datetime.strptime(entry['time_from_1800'], time_format), 's')
+
+        anal_min = np.load(os.path.join(path, "anal_min.npy"), mmap_mode='r')
+        time     = origin + (np.asarray(anal_min, dtype=np.float64) * 60.).astype('timedelta64[s]')
+
+        keep = np.ones(len(time), dtype=bool)
+        if start != None:
+            keep &= time >= np.datetime64(start, 's')
+        if end != None:
+            keep &= time <= np.datetime64(end, 's')
+        if hours != None:
+            hour = (time - time.astype('datetime64[D]')).astype(np.float64) / 3600.
+            h0, h1 = float(hours[0]), float(hours[1])
+            if h1 < h0:
+                keep &= (hour >= h0) | (hour <= h1)
+            else:
+                keep &= (hour >= h0) & (hour <= h1)
+
+        rows = np.nonzero(keep)[0]
+
+        if columns == None:
+            names = entry['columns']
+        else:
+            names = [name for name in columns if name in entry['columns']]
+
+        data = {}
+        for name in names:
+            data[name] = np.load(os.path.join(path, name + ".npy"), mmap_mode='r')[rows]
+        data['time'] = time[rows]
+
+        frames.append(pd.DataFrame(data, columns=names + ['time']))
+
+    if len(frames) == 0:
+        return pd.DataFrame(columns=(columns or []) + ['time'])
+
+    return pd.concat(frames, ignore_index=True)
+
+#-------------------------------------------------------------------------------
+# Main function defined to return correct sys.exit() calls
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+# Command line interface definitions
+
+    parser = OptionParser(usage="%prog -s STORE [-f obs_seq.final.YYYYMMDD.nc ...]")
+
+    parser.add_option("-s", "--store", dest="store", default=None, type="string", help = "directory of the store")
+    parser.add_option("-f", "--file",  dest="files", default=[], action="append", help = "collated file to add (repeat for more files)")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.store == None:
+        print("\n                NO STORE DIRECTORY IS SUPPLIED, EXITING.... \n ")
+        parser.print_help()
+        sys.exit(1)
+
+    if not os.path.isdir(options.store):
+        os.makedirs(options.store)
+
+    for file in options.files + args:
+        try:
+            obs_seq_store_add(options.store, file)
+        except ValueError as error:
+            print(" obs_seq_store:  cannot add %s:  %s" % (file, error))
+
+    partitions = obs_seq_store_catalog(options.store)
+    dates      = sorted(set([entry['date'] for entry in partitions]))
+
+    print(" obs_seq_store:  %d partitions, %d days, %d obs in %s" %
+          (len(partitions), len(dates), sum([entry['nobs'] for entry in partitions]), options.store))
+
+#-------------------------------------------------------------------------------
+# Main program for testing...
+#
+if __name__ == "__main__":
+
+    sys.exit(main())
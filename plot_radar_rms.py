@@ -3,7 +3,7 @@ import pandas as pd
 import numpy as np
 from netcdftime import utime
 import matplotlib.pyplot as plt
-import sys, os, glob
+import sys, os, glob, re
 from optparse import OptionParser
 import datetime as dtime
 import xarray as xr
@@ -13,6 +13,11 @@ import matplotlib.cm as cm
 import matplotlib.ticker as ticker
 import matplotlib.dates as mdates
 from pltbook import nice_mxmnintvl, nice_clevels
+from obs_seq_load import obs_seq_load, obs_seq_load_diag, obs_seq_load_select
+from obs_seq_cube import obs_seq_cube_2D_stats
+from obs_seq_bins import obs_seq_2D_stats, obs_seq_time_windows
+from obs_seq_render import obs_seq_render_job
+from obs_seq_chunks import obs_seq_chunk_2D_stats
 
 time_format = "%Y-%m-%d_%H:%M:%S"
 day_utime   = utime("days since 1601-01-01 00:00:00")
@@ -34,29 +39,34 @@ mpl.rcParams['figure.figsize'] = (12,10)
 
 _obs_error = [7.5, 3.0]
 
-# Create 15 min bins for a 9 hour period (9x4=36).  Each bin will average for analysis times
-time_bins = [ (15*t,15*(t+3)) for t in range(36)]
-
 # Create uneven height bins because of MRMS and other radar scans.
 height_bins = [(0.0, 1000.), (1000., 2000.), (2000., 3000.), (3000., 4000.), 
                (4000., 5000.), (5000., 6000.), (7000.,8000.), (8000.,9000.), (9000.,10000.)]
 
 #-------------------------------------------------------------------------------
+# Read the collated file through obs_seq_load:  only the listed columns (default all) and
+# only the rows of the listed kinds (default all) are read.
 #
-def obs_seq_read_netcdf(filename, retFileAttr = False):
+def obs_seq_read_netcdf(filename, retFileAttr = False, columns=None, kinds=None):
+    dataset, attrs = obs_seq_load(filename, columns=columns, kinds=kinds)
     if retFileAttr == False:
-        try:
-            return xr.open_dataset(filename).to_dataframe()
-        except IOError:
-            print(" \n ----> netCDF obs_seq_final file not found! \n")
-            sys.exit(-1)
+        return dataset
     else:
-        try:
-            xa = xr.open_dataset(filename)
-            return xa.to_dataframe(), xa.attrs
-        except IOError:
-            print(" \n ----> netCDF obs_seq_final file not found! \n")
-            sys.exit(-1)
+        return dataset, attrs
+
+#-------------------------------------------------------------------------------
+# Time origin of anal_min (the first analysis time), from the time_from_1800 file attribute
+# or the datetime64 anal_time column.  Files collated before anal_time was a real time
+# column fall back to an 18Z origin.
+#
+def obs_seq_time_origin(df, attrs={}):
+    if 'time_from_1800' in attrs:
+        return dtime.datetime.strptime(attrs['time_from_1800'], time_format)
+    try:
+        origin = df['anal_time'] - pd.to_timedelta(df['anal_min'], unit='m')
+        return origin.min().to_pydatetime()
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
 
 #-------------------------------------------------------------------------------
 #
@@ -74,75 +84,23 @@ def obs_seq_get_obtype(df, kind=None, name=None):
     sys.exit(-1)
     
 #-------------------------------------------------------------------------------
+# Time-height bins of the root mean square of variable, the mean prior spread and the number of obs.
+# Uses the single-pass np.bincount engine in obs_seq_bins (same bins and the same
+# dart_qc / threshold selection as the old DataFrame.query loops).
 #
 def obs_seq_2D_bin(df, variable, time=None, height=None, threshold=None, dart_qc=True):
-    
-    # Create the data structures needed for bin information
-    
-    fbins    = np.zeros((len(height),len(time)))
-    bins     = np.zeros((len(height),len(time)))
-    spread   = np.zeros((len(height),len(time)))
-
-    num_obs = np.zeros((len(height),len(time)))
-    min      = []
-    hgt      = []
-
-    for n, t in enumerate(time):
-        
-        # Create coordinate list for time in minutes
-        min.append(t[0])
-        
-        # This string is used to bin data in time
-        time_string = '%d <= anal_min <= %d' % (t[0], t[1])
-
-        # Pandas dataframe query:  This query string returns a new dataframe with only those
-        # rows that match the string.
-        cut0_df = df.query(time_string)
-
-        for m, z in enumerate(height):
-            
-            # This string is used to bin data in height
-            height_string = '%f < height <= %f' % (z[0], z[1])
-
-            # Pandas dataframe query:  This query string returns a new dataframe with only those
-            # rows that match the string.
-            cut1_df = cut0_df.query(height_string)
-
-            # Create coordinate list for heights
-            if n == 0:
-                hgt.append(0.5*(z[0]+z[1]))
-
-            # Remove all DART_QC indices != 0.0 because those are the only ones assimilated...
-            if dart_qc:
-                cut2_df = cut1_df.query("dart_qc < 0.1")
-            else:
-                cut2_df = cut1_df
-                
-            if threshold != None:  # threshold is a string, like "heights > 2000." 
-                cut3_df      = cut2_df.query(threshold)    
-                bins[m,n]    = np.sqrt((cut3_df[variable]**2).mean())
-                spread[m,n]  = cut3_df['sdHxf'].mean()
-                num_obs[m,n] = np.sum(cut3_df[variable] != 0.0)
-            else:
-                bins[m,n]    = np.sqrt((cut2_df[variable]**2).mean())
-                spread[m,n]  = cut2_df['sdHxf'].mean()
-                num_obs[m,n] = np.sum(cut2_df[variable] != 0.0)
-
-    if threshold != None:
-        del cut0_df, cut1_df, cut2_df, cut3_df
-    else:
-        del cut0_df, cut1_df, cut2_df
 
-        
-    return {'spread': spread, 'bin2d': bins, 'num_obs': num_obs,  
-            'mins': np.array(min), 'hgts': np.array(hgt)}
+    return obs_seq_2D_stats(df, variable, time=time, height=height, threshold=threshold,
+                            dart_qc=dart_qc, statistic="rms")
 
 #-------------------------------------------------------------------------------
 #
 
-def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior", obs_error=7.5):
+def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior", obs_error=7.5, time_from=None, fig=None):
     
-    fig = plt.figure(figsize=(12,12))
+    if fig == None:
+        fig = plt.figure(figsize=(12,12))
+
     fig.text(0.68, 0.75, "\nBlack Line: RMSI\nBlue Line: %s Spread\nRed:  10*Consist Ratio\nGreen: # of obs" % ptype, 
              size=16, va="baseline", ha="left", multialignment="left")
     
@@ -160,13 +118,16 @@ def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior
     num_obs  = np.ma.masked_invalid(data_dict['num_obs'])
     
     datebins = []
-    minutes_from = dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
+    if time_from != None:
+        minutes_from = time_from
+    else:
+        minutes_from = dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
     for min in anal_min:
         datebins.append(minutes_from + dtime.timedelta(0,int(min)*60))
         
     # 2D plot
     
-    axC = plt.axes(rectC)
+    axC = fig.add_axes(rectC)
 
     if auto_clevels:
         cmin, cmax, cint, clevels = nice_clevels(-30, 30, outside=False, cint = 5.0)
@@ -200,7 +161,7 @@ def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior
     
     # 1D time series plot
     
-    axX = plt.axes(rectX)
+    axX = fig.add_axes(rectX)
     time_data   = data.mean(axis=0)
     time_spread = spread.mean(axis=0)
     time_consist= 10*(time_spread**2 + obs_error**2) / (time_data**2)
@@ -230,7 +191,7 @@ def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior
      
     # 1D Height Plotting Plotting
 
-    axY           = plt.axes(rectY)
+    axY           = fig.add_axes(rectY)
     height_data   = data.mean(axis=1)
     height_spread = spread.mean(axis=1)
     height_consist= (height_spread**2 + obs_error**2) / (height_data**2)
@@ -260,6 +221,102 @@ def obs_seq_TimeHeightRMS(data_dict, plotlabel=None, otype="RMS", ptype = "Prior
 
     axY.grid(True)
 
+#-------------------------------------------------------------------------------
+# Statistics of the time-height RMS plot of one radar variable (REF or VR) of a
+# collated file, as an obs_seq_render job.  data is an optional obs_seq_load_diag
+# dictionary shared by several plots of the same file (see obs_seq_diag), so the file
+# is only read once.  With chunk (rows) the obs are binned out of core, chunk by chunk with
+# up to workers processes (obs_seq_chunks).
+#
+def obs_seq_radar_rms_job(filename, var="REF", image_dir="./", plotfilename=None, thres=None, window=45, stride=15,
+                          raw=False, data=None, chunk=None, workers=1):
+
+    # Get the radar variable out of file  fileAttrs has a dictionary for the DART ob type kinds
+    
+    if var == "VR":
+        kind_name = 'DOPPLER_RADIAL_VELOCITY'
+        _cmin, _cmax, _cinc = -15., 15., 1.0
+        obs_error = _obs_error[1]
+    else:
+        kind_name = 'RADAR_REFLECTIVITY'
+        obs_error = _obs_error[0]
+
+    # Statistics straight from the cube written by obs_seq_collate --stats when the file has
+    # one, otherwise (or with a threshold, which needs the obs) binned from the obs of that
+    # kind - only the columns the binning and threshold use are read
+
+    columns = ['kind', 'anal_min', 'height', 'dart_qc', 'innov', 'sdHxf']
+    if thres != None:
+        columns = columns + re.findall(r"[A-Za-z_]\w*", thres)
+
+    if data == None:
+        data = obs_seq_load_diag(filename, columns=columns, kinds=[kind_name], raw=raw, obs=chunk == None)
+
+    fileAttrs    = data['attrs']
+    time_windows = obs_seq_time_windows(window, stride)
+    data_dict    = None
+    dataset      = None
+
+    if thres == None and not raw and data['cube'] != None and kind_name in fileAttrs:
+        data_dict = obs_seq_cube_2D_stats(data['cube'], 'innov', time=time_windows, height=height_bins,
+                                          kinds=[fileAttrs[kind_name]], statistic="rms")
+
+    if data_dict == None and chunk != None:
+        data_dict = obs_seq_chunk_2D_stats(filename, 'innov', time=time_windows, height=height_bins,
+                                           kinds=[fileAttrs[kind_name]], threshold=thres, statistic="rms",
+                                           rows=chunk, workers=workers)
+
+    if data_dict == None:
+        dataset   = obs_seq_load_select(data, columns, [kind_name])
+        kind      = fileAttrs[kind_name]
+        field     = obs_seq_get_obtype(dataset, kind=kind)
+        data_dict = obs_seq_2D_bin(field, 'innov', time=time_windows, height=height_bins, threshold=thres)
+
+    time_from = obs_seq_time_origin(dataset, fileAttrs)
+
+    # Construct a output pdf filename
+   
+    if plotfilename == None:
+        file = os.path.split(filename)[-1]
+        day  = os.path.splitext(file)[0][-8:]
+        file_time = dtime.datetime.strptime(day, "%Y%m%d")
+        if file.find("obs") > 0:
+            plotfilename = "%s/%s_%sRMS_%s" % (image_dir, var, file[0:file.find("obs")], day)
+        else:
+            plotfilename = "%s/%s_RMS_%s" % (image_dir, var, day)
+
+        plotlabel = "REALTIME\nOBTYPE: %s" % (var)
+
+    else:
+        plotlabel    = "%s\nDART QC ON" % (var)
+        
+    if thres != None:
+        plotlabel = "%s\nDART QC ON\n%s" % (plotlabel, thres)
+        
+    return {'product': 'radar_rms', 'kind': var, 'stats': data_dict, 'output': plotfilename+".png",
+            'options': {'plotlabel': plotlabel, 'ptype': "Prior", 'obs_error': obs_error, 'time_from': time_from}}
+
+#-------------------------------------------------------------------------------
+# Draw the plot of obs_seq_radar_rms_job into its png (on the Agg canvas, or through
+# pyplot with show=True).  Returns the png file name.
+#
+def obs_seq_radar_rms(filename, var="REF", image_dir="./", plotfilename=None, thres=None, window=45, stride=15,
+                      raw=False, show=False, data=None, chunk=None, workers=1):
+
+    job = obs_seq_radar_rms_job(filename, var=var, image_dir=image_dir, plotfilename=plotfilename, thres=thres,
+                                window=window, stride=stride, raw=raw, data=data,
+                                chunk=chunk, workers=workers)
+
+    if not show:
+        return obs_seq_render_job(job)
+
+    obs_seq_TimeHeightRMS(job['stats'], **job['options'])
+    plt.savefig(job['output'])
+    plt.show()
+    plt.close()
+
+    return job['output']
+
 #=========================================================================================
 # Plot the innovations from an obs_seq_file.nc file created by dart_cc.py
 #-------------------------------------------------------------------------------
@@ -284,8 +341,13 @@ def main(argv=None):
                                          
     parser.add_option(       "--thres", dest="thres", default=None, help="use this to threshold calculations using an obs floor")
     parser.add_option("--dir",  dest="dir",  default="./", type="string", help = "full pathname where to put image")
+    parser.add_option("--window", dest="window", default=45, type="int", help = "length of the time windows in minutes, default is 45")
+    parser.add_option("--stride", dest="stride", default=15, type="int", help = "minutes between the starts of the time windows, default is 15")
+    parser.add_option("--raw", dest="raw", default=False, action="store_true", help = "bin the obs even when the file has a statistics cube")
+    parser.add_option("--chunk", dest="chunk", default=None, type="int", help = "bin the obs out of core in chunks of this many rows")
+    parser.add_option("--workers", dest="workers", default=1, type="int", help = "number of processes binning the chunks, default is 1")
 
-    (options, args) = parser.parse_args()
+    (options, args) = parser.parse_args(argv[1:])
     
     if options.file == None:
 
@@ -294,54 +356,10 @@ def main(argv=None):
         print
         sys.exit(1)
 
-    # Read in the data
-    dataset, fileAttrs = obs_seq_read_netcdf(options.file, retFileAttr = True)
-    
-    # Get the radar variable out of file  fileAttrs has a dictionary for the DART ob type kinds
-    
-    if options.var == "VR":
-        kind = fileAttrs['DOPPLER_RADIAL_VELOCITY']
-        _cmin, _cmax, _cinc = -15., 15., 1.0
-        obs_error = _obs_error[1]
-    else:
-        kind = fileAttrs['RADAR_REFLECTIVITY']
-        obs_error = _obs_error[0]
-   
-    field = obs_seq_get_obtype(dataset, kind=kind)
-
-    # Construct a output pdf filename
-   
-    if options.plotfilename == None:
-        file = os.path.split(options.file)[-1]
-        file_time = dtime.datetime.strptime(file[-11:-3], "%Y%m%d")
-        if file.find("obs") > 0:
-            plotfilename = "%s/%s_%sRMS_%s" % (options.dir, options.var, file[0:file.find("obs")], file[-11:-3])
-        else:
-            plotfilename = "%s/%s_RMS_%s" % (options.dir, options.var, file[-11:-3])
-
-        plotlabel = "REALTIME\nOBTYPE: %s" % (options.var)
-
-    else:
-        plotfilename = options.plotfilename
-        plotlabel    = "%s\nDART QC ON" % (options.var)
-        
-    if options.thres != None:
-        plotlabel = "%s\nDART QC ON\n%s" % (plotlabel, options.thres)
-        
-#   Bin data
-    data_dict = obs_seq_2D_bin(field, 'innov', time=time_bins, height=height_bins, threshold=options.thres)
-    
-#   Plot data
-    if options.file.find("final") != 0: 
-        obs_seq_TimeHeightRMS(data_dict, plotlabel=plotlabel, ptype="Prior", obs_error=obs_error)
-    else:
-        obs_seq_TimeHeightRMS(data_dict, plotlabel=plotlabel, obs_error=obs_error)
-    
-#   Saving and plotting
-    plt.savefig(plotfilename+".png")
-    
-    if options.show:
-        plt.show()
+    obs_seq_radar_rms(options.file, var=options.var, image_dir=options.dir, plotfilename=options.plotfilename,
+                      thres=options.thres, window=options.window, stride=options.stride,
+                      raw=options.raw, show=options.show, chunk=options.chunk,
+                      workers=options.workers)
 
 #-------------------------------------------------------------------------------
 # Main program for testing...
@@ -0,0 +1,440 @@
+#!/usr/bin/env python
+# coding: utf-8
+#
+# Rank histograms (Talagrand diagrams) of the ensemble members kept by obs_seq_collate
+# --copies.
+#
+# Every ob is ranked against the prior (or posterior) member values of its row of the
+# copies matrix:  its rank is the number of members below it, 0 ... N for N members, and
+# for a reliable ensemble the ranks are uniform.  The ranks of a whole chunk of obs are
+# found at once by comparing the obs column with the member matrix, ties (e.g. 0 dBZ
+# reflectivity against members that are all 0 dBZ) are split at random over the ranks they
+# span, and with perturb the members are first perturbed with the obs error (N(0, error
+# variance)) so the spread is compared with the innovations the filter sees.  The ranks
+# are then counted for every kind, time window and height bin with one np.bincount (the
+# bins of obs_seq_bins), chunk by chunk with up to workers processes (obs_seq_chunks), so
+# memory depends on the chunk size and not on the size of the day.
+#
+# The counts are written to a netCDF file (RANK_YYYYMMDD.nc) and every kind with obs gets
+# a plot (RANK_KIND_YYYYMMDD.png):  the histogram of the day, the fraction of obs outside
+# the ensemble in every time-height bin, and the histogram of every height bin.  obs_seq_diag
+# draws them with the other plots of the day when the file has member copies.
+#
+
+import sys, os
+import datetime as dtime
+from optparse import OptionParser
+from functools import partial
+
+import numpy as np
+import netCDF4 as ncdf
+import matplotlib.pyplot as plt
+import matplotlib.cm as cm
+import matplotlib.dates as mdates
+import matplotlib.ticker as ticker
+
+from obs_seq_load import obs_seq_load_attrs, obs_seq_load_copies, obs_seq_load_copy_names
+from obs_seq_bins import obs_seq_bin_pairs, obs_seq_query_bins, obs_seq_time_windows, obs_seq_bin_mean
+from obs_seq_chunks import obs_seq_chunk_ranges, obs_seq_chunk_map, chunk_rows
+from obs_seq_render import obs_seq_render
+
+time_format = "%Y-%m-%d_%H:%M:%S"
+
+# 1 km height bins up to 10 km
+
+rank_height_bins = [(1000.*z, 1000.*(z+1)) for z in range(10)]
+
+# Columns read with the member copies
+
+rank_columns = ['kind', 'anal_min', 'height', 'dart_qc', 'value', 'error_variance']
+
+# DART missing value of the forward operators
+
+_missing = -888887.
+
+#=========================================================================================
+# Columns of the copies matrix holding the ensemble members ("prior ensemble member   1",
+# ..., or the posterior ones with members="posterior"), from the copy names
+#
+def obs_seq_rank_members(copy_names, members="prior"):
+
+    prefix = "%s ensemble member" % members
+
+    return [n for n, name in enumerate(copy_names) if name.strip().startswith(prefix)]
+
+#-------------------------------------------------------------------------------
+# Rank of every ob among its members:  obs (nobs), ens (nobs x N), both float32.  Ties
+# are given a random rank within the ranks they span.  With error_sd (nobs) the members
+# are perturbed with N(0, error_sd) first.  Returns int32 ranks 0 ... N.
+#
+def obs_seq_ranks(obs, ens, error_sd=None, rng=None):
+
+    if rng == None:
+        rng = np.random.RandomState(0)
+
+    if error_sd is not None:
+        noise = rng.standard_normal(ens.shape).astype(np.float32)
+        ens   = ens + noise * np.asarray(error_sd, dtype=np.float32)[:, np.newaxis]
+        del noise
+
+    y     = np.asarray(obs, dtype=np.float32)[:, np.newaxis]
+    below = np.count_nonzero(ens < y, axis=1)
+    ties  = np.count_nonzero(ens == y, axis=1)
+
+    return (below + np.floor(rng.random_sample(len(below)) * (ties + 1))).astype(np.int32)
+
+#-------------------------------------------------------------------------------
+# Rank counts of one chunk of a collated file (start, stop), for obs_seq_chunk_map (see
+# obs_seq_rank_counts; kinds are the kind numbers of the file, columns the member copies)
+#
+def obs_seq_rank_chunk(chunk, filename, kinds, columns, time, height, perturb=False, dart_qc=True, seed=0):
+
+    start, stop = chunk
+
+    df, copies, attrs = obs_seq_load_copies(filename, columns=rank_columns, start=start, stop=stop)
+
+    # The members are usually consecutive copies, taken as a view.  NaN and the DART
+    # missing value both fail "> _missing".
+
+    if columns == list(range(columns[0], columns[-1] + 1)):
+        ens = copies[:, columns[0]:columns[-1] + 1]
+    else:
+        ens = copies[:, columns]
+    del copies
+
+    obs  = df['value'].values.astype(np.float32)
+    keep = (obs > _missing) & np.all(ens > _missing, axis=1) & np.isin(df['kind'].values, kinds)
+
+    if dart_qc:
+        keep &= df['dart_qc'].values < 0.1
+
+    if not keep.all():
+        df, obs, ens = df[keep], obs[keep], ens[keep]
+
+    if perturb:
+        error_sd = np.sqrt(np.maximum(df['error_variance'].values, 0.0))
+    else:
+        error_sd = None
+
+    rng   = np.random.RandomState((seed + (start or 0)) % 2**32)
+    ranks = obs_seq_ranks(obs, ens, error_sd, rng)
+    del ens
+
+    return obs_seq_rank_counts(ranks, np.searchsorted(kinds, df['kind'].values), df['anal_min'].values,
+                               df['height'].values, len(kinds), len(columns) + 1, time, height)
+
+#-------------------------------------------------------------------------------
+# Count the ranks (0 ... nrank-1) of obs of kind index kind (0 ... nkind-1).  Returns
+# the (kind, level, time, rank) counts of the time-height bins, the (kind, level, rank)
+# counts of the height bins and the (kind, rank) counts of all the obs.
+#
+def obs_seq_rank_counts(ranks, kind, anal_min, height, nkind, nrank, time, height_bins):
+
+    time_q, height_q = obs_seq_query_bins(time, height_bins)
+
+    nz, nt = len(height_bins), len(time)
+
+    zrows, zbin = obs_seq_bin_pairs(height, height_q, lo_closed=False)
+    trows, tbin = obs_seq_bin_pairs(anal_min[zrows], time_q)
+
+    rows = zrows[trows]
+    cell = ((kind[rows] * nz + zbin[trows]) * nt + tbin) * nrank + ranks[rows]
+
+    counts = np.bincount(cell, minlength=nkind*nz*nt*nrank).reshape(nkind, nz, nt, nrank)
+    level  = np.bincount((kind[zrows] * nz + zbin) * nrank + ranks[zrows],
+                         minlength=nkind*nz*nrank).reshape(nkind, nz, nrank)
+    total  = np.bincount(kind * nrank + ranks, minlength=nkind*nrank).reshape(nkind, nrank)
+
+    return counts, level, total
+
+#=========================================================================================
+# Rank histograms of a collated file with member copies.  Returns a dictionary:
+#
+#   kind, names     kind numbers and names that have ranked obs
+#   counts          (kind, level, time, rank) counts in the time windows and height bins
+#   level           (kind, level, rank) counts in the height bins
+#   total           (kind, rank) counts of all the obs of each kind
+#   mins, hgts      window start times and mid heights, height_lo/height_hi the bins
+#   members         names of the member copies
+#   window, perturb the options used
+#   time_from_1800  the time origin of anal_min
+#
+# or None when the file has no member copies.  The obs are read chunk rows at a time, by
+# up to workers processes.
+#
+def obs_seq_rank_hist(filename, window=45, stride=15, height=rank_height_bins, members="prior", perturb=False,
+                      dart_qc=True, rows=chunk_rows, workers=1, seed=0):
+
+    attrs      = obs_seq_load_attrs(filename)
+    copy_names = obs_seq_load_copy_names(attrs)
+    columns    = obs_seq_rank_members(copy_names, members)
+
+    if len(columns) == 0:
+        print(" obs_seq_rank_hist:  no %s ensemble member copies in %s" % (members, filename))
+        return None
+
+    names = dict((int(value), key) for key, value in attrs.items() if isinstance(value, (int, np.integer)))
+    kinds = np.array(sorted(names.keys()), dtype=np.int64)
+    time  = obs_seq_time_windows(window, stride)
+    nrank = len(columns) + 1
+
+    count = partial(obs_seq_rank_chunk, filename=filename, kinds=kinds, columns=columns, time=time,
+                    height=height, perturb=perturb, dart_qc=dart_qc, seed=seed)
+
+    counts = np.zeros((len(kinds), len(height), len(time), nrank), dtype=np.int64)
+    level  = np.zeros((len(kinds), len(height), nrank), dtype=np.int64)
+    total  = np.zeros((len(kinds), nrank), dtype=np.int64)
+
+    for chunk_counts, chunk_level, chunk_total in obs_seq_chunk_map(count, obs_seq_chunk_ranges(filename, rows=rows),
+                                                                    workers):
+        counts += chunk_counts
+        level  += chunk_level
+        total  += chunk_total
+
+    found = np.nonzero(total.sum(axis=1) > 0)[0]
+
+    return {'kind':           kinds[found],
+            'names':          [names[int(kinds[k])] for k in found],
+            'counts':         counts[found],
+            'level':          level[found],
+            'total':          total[found],
+            'mins':           np.array([t[0] for t in time]),
+            'hgts':           np.array([0.5*(z[0]+z[1]) for z in height]),
+            'height_lo':      np.array([z[0] for z in height]),
+            'height_hi':      np.array([z[1] for z in height]),
+            'members':        [copy_names[n] for n in columns],
+            'window':         window,
+            'perturb':        perturb,
+            'time_from_1800': attrs['time_from_1800']}
+
+#-------------------------------------------------------------------------------
+# Write the rank histograms to netcdf_file
+#
+def obs_seq_rank_write(netcdf_file, hist):
+
+    fnc = ncdf.Dataset(netcdf_file, mode='w', format='NETCDF4')
+
+    fnc.history        = "Created " + dtime.datetime.today().strftime(time_format)
+    fnc.time_from_1800 = hist['time_from_1800']
+    fnc.members        = "\n".join(hist['members'])
+    fnc.window         = int(hist['window'])
+    fnc.perturbed      = int(hist['perturb'])
+
+    for number, name in zip(hist['kind'], hist['names']):
+        fnc.setncattr(name, int(number))
+
+    nkind, nz, nt, nrank = hist['counts'].shape
+
+    fnc.createDimension('kind', nkind)
+    fnc.createDimension('level', nz)
+    fnc.createDimension('time', nt)
+    fnc.createDimension('rank', nrank)
+
+    fnc.createVariable('kind', 'i4', ('kind',))[:]         = hist['kind']
+    fnc.createVariable('anal_min', 'f8', ('time',))[:]     = hist['mins']
+    fnc.createVariable('height_lo', 'f8', ('level',))[:]   = hist['height_lo']
+    fnc.createVariable('height_hi', 'f8', ('level',))[:]   = hist['height_hi']
+
+    var = fnc.createVariable('counts', 'i8', ('kind', 'level', 'time', 'rank'), zlib=True)
+    var.long_name = "number of obs of each rank in the time windows starting at anal_min and the height bins"
+    var[:] = hist['counts']
+
+    var = fnc.createVariable('level', 'i8', ('kind', 'level', 'rank'))
+    var.long_name = "number of obs of each rank in the height bins, all times"
+    var[:] = hist['level']
+
+    var = fnc.createVariable('total', 'i8', ('kind', 'rank'))
+    var.long_name = "number of obs of each rank, all times and heights"
+    var[:] = hist['total']
+
+    fnc.close()
+
+#=========================================================================================
+# Statistics of the plot of one kind (index k of hist):  relative frequencies of the
+# ranks (1 for a uniform histogram) over the day and in every height bin, and the
+# fraction of obs outside the ensemble in every time-height bin.  The cells of the time
+# windows run from the start of each window to the start of the next one.
+#
+def obs_seq_rank_stats(hist, k):
+
+    counts = np.asarray(hist['counts'][k], dtype=np.float64)
+    level  = np.asarray(hist['level'][k], dtype=np.float64)
+    total  = np.asarray(hist['total'][k], dtype=np.float64)
+    nrank  = len(total)
+
+    num_obs = counts.sum(axis=2)
+
+    mins   = np.asarray(hist['mins'], dtype=np.float64)
+    stride = mins[1] - mins[0] if len(mins) > 1 else hist['window']
+
+    return {'freq':    nrank * obs_seq_bin_mean(total, total.sum()),
+            'level':   nrank * obs_seq_bin_mean(level, level.sum(axis=1)[:, np.newaxis]),
+            'outside': obs_seq_bin_mean(counts[:, :, 0] + counts[:, :, -1], num_obs),
+            'num_obs': num_obs,
+            'nobs':    int(total.sum()),
+            'mins':    hist['mins'],
+            'hgts':    hist['hgts'],
+            'tedges':  np.append(mins, mins[-1] + stride),
+            'zedges':  np.append(hist['height_lo'], hist['height_hi'][-1])}
+
+#-------------------------------------------------------------------------------
+# Draw the rank histogram plot of one kind (stats from obs_seq_rank_stats)
+#
+def obs_seq_RankHist(stats, plotlabel=None, time_from=None, fig=None):
+
+    if fig == None:
+        fig = plt.figure(figsize=(12,12))
+
+    nrank = len(stats['freq'])
+
+    fig.text(0.72, 0.78, "\n\nRank Histogram\n%d members, %d obs\nBars = frequency / uniform\nOutside = rank 0 or %d\n(uniform:  %4.2f)"
+             % (nrank - 1, stats['nobs'], nrank - 1, 2. / nrank),
+             size=14, va="baseline", ha="left", multialignment="left")
+
+    if plotlabel != None:
+        fig.text(0.72, 0.70, plotlabel, size=12, va="baseline", ha="left", multialignment="left")
+
+    # Histogram of the day
+
+    axH = fig.add_axes([0.1, 0.62, 0.55, 0.3])
+    axH.bar(np.arange(nrank), stats['freq'], width=0.9, color='0.6', edgecolor='k')
+    axH.axhline(1.0, color='r', ls='--', lw=1.5)
+    axH.set_xlim(-0.5, nrank - 0.5)
+    axH.xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+    axH.set_ylim(0.0, max(2.0, 1.1 * np.nanmax(stats['freq']) if nrank > 0 else 2.0))
+    axH.set_xlabel("Rank of the ob among the members")
+    axH.set_ylabel("Frequency / uniform")
+    axH.grid(True, axis='y')
+
+    # Fraction of the obs outside the ensemble, time-height
+
+    if time_from == None:
+        time_from = dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
+
+    datebins = [time_from + dtime.timedelta(0, int(t)*60) for t in stats['tedges']]
+    z        = stats['zedges'] / 1000.
+    outside  = np.ma.masked_invalid(stats['outside'])
+
+    axC = fig.add_axes([0.1, 0.1, 0.55, 0.42])
+    cs  = axC.pcolormesh(mdates.date2num(datebins), z, outside, cmap=cm.get_cmap('YlOrRd'), vmin=0.0, vmax=1.0)
+    fig.colorbar(cs, ax=axC, orientation='horizontal', pad=0.15, fraction=0.05, label="Fraction outside the ensemble")
+
+    axC.xaxis_date()
+    axC.set_xlim(datebins[0], datebins[-1])
+    axC.xaxis.set_major_locator(mdates.HourLocator())
+    axC.xaxis.set_minor_locator(mdates.MinuteLocator(byminute=[0, 15, 30, 45]))
+    axC.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    for label in axC.get_xticklabels():
+        label.set_rotation(40)
+        label.set_fontsize(10)
+    axC.set_ylabel("Height (km)")
+    axC.set_xlabel("Time")
+
+    # Histogram of every height bin
+
+    axY = fig.add_axes([0.72, 0.1, 0.22, 0.42])
+    cs  = axY.pcolormesh(np.arange(nrank + 1) - 0.5, z, np.ma.masked_invalid(stats['level']), cmap=cm.get_cmap('RdBu_r'),
+                         vmin=0.0, vmax=2.0)
+    fig.colorbar(cs, ax=axY, orientation='horizontal', pad=0.15, fraction=0.05, label="Frequency / uniform")
+    axY.xaxis.set_major_locator(ticker.MaxNLocator(integer=True))
+    axY.set_xlabel("Rank")
+    axY.set_yticklabels([])
+
+#-------------------------------------------------------------------------------
+# obs_seq_render jobs of the kinds of hist that have obs:  images named
+# RANK_<kind name>_<day> in image_dir, or <plotfilename>_<kind name> when one is given
+#
+def obs_seq_rank_jobs(hist, filename, image_dir="./", plotfilename=None, plotlabel=None):
+
+    time_from = dtime.datetime.strptime(hist['time_from_1800'], time_format)
+    file      = os.path.split(filename)[-1]
+    day       = os.path.splitext(file)[0][-8:]
+
+    jobs = []
+
+    for k, name in enumerate(hist['names']):
+
+        if plotfilename == None:
+            output = "%s/RANK_%s_%s" % (image_dir, name, day)
+        else:
+            output = "%s_%s" % (plotfilename, name)
+
+        label = "%s\nOBTYPE: %s" % (plotlabel or "REALTIME: %s" % day, name)
+        if hist['perturb']:
+            label = label + "\nMembers + obs error"
+
+        jobs.append({'product': 'rank_hist', 'kind': name, 'stats': obs_seq_rank_stats(hist, k),
+                     'output': output + ".png",
+                     'options': {'plotlabel': label, 'time_from': time_from}})
+
+    return jobs
+
+#-------------------------------------------------------------------------------
+# Rank histograms of a collated file:  computed, written to the data file (default
+# RANK_YYYYMMDD.nc in image_dir) and returned as obs_seq_render jobs ([] when the file has
+# no member copies)
+#
+def obs_seq_rank_hist_jobs(filename, image_dir="./", plotfilename=None, plotlabel=None, window=45, stride=15,
+                           members="prior", perturb=False, out=None, rows=chunk_rows, workers=1, seed=0):
+
+    hist = obs_seq_rank_hist(filename, window=window, stride=stride, members=members, perturb=perturb,
+                             rows=rows, workers=workers, seed=seed)
+
+    if hist == None:
+        return []
+
+    if out == None:
+        out = "%s/RANK_%s.nc" % (image_dir, os.path.splitext(os.path.split(filename)[-1])[0][-8:])
+
+    obs_seq_rank_write(out, hist)
+
+    print(" obs_seq_rank_hist:  %d kinds ranked against %d members, written to %s" %
+          (len(hist['names']), len(hist['members']), out))
+
+    return obs_seq_rank_jobs(hist, filename, image_dir=image_dir, plotfilename=plotfilename, plotlabel=plotlabel)
+
+#=========================================================================================
+# Rank histograms of an obs_seq_file.nc file created by obs_seq_collate --copies
+#-------------------------------------------------------------------------------
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv
+
+    parser = OptionParser()
+
+    parser.add_option("-f", "--file",  dest="file",  default=None, type="string", help = "netCDF4 obs_seq_final to process")
+    parser.add_option("-p", "--plotfile",  dest="plotfilename",  default=None, type="string", help = "prefix of the output png files")
+    parser.add_option("-o", "--out", dest="out", default=None, type="string", help = "rank histogram netCDF file, default is RANK_YYYYMMDD.nc in --dir")
+    parser.add_option("--dir",  dest="dir",  default="./", type="string", help = "full pathname where to put the images")
+    parser.add_option("--members", dest="members", default="prior", type="string", help = "rank against the prior or posterior members, default is prior")
+    parser.add_option("--perturb", dest="perturb", default=False, action="store_true", help = "perturb the members with the obs error before ranking")
+    parser.add_option("--seed", dest="seed", default=0, type="int", help = "seed of the random tie breaks and perturbations, default is 0")
+    parser.add_option("--window", dest="window", default=45, type="int", help = "length of the time windows in minutes, default is 45")
+    parser.add_option("--stride", dest="stride", default=15, type="int", help = "minutes between the starts of the time windows, default is 15")
+    parser.add_option("--chunk", dest="chunk", default=chunk_rows, type="int", help = "rank the obs in chunks of this many rows, default is %d" % chunk_rows)
+    parser.add_option("--workers", dest="workers", default=1, type="int", help = "number of processes ranking the chunks, default is 1")
+    parser.add_option("--processes", dest="processes", default=None, type="int", help = "number of processes drawing the images, default is one per core")
+    parser.add_option("--noplot", dest="plot", default=True, action="store_false", help = "only write the rank histogram file")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.file == None:
+        print("\n                NO FILE IS SUPPLIED, EXITING.... \n ")
+        parser.print_help()
+        sys.exit(1)
+
+    jobs = obs_seq_rank_hist_jobs(options.file, image_dir=options.dir, plotfilename=options.plotfilename,
+                                  window=options.window, stride=options.stride, members=options.members,
+                                  perturb=options.perturb, out=options.out, rows=options.chunk,
+                                  workers=options.workers, seed=options.seed)
+
+    if options.plot and len(jobs) > 0:
+        obs_seq_render(jobs, processes=options.processes)
+
+#-------------------------------------------------------------------------------
+# Main program for testing...
+#
+if __name__ == "__main__":
+    sys.exit(main())
+
+# End of file
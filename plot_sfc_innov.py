@@ -17,6 +17,11 @@ mpl.rcParams['figure.figsize'] = (12,10)
 import matplotlib.ticker as ticker
 import matplotlib.dates as mdates
 from pltbook import nice_mxmnintvl, nice_clevels
+from obs_seq_load import obs_seq_load, obs_seq_load_diag, obs_seq_load_select
+from obs_seq_cube import obs_seq_cube_1D_stats
+from obs_seq_bins import obs_seq_1D_stats, obs_seq_time_windows
+from obs_seq_render import obs_seq_render_job
+from obs_seq_chunks import obs_seq_chunk_1D_stats
 import matplotlib.transforms as mtransforms
 
 time_format = "%Y-%m-%d_%H:%M:%S"
@@ -31,25 +36,30 @@ plot_params = {0:['LAND_SFC_TEMPERATURE',     'METAR_TEMPERATURE_2_METER',-3,3],
                3:['LAND_SFC_U_WIND_COMPONENT','METAR_U_10_METER_WIND',  -5,5], 
                4:['LAND_SFC_V_WIND_COMPONENT','METAR_V_10_METER_WIND',  -5,5]}
 
-# Create 30 min bins for a 9 hour period (9x4=36)
-time_bins = [ (15*t,15*(t+3)) for t in range(36)]
-
 #-------------------------------------------------------------------------------
+# Read the collated file through obs_seq_load:  only the listed columns (default all) and
+# only the rows of the listed kinds (default all) are read.
 #
-def obs_seq_read_netcdf(filename, retFileAttr = False):
+def obs_seq_read_netcdf(filename, retFileAttr = False, columns=None, kinds=None):
+    dataset, attrs = obs_seq_load(filename, columns=columns, kinds=kinds)
     if retFileAttr == False:
-        try:
-            return xr.open_dataset(filename).to_dataframe()
-        except IOError:
-            print(" \n ----> netCDF obs_seq_final file not found! \n")
-            sys.exit(-1)
+        return dataset
     else:
-        try:
-            xa = xr.open_dataset(filename)
-            return xa.to_dataframe(), xa.attrs
-        except IOError:
-            print(" \n ----> netCDF obs_seq_final file not found! \n")
-            sys.exit(-1)
+        return dataset, attrs
+
+#-------------------------------------------------------------------------------
+# Time origin of anal_min (the first analysis time), from the time_from_1800 file attribute
+# or the datetime64 anal_time column.  Files collated before anal_time was a real time
+# column fall back to an 18Z origin.
+#
+def obs_seq_time_origin(df, attrs={}):
+    if 'time_from_1800' in attrs:
+        return dtime.datetime.strptime(attrs['time_from_1800'], time_format)
+    try:
+        origin = df['anal_time'] - pd.to_timedelta(df['anal_min'], unit='m')
+        return origin.min().to_pydatetime()
+    except (KeyError, TypeError, ValueError, AttributeError):
+        return dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
 
 #-------------------------------------------------------------------------------
 #
@@ -72,65 +82,17 @@ def obs_seq_get_obtype(df, kind=None, name=None):
     sys.exit(-1)
     
 #-------------------------------------------------------------------------------
+# Time series of the mean and RMS of variable, the mean posterior spread and the number of
+# obs in each time bin, from the vectorized engine in obs_seq_bins
 #
 def obs_seq_1D_bin(df, variable, time=None, threshold=None, dart_qc=True):
-    
-    # Create the data structures needed for bin information
-    
-    bins     = np.zeros(len(time))
-    rms      = np.zeros(len(time))
-    spread   = np.zeros(len(time))
-    num_obs  = np.zeros(len(time))
-    min      = []
-
-    for n, t in enumerate(time):
-        
-        # Create coordinate list for time in minutes
-        min.append(t[0])
-        
-        # This string is used to bin data in time
-        time_string = '%d <= anal_min <= %d' % (t[0], t[1])
 
-        # Pandas dataframe query:  This query string returns a new dataframe with only those
-        # rows that match the string.
-        cut0_df = df.query(time_string)
-
-        # Remove all DART_QC indices != 0.0 because those are the only ones assimilated...
-        if dart_qc:
-            cut1_df = cut0_df.query("dart_qc < 0.1")
-        else:
-            cut1_df = cut0_df
-
-        if threshold != None:  # threshold is a string, like "heights > 2000." 
-            cut2_df    = cut1_df.query(threshold)
-            cut3_df    = cut2_df[variable]
-            bins[n]    = cut3_df.mean()
-            rms[n]     = np.sqrt((cut3_df**2).mean())
-            spread[n]  = cut2_df['sdHxa'].mean()
-            num_obs[n] = np.sum(cut3_df != 0.0)
-        else:
-            cut2_df    = cut1_df[variable]
-            bins[n]    = cut2_df.mean()
-            rms[n]     = np.sqrt((cut2_df**2).mean())
-            spread[n]  = cut1_df['sdHxa'].mean()
-            num_obs[n] = np.sum(cut2_df != 0.0)
-
-    if threshold != None:
-        del cut0_df, cut1_df, cut2_df
-    else:
-        del cut0_df, cut1_df
-
-        
-    return {'spread':  np.ma.masked_invalid(spread), 
-            'bin1d':   np.ma.masked_invalid(bins), 
-            'rms1d':   np.ma.masked_invalid(rms), 
-            'num_obs': num_obs,  
-            'mins':    np.array(min)}
+    return obs_seq_1D_stats(df, variable, time=time, threshold=threshold, dart_qc=dart_qc)
 
 #-------------------------------------------------------------------------------
 #
 
-def obs_seq_SfcInnov(data_dict, axX=None, cint=None, title=None):
+def obs_seq_SfcInnov(data_dict, axX=None, cint=None, title=None, time_from=None):
         
     # Decouple data_dict
     spread   = data_dict['spread']
@@ -140,7 +102,10 @@ def obs_seq_SfcInnov(data_dict, axX=None, cint=None, title=None):
     num_obs  = data_dict['num_obs']
     
     datebins = []
-    minutes_from = dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
+    if time_from != None:
+        minutes_from = time_from
+    else:
+        minutes_from = dtime.datetime.strptime("2017-05-16_18:00:00", time_format)
     for min in anal_min:
         datebins.append(minutes_from + dtime.timedelta(0,int(min)*60))
     
@@ -200,41 +165,72 @@ def obs_seq_SfcInnov(data_dict, axX=None, cint=None, title=None):
         axX.set_title(title, zorder=10)
                 
 #-------------------------------------------------------------------------------
-# Main function defined to return correct sys.exit() calls
+# The five panels of the surface diagnostics:  panels is a list of dictionaries with the
+# time series (stats), y range (cint) and title of each panel
+#
+def obs_seq_SfcDiag(panels, plotlabel=None, time_from=None, fig=None):
 
-def main(argv=None):
-    if argv is None:
-           argv = sys.argv
+    if fig == None:
+        fig = plt.figure(figsize=(12,14))
 
-# Command line interface definitions
+    ax = fig.subplots(len(panels))
 
-    parser = OptionParser()
+    for key, panel in enumerate(panels):
+        obs_seq_SfcInnov(panel['stats'], axX = ax[key], cint=panel['cint'], title=panel['title'], time_from=time_from)
+    
+    fig.subplots_adjust(hspace=0.3, wspace=0.3)
+    plt.setp([a.get_xticklabels() for a in ax[:-1]], visible=False)
+    ax[-1].set_xlabel("Time")
+    fig.suptitle(("\n\nDiagnostics for %s\n\nBlack Line = Innov     Red Line = RMSI\
+    Blue Line = Prior Spread      Green = No. of Obs" % plotlabel), 
+             size=12, va="baseline", ha="center", multialignment="center", y= 0.925)
+    fig.tight_layout(rect=[0.1, 0.1, 0.9, 0.9])
 
-    parser.add_option("-f", "--file",  dest="file",  default=None, type="string", help = "obs_seq.final.nc file to process")
-    parser.add_option("--dir",  dest="dir",  default="./", type="string", help = "full pathname where to put image")
+#-------------------------------------------------------------------------------
+# Statistics of the surface innovation time series of a collated file, as an obs_seq_render
+# job.  data is an optional obs_seq_load_diag dictionary shared by several plots of the
+# same file (see obs_seq_diag), so the file is only read once.  The png and the label
+# default to the date in the file name.
+#
+def obs_seq_sfc_innov_job(filename, image_dir="./", plotfilename=None, plotlabel=None, window=45, stride=15,
+                          raw=False, data=None, chunk=None, workers=1):
 
-    (options, args) = parser.parse_args()
+    day = os.path.splitext(filename)[0][-8:]
 
-    if options.file == None:
-        print "\n                NO INPUT obs_seq_final.nc IS SUPPLIED, EXITING.... \n "
-        parser.print_help()
-        print
-        sys.exit(1)
-    else:
-        file       = options.file
-        image_dir  = options.dir
+    if plotfilename == None:
+        plotfilename = "%s/SFC_ObsDiag_%s" % (image_dir, day)
+
+    if plotlabel == None:
+        plotlabel = "SFC %s" % day
+
+    # Use the statistics cube written by obs_seq_collate --stats when the file has one,
+    # otherwise read the surface kinds and bin the obs (out of core, chunk rows at a time,
+    # when chunk is given)
 
-# Start code
+    kind_names = [name for key in plot_params.keys() for name in plot_params[key][:2]]
+    columns    = ['kind', 'anal_min', 'dart_qc', 'innov', 'sdHxa']
 
-    plotlabel = "SFC %s" % file[-11:-3]
-    dataset, fileAttrs = obs_seq_read_netcdf(file, retFileAttr = True)
+    if data == None:
+        data = obs_seq_load_diag(filename, columns=columns, kinds=kind_names, raw=raw, obs=chunk == None)
 
-    fig, ax = plt.subplots(5, figsize=(12,14))
+    fileAttrs = data['attrs']
+    cube      = None
+    dataset   = None
+
+    if not raw:
+        cube = data['cube']
+
+    if cube == None and chunk == None:
+        dataset = obs_seq_load_select(data, columns, kind_names)
+
+    time_from = obs_seq_time_origin(dataset, fileAttrs)
+
+    time_windows = obs_seq_time_windows(window, stride)
+
+    panels = []
 
     for key in np.arange(5):
     
-        field = pd.DataFrame({'A' : []})
-    
         ptitle = "%s and %s" % (plot_params[key][0],plot_params[key][1])
         print(" Plotting:  %s" % ptitle)
         try:
@@ -245,23 +241,58 @@ def main(argv=None):
             except:
                 kinds = [fileAttrs[plot_params[key][1]]]
 
-        field  = obs_seq_get_obtype(dataset, kind=kinds)
-    
-        data_dict = obs_seq_1D_bin(field, 'innov', time=time_bins)
-        obs_seq_SfcInnov(data_dict, axX = ax[key], cint=plot_params[key][2:], title=ptitle)
+        if cube != None:
+            data_dict = obs_seq_cube_1D_stats(cube, 'innov', time=time_windows, kinds=kinds)
+        elif chunk != None:
+            data_dict = obs_seq_chunk_1D_stats(filename, 'innov', time=time_windows, kinds=kinds, rows=chunk,
+                                               workers=workers)
+        else:
+            field     = obs_seq_get_obtype(dataset, kind=kinds)
+            data_dict = obs_seq_1D_bin(field, 'innov', time=time_windows)
+            del field
 
-        del field, data_dict
-    
-    fig.subplots_adjust(hspace=0.3, wspace=0.3)
-    plt.setp([a.get_xticklabels() for a in ax[:-1]], visible=False)
-    ax[-1].set_xlabel("Time")
-    fig.suptitle(("\n\nDiagnostics for %s\n\nBlack Line = Innov     Red Line = RMSI\
-    Blue Line = Prior Spread      Green = No. of Obs" % plotlabel), 
-             size=12, va="baseline", ha="center", multialignment="center", y= 0.925)
-    fig.tight_layout(rect=[0.1, 0.1, 0.9, 0.9])
-    
-    plt.savefig("%s/SFC_ObsDiag_%s.png" % (image_dir, file[-11:-3]))
-#   plt.show()
+        panels.append({'stats': data_dict, 'cint': plot_params[key][2:], 'title': ptitle})
+
+    return {'product': 'sfc_innov', 'kind': 'SFC', 'stats': panels, 'output': plotfilename+".png",
+            'options': {'plotlabel': plotlabel, 'time_from': time_from}}
+
+#-------------------------------------------------------------------------------
+# Draw the plot of obs_seq_sfc_innov_job into its png.  Returns the png file name.
+#
+def obs_seq_sfc_innov(filename, image_dir="./", window=45, stride=15, raw=False, data=None, chunk=None, workers=1):
+
+    return obs_seq_render_job(obs_seq_sfc_innov_job(filename, image_dir=image_dir, window=window, stride=stride,
+                                                    raw=raw, data=data, chunk=chunk, workers=workers))
+
+#-------------------------------------------------------------------------------
+# Main function defined to return correct sys.exit() calls
+
+def main(argv=None):
+    if argv is None:
+           argv = sys.argv
+
+# Command line interface definitions
+
+    parser = OptionParser()
+
+    parser.add_option("-f", "--file",  dest="file",  default=None, type="string", help = "obs_seq.final.nc file to process")
+    parser.add_option("--dir",  dest="dir",  default="./", type="string", help = "full pathname where to put image")
+    parser.add_option("--window", dest="window", default=45, type="int", help = "length of the time windows in minutes, default is 45")
+    parser.add_option("--stride", dest="stride", default=15, type="int", help = "minutes between the starts of the time windows, default is 15")
+    parser.add_option("--raw", dest="raw", default=False, action="store_true", help = "bin the obs even when the file has a statistics cube")
+    parser.add_option("--chunk", dest="chunk", default=None, type="int", help = "bin the obs out of core in chunks of this many rows")
+    parser.add_option("--workers", dest="workers", default=1, type="int", help = "number of processes binning the chunks, default is 1")
+
+    (options, args) = parser.parse_args(argv[1:])
+
+    if options.file == None:
+        print "\n                NO INPUT obs_seq_final.nc IS SUPPLIED, EXITING.... \n "
+        parser.print_help()
+        print
+        sys.exit(1)
+
+    obs_seq_sfc_innov(options.file, image_dir=options.dir, window=options.window, stride=options.stride,
+                      raw=options.raw, chunk=options.chunk, workers=options.workers)
     
 #-------------------------------------------------------------------------------
 # Main program for testing...
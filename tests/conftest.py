@@ -0,0 +1,9 @@
+# coding: utf-8
+#
+# The scripts are flat modules at the top of the repository:  put it on the path of the tests.
+#
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
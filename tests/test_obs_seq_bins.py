@@ -0,0 +1,140 @@
+# coding: utf-8
+#
+# obs_seq_bin_sums against the nested DataFrame.query loops it replaced (obs_seq_2D_bin
+# of plot_radar_innov):  the 45 minute windows every 15 minutes, uneven height bins with
+# a gap, values on the bin edges and missing values.
+#
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from obs_seq_bins import obs_seq_bin_sums, obs_seq_time_windows, obs_seq_2D_from_sums, obs_seq_1D_from_sums
+
+height_bins = [(0, 1000), (1000, 2000), (2000, 3000), (3000, 4000), (4000, 5000), (5000, 6000),
+               (7000, 8000), (8000, 9000), (9000, 10000)]
+
+#-------------------------------------------------------------------------------
+# Synthetic obs:  analysis minutes and heights partly on the bin edges, some NaN values
+# and spreads, some zero values and some obs rejected by DART QC
+#
+def obs_frame(nobs=3000, seed=0):
+
+    rng = np.random.RandomState(seed)
+
+    anal_min = rng.randint(-30, 570, nobs).astype(np.float64)
+    height   = rng.uniform(-500., 11000., nobs)
+    edges    = rng.rand(nobs) < 0.2
+    height[edges] = 1000. * rng.randint(0, 11, edges.sum())
+
+    innov = rng.randn(nobs)
+    innov[rng.rand(nobs) < 0.05] = np.nan
+    innov[rng.rand(nobs) < 0.05] = 0.0
+
+    sdHxf = rng.uniform(0.5, 2., nobs)
+    sdHxf[rng.rand(nobs) < 0.05] = np.nan
+
+    return pd.DataFrame({'anal_min': anal_min,
+                         'height':   height,
+                         'innov':    innov,
+                         'sdHxf':    sdHxf,
+                         'sdHxa':    0.5 * sdHxf,
+                         'dart_qc':  rng.randint(0, 3, nobs) * (rng.rand(nobs) < 0.3)})
+
+#-------------------------------------------------------------------------------
+# The old loops:  one query per time bin, height bin, DART QC and threshold
+#
+def query_2D_bin(df, variable, time, height, threshold=None, dart_qc=True, spread='sdHxf'):
+
+    bins    = np.zeros((len(height), len(time)))
+    sprd    = np.zeros((len(height), len(time)))
+    num_obs = np.zeros((len(height), len(time)))
+
+    for n, t in enumerate(time):
+        cut0_df = df.query('%d <= anal_min <= %d' % (t[0], t[1]))
+        for m, z in enumerate(height):
+            cut1_df = cut0_df.query('%f < height <= %f' % (z[0], z[1]))
+            if dart_qc:
+                cut1_df = cut1_df.query("dart_qc < 0.1")
+            if threshold != None:
+                cut1_df = cut1_df.query(threshold)
+            bins[m,n]    = cut1_df[variable].mean()
+            sprd[m,n]    = cut1_df[spread].mean()
+            num_obs[m,n] = np.sum(cut1_df[variable] != 0.0)
+
+    return {'bin2d': bins, 'spread': sprd, 'num_obs': num_obs}
+
+def assert_same_bins(new, old):
+
+    for name in ['bin2d', 'spread', 'num_obs']:
+        np.testing.assert_allclose(new[name], old[name], rtol=1.e-10, atol=1.e-12, equal_nan=True, err_msg=name)
+
+#=========================================================================================
+#
+@pytest.mark.parametrize("window, stride", [(45, 15), (15, 15), (60, 10)])
+def test_time_windows(window, stride):
+
+    df   = obs_frame()
+    time = obs_seq_time_windows(window, stride)
+
+    new = obs_seq_2D_from_sums(obs_seq_bin_sums(df, 'innov', time, height_bins))
+    old = query_2D_bin(df, 'innov', time, height_bins)
+
+    assert new['bin2d'].shape == (len(height_bins), len(time))
+    assert_same_bins(new, old)
+    np.testing.assert_array_equal(new['mins'], [t[0] for t in time])
+
+def test_irregular_time_bins():
+
+    df   = obs_frame(seed=1)
+    time = [(0, 20), (10, 90), (90, 95), (300, 299), (400, 560)]
+
+    assert_same_bins(obs_seq_2D_from_sums(obs_seq_bin_sums(df, 'innov', time, height_bins)),
+                     query_2D_bin(df, 'innov', time, height_bins))
+
+def test_unordered_height_bins():
+
+    df     = obs_frame(seed=2)
+    time   = obs_seq_time_windows(45, 15)
+    height = [(2000, 5000), (0, 1500), (1000, 3000), (8000, 12000)]
+
+    assert_same_bins(obs_seq_2D_from_sums(obs_seq_bin_sums(df, 'innov', time, height)),
+                     query_2D_bin(df, 'innov', time, height))
+
+def test_threshold_and_no_qc():
+
+    df   = obs_frame(seed=3)
+    time = obs_seq_time_windows(45, 15)
+
+    new = obs_seq_bin_sums(df, 'innov', time, height_bins, threshold="sdHxf > 1.", dart_qc=False)
+
+    assert_same_bins(obs_seq_2D_from_sums(new),
+                     query_2D_bin(df, 'innov', time, height_bins, threshold="sdHxf > 1.", dart_qc=False))
+
+def test_rms():
+
+    df   = obs_frame(seed=4)
+    time = obs_seq_time_windows(45, 15)
+
+    new = obs_seq_2D_from_sums(obs_seq_bin_sums(df, 'innov', time, height_bins), statistic="rms")
+    df['innov2'] = df['innov']**2
+    old = query_2D_bin(df, 'innov2', time, height_bins)
+
+    np.testing.assert_allclose(new['bin2d'], np.sqrt(old['bin2d']), rtol=1.e-10, equal_nan=True)
+
+#-------------------------------------------------------------------------------
+# Without height bins:  the time series of plot_sfc_innov
+#
+def test_time_series():
+
+    df   = obs_frame(seed=5)
+    time = obs_seq_time_windows(45, 15)
+
+    new = obs_seq_1D_from_sums(obs_seq_bin_sums(df, 'innov', time, spread='sdHxa'))
+
+    for n, t in enumerate(time):
+        cut = df.query('%d <= anal_min <= %d' % (t[0], t[1])).query("dart_qc < 0.1")
+        np.testing.assert_allclose(new['bin1d'].filled(np.nan)[n], cut['innov'].mean(), rtol=1.e-10)
+        np.testing.assert_allclose(new['rms1d'].filled(np.nan)[n], np.sqrt((cut['innov']**2).mean()), rtol=1.e-10)
+        np.testing.assert_allclose(new['spread'].filled(np.nan)[n], cut['sdHxa'].mean(), rtol=1.e-10)
+        assert new['num_obs'][n] == np.sum(cut['innov'] != 0.0)
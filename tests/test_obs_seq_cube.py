@@ -0,0 +1,121 @@
+# coding: utf-8
+#
+# Statistics cubes merged with the pairwise (Chan et al.) update against the cube of all
+# the obs in a single pass, and the statistics drawn from a cube against those binned
+# from the obs.
+#
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from obs_seq_cube import obs_seq_cube, obs_seq_cube_merge, obs_seq_cube_add, obs_seq_cube_2D_stats
+from obs_seq_cube import cube_fields, cube_stats
+from obs_seq_bins import obs_seq_2D_stats, obs_seq_time_windows
+
+height_bins = [(0, 1000), (1000, 2000), (2000, 3000), (3000, 4000), (4000, 5000), (5000, 6000),
+               (7000, 8000), (8000, 9000), (9000, 10000)]
+
+#-------------------------------------------------------------------------------
+# Synthetic obs of a few kinds and cycles:  heights partly on the level edges or out of
+# range, some NaN values and some obs rejected by DART QC
+#
+def obs_frame(nobs=4000, seed=0):
+
+    rng = np.random.RandomState(seed)
+
+    height = rng.uniform(-500., 12000., nobs)
+    edges  = rng.rand(nobs) < 0.2
+    height[edges] = 1000. * rng.randint(0, 11, edges.sum())
+
+    value   = 10. + 5. * rng.randn(nobs)
+    meanHxf = value - rng.randn(nobs)
+    meanHxf[rng.rand(nobs) < 0.05] = np.nan
+
+    sdHxf = rng.uniform(0.5, 2., nobs)
+    sdHxf[rng.rand(nobs) < 0.05] = np.nan
+
+    return pd.DataFrame({'kind':     rng.choice([1, 44, 45], nobs).astype(np.int32),
+                         'anal_min': 15. * rng.randint(0, 36, nobs),
+                         'height':   height,
+                         'dart_qc':  rng.randint(0, 3, nobs) * (rng.rand(nobs) < 0.3),
+                         'value':    value,
+                         'innov':    value - meanHxf,
+                         'meanHxa':  value - 0.5 * rng.randn(nobs),
+                         'sdHxf':    sdHxf,
+                         'sdHxa':    0.8 * sdHxf})
+
+def assert_same_cube(a, b):
+
+    assert sorted(a.keys()) == sorted(b.keys())
+
+    for name in ['kind', 'anal_min', 'height_lo', 'height_hi']:
+        np.testing.assert_array_equal(a[name], b[name], err_msg=name)
+
+    for field in cube_fields:
+        for stat in cube_stats:
+            name = "%s_%s" % (field, stat)
+            np.testing.assert_allclose(a[name], b[name], rtol=1.e-10, atol=1.e-9, err_msg=name)
+
+#=========================================================================================
+# Two halves with the same kinds and times, and two halves with different ones
+#
+@pytest.mark.parametrize("split", ["random", "time"])
+def test_merge_halves(split):
+
+    df = obs_frame()
+
+    if split == "time":
+        first = (df['anal_min'].values < 200.) & (df['kind'].values != 45)
+    else:
+        first = np.random.RandomState(1).rand(len(df)) < 0.5
+
+    merged = obs_seq_cube_merge(obs_seq_cube(df[first]), obs_seq_cube(df[~first]))
+
+    assert_same_cube(merged, obs_seq_cube(df))
+    assert_same_cube(obs_seq_cube_merge(obs_seq_cube(df[~first]), obs_seq_cube(df[first])), obs_seq_cube(df))
+
+def test_merge_none():
+
+    cube = obs_seq_cube(obs_frame())
+
+    assert obs_seq_cube_merge(None, cube) is cube
+    assert obs_seq_cube_merge(cube, None) is cube
+
+#-------------------------------------------------------------------------------
+# Chunks folded in one at a time, as obs_seq_chunk_cube and collate --stats do
+#
+def test_cube_add_chunks():
+
+    df   = obs_frame(seed=2)
+    cube = None
+
+    for start in range(0, len(df), 700):
+        cube = obs_seq_cube_add(cube, df.iloc[start:start+700])
+
+    assert_same_cube(cube, obs_seq_cube(df))
+
+def test_merge_no_qc():
+
+    df    = obs_frame(seed=3)
+    first = np.arange(len(df)) < 1500
+
+    assert_same_cube(obs_seq_cube_merge(obs_seq_cube(df[first], dart_qc=False), obs_seq_cube(df[~first], dart_qc=False)),
+                     obs_seq_cube(df, dart_qc=False))
+
+#-------------------------------------------------------------------------------
+# The time-height statistics of a merged cube are those binned from the obs
+#
+@pytest.mark.parametrize("statistic", ["mean", "rms"])
+def test_cube_2D_stats(statistic):
+
+    df    = obs_frame(seed=4)
+    time  = obs_seq_time_windows(45, 15)
+    first = np.random.RandomState(5).rand(len(df)) < 0.5
+    cube  = obs_seq_cube_merge(obs_seq_cube(df[first]), obs_seq_cube(df[~first]))
+
+    new = obs_seq_cube_2D_stats(cube, 'innov', time, height_bins, statistic=statistic)
+    old = obs_seq_2D_stats(df, 'innov', time, height_bins, statistic=statistic)
+
+    for name in ['bin2d', 'spread', 'num_obs']:
+        np.testing.assert_allclose(new[name], old[name], rtol=1.e-10, atol=1.e-12, equal_nan=True, err_msg=name)
@@ -0,0 +1,102 @@
+# coding: utf-8
+#
+# The mmap parser (obs_seq_parse) against the original line-by-line reader
+# (read_obs_seq_python) on the small synthetic obs_seq.final of tests/data:  both
+# location line formats, radial velocity obs with their platform lines, five copies and
+# two QC values.
+#
+
+import os
+
+import numpy as np
+import pytest
+
+import obs_seq_parse
+from obs_seq_collate import obs_seq_header, obs_seq_from_columns, read_obs_seq_python
+
+obs_seq_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "obs_seq.final.201805011800")
+
+# The last ob of the fixture:  the line-by-line reader takes the time and error variance of
+# the last ob from the ob before it, so these are checked against the file instead
+
+last_ob = {'kind': 4, 'seconds': 64855, 'days': 152125, 'error_variance': 2.500887523876590E+01,
+           'value': -6.756671677985868E+00, 'height': 2560.3008147476143677}
+
+#-------------------------------------------------------------------------------
+# Every field of the two record arrays, NaNs in the same places.  b is read by
+# read_obs_seq_python, so its last ob is only compared by kind and location.
+#
+def assert_same_obs(a, b):
+
+    assert a.dtype.names == b.dtype.names
+    assert a.size == b.size
+
+    for name in a.dtype.names:
+        if name in ['seconds', 'days', 'error_variance', 'utime', 'date']:
+            x, y = a[name][:-1], b[name][:-1]
+        else:
+            x, y = a[name], b[name]
+        if x.dtype.kind in 'fc':
+            np.testing.assert_allclose(x, y, rtol=1.e-12, equal_nan=True, err_msg=name)
+        else:
+            np.testing.assert_array_equal(x, y, err_msg=name)
+
+    for name in last_ob.keys():
+        np.testing.assert_allclose(a[name][-1], last_ob[name], rtol=1.e-7, err_msg=name)
+
+def read_mmap(fhead, workers=1):
+
+    return obs_seq_from_columns(obs_seq_parse.read_obs_columns(fhead, workers=workers), fhead)
+
+#=========================================================================================
+#
+def test_read_obs_columns():
+
+    fhead = obs_seq_header(obs_seq_file)
+
+    python = read_obs_seq_python(fhead)
+    mmap   = read_mmap(fhead)
+
+    assert mmap.size == fhead.num_obs
+    assert np.any(mmap.kind == 45)
+    assert_same_obs(mmap, python)
+
+def test_read_obs_columns_workers():
+
+    fhead = obs_seq_header(obs_seq_file)
+
+    assert_same_obs(read_mmap(fhead, workers=3), read_obs_seq_python(fhead))
+
+@pytest.mark.parametrize("batch_size, block_size", [(7, 512), (1000, 8*1024*1024)])
+def test_iter_obs_columns(batch_size, block_size):
+
+    fhead = obs_seq_header(obs_seq_file)
+
+    parts = list(obs_seq_parse.iter_obs_columns(fhead, batch_size=batch_size, block_size=block_size))
+
+    assert all(part['number'].size <= batch_size for part in parts)
+    assert_same_obs(obs_seq_from_columns(obs_seq_parse.obs_seq_concat_columns(parts), fhead), read_obs_seq_python(fhead))
+
+#-------------------------------------------------------------------------------
+# A complete file without its final newline still reads, a truncated one does not
+#
+def test_no_final_newline(tmpdir):
+
+    filename = str(tmpdir.join(os.path.basename(obs_seq_file)))
+    with open(obs_seq_file, 'rb') as f:
+        text = f.read()
+    with open(filename, 'wb') as f:
+        f.write(text.rstrip(b'\n'))
+
+    assert_same_obs(read_mmap(obs_seq_header(filename)), read_obs_seq_python(obs_seq_header(obs_seq_file)))
+
+def test_truncated_file(tmpdir):
+
+    filename = str(tmpdir.join(os.path.basename(obs_seq_file)))
+    with open(obs_seq_file, 'rb') as f:
+        text = f.read()
+    with open(filename, 'wb') as f:
+        f.write(text[:text.rindex(b' OBS ') + 40])
+
+    with pytest.raises(ValueError):
+        read_mmap(obs_seq_header(filename))